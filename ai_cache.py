@@ -0,0 +1,334 @@
+"""
+Caché de resultados de IA direccionada por contenido.
+
+La clave se calcula con el SHA-256 de los bytes de las imágenes más el servicio,
+el modelo, el modo y la versión del prompt, de modo que volver a enviar la
+misma página escaneada no paga otra llamada al proveedor.
+
+Dos niveles:
+- Memoria: LRU acotado por número de entradas.
+- Disco: SQLite con TTL y desalojo por tamaño total (las entradas menos
+  usadas recientemente se eliminan primero).
+
+Además, las llamadas idénticas que llegan mientras otra sigue en curso se
+coalescen (SingleFlight): esperan el mismo resultado en vez de repetir la
+petición al proveedor.
+
+Variables de entorno:
+- AI_CACHE_ENABLED: "false" para desactivar la caché (default true)
+- AI_CACHE_PATH: ruta del archivo SQLite (default .cache/ai_cache.sqlite3)
+- AI_CACHE_TTL: segundos de validez de una entrada (default 7 días)
+- AI_CACHE_MEMORY_ENTRIES: entradas en el nivel de memoria (default 256)
+- AI_CACHE_MAX_BYTES: tamaño máximo del nivel en disco (default 200 MB)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+AI_CACHE_PATH = Path(os.getenv("AI_CACHE_PATH", ".cache/ai_cache.sqlite3"))
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+AI_CACHE_MEMORY_ENTRIES = int(os.getenv("AI_CACHE_MEMORY_ENTRIES", "256"))
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Cada cuántas escrituras se revisa el tamaño del nivel en disco
+_EVICT_EVERY = 50
+
+
+def hash_images(images: Iterable[bytes]) -> str:
+    """SHA-256 de cada imagen, combinado en orden"""
+    h = hashlib.sha256()
+    for image in images:
+        h.update(hashlib.sha256(image).digest())
+    return h.hexdigest()
+
+
+def make_cache_key(images: Iterable[bytes], service: str, model: str, mode: str, prompt_version: str, extra: str = "") -> str:
+    """Clave de caché: hash de las imágenes + servicio + modelo + modo + versión del prompt"""
+    partes = [hash_images(images), service, model, mode, prompt_version]
+    if extra:
+        partes.append(hashlib.sha256(extra.encode("utf-8")).hexdigest())
+    return "|".join(partes)
+
+
+def es_resultado_cacheable(result: Any) -> bool:
+    """No se guardan respuestas simuladas ni errores (RECITATION, fallos de API)"""
+    if not isinstance(result, dict):
+        return False
+    if "error" in result:
+        return False
+    return result.get("ai_service") != "mock"
+
+
+class AICache:
+    """Caché de dos niveles (LRU en memoria + SQLite en disco)"""
+
+    def __init__(
+        self,
+        path: Path = AI_CACHE_PATH,
+        ttl: float = AI_CACHE_TTL,
+        memory_entries: int = AI_CACHE_MEMORY_ENTRIES,
+        max_bytes: int = AI_CACHE_MAX_BYTES,
+    ):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        self.stats = {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "escrituras": 0, "desalojos": 0}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entradas (
+                    clave TEXT PRIMARY KEY,
+                    valor TEXT NOT NULL,
+                    creado REAL NOT NULL,
+                    ultimo_acceso REAL NOT NULL,
+                    bytes INTEGER NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entradas_acceso ON entradas(ultimo_acceso)")
+            self._conn.commit()
+        return self._conn
+
+    # ----- nivel en memoria -----
+
+    def _memory_get(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        item = self._memory.get(key)
+        if item is None:
+            return None
+        creado, valor = item
+        if now - creado > self.ttl:
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        return valor
+
+    def _memory_set(self, key: str, valor: Dict[str, Any], creado: float) -> None:
+        self._memory[key] = (creado, valor)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # ----- operaciones síncronas (se ejecutan en un hilo) -----
+
+    def get_sync(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            valor = self._memory_get(key, now)
+            if valor is not None:
+                self.stats["hits_memoria"] += 1
+                return json.loads(json.dumps(valor))
+
+            db = self._db()
+            row = db.execute("SELECT valor, creado FROM entradas WHERE clave = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            texto, creado = row
+            if now - creado > self.ttl:
+                db.execute("DELETE FROM entradas WHERE clave = ?", (key,))
+                db.commit()
+                self.stats["misses"] += 1
+                return None
+            db.execute("UPDATE entradas SET ultimo_acceso = ? WHERE clave = ?", (now, key))
+            db.commit()
+            valor = json.loads(texto)
+            self._memory_set(key, valor, creado)
+            self.stats["hits_disco"] += 1
+            return json.loads(texto)
+
+    def set_sync(self, key: str, valor: Dict[str, Any]) -> None:
+        now = time.time()
+        texto = json.dumps(valor, ensure_ascii=False)
+        with self._lock:
+            self._memory_set(key, json.loads(texto), now)
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO entradas (clave, valor, creado, ultimo_acceso, bytes) VALUES (?, ?, ?, ?, ?)",
+                (key, texto, now, now, len(texto.encode("utf-8"))),
+            )
+            db.commit()
+            self.stats["escrituras"] += 1
+            self._writes += 1
+            if self._writes % _EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """Elimina entradas vencidas y, si se excede el tamaño, las menos usadas"""
+        db = self._db()
+        cur = db.execute("DELETE FROM entradas WHERE creado < ?", (now - self.ttl,))
+        eliminadas = cur.rowcount
+        total = db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entradas").fetchone()[0]
+        if total > self.max_bytes:
+            exceso = total - self.max_bytes
+            filas = db.execute("SELECT clave, bytes FROM entradas ORDER BY ultimo_acceso ASC").fetchall()
+            claves = []
+            for clave, size in filas:
+                if exceso <= 0:
+                    break
+                claves.append((clave,))
+                exceso -= size
+            db.executemany("DELETE FROM entradas WHERE clave = ?", claves)
+            for (clave,) in claves:
+                self._memory.pop(clave, None)
+            eliminadas += len(claves)
+        db.commit()
+        self.stats["desalojos"] += eliminadas
+
+    # ----- API asíncrona -----
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.get_sync, key)
+
+    async def set(self, key: str, valor: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.set_sync, key, valor)
+
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.stats["hits_memoria"] + self.stats["hits_disco"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hits": hits,
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "entradas_memoria": len(self._memory),
+            "habilitada": AI_CACHE_ENABLED,
+        }
+
+
+ai_cache = AICache()
+
+
+class SingleFlight:
+    """
+    Coalescencia de llamadas idénticas en curso: mientras una llamada con la
+    misma clave (hash de imágenes + servicio + modelo + modo + prompt) no ha
+    terminado, las siguientes esperan su resultado en lugar de repetir la
+    petición al proveedor (doble clic en "Procesar con IA", dos revisores con
+    la misma página).
+
+    La llamada compartida corre en su propia tarea: si el primer cliente se
+    desconecta, los demás siguen recibiendo el resultado.
+    """
+
+    def __init__(self):
+        self._en_vuelo: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+        self.stats = {"lideres": 0, "coalescidas": 0, "errores_compartidos": 0}
+
+    async def _esperar(self, fut: "asyncio.Future[Dict[str, Any]]") -> Dict[str, Any]:
+        self.stats["coalescidas"] += 1
+        logger.info(f"🔗 Petición idéntica en curso, esperando su resultado")
+        try:
+            result = await asyncio.shield(fut)
+        except Exception:
+            self.stats["errores_compartidos"] += 1
+            raise
+        # Copia: cada llamador puede modificar su resultado sin afectar a los demás
+        return json.loads(json.dumps(result))
+
+    def en_curso(self, key: str) -> Optional["asyncio.Future[Dict[str, Any]]"]:
+        return self._en_vuelo.get(key)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Ejecuta `fn` una sola vez por clave entre las llamadas concurrentes"""
+        fut = self._en_vuelo.get(key)
+        if fut is not None:
+            return await self._esperar(fut)
+
+        task = asyncio.ensure_future(fn())
+        self._registrar(key, task)
+        return await asyncio.shield(task)
+
+    def reservar(self, key: str) -> "asyncio.Future[Dict[str, Any]]":
+        """
+        Para llamadas que no son una corrutina simple (streaming): registra un
+        future que el llamador debe resolver con completar().
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._registrar(key, fut)
+        return fut
+
+    def completar(self, fut: "asyncio.Future[Dict[str, Any]]", result: Optional[Dict[str, Any]] = None, exc: Optional[BaseException] = None) -> None:
+        if fut.done():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+    async def esperar(self, key: str) -> Optional[Dict[str, Any]]:
+        """Resultado de la llamada en curso con esa clave, o None si no hay ninguna"""
+        fut = self._en_vuelo.get(key)
+        if fut is None:
+            return None
+        return await self._esperar(fut)
+
+    def _registrar(self, key: str, fut: "asyncio.Future[Dict[str, Any]]") -> None:
+        self.stats["lideres"] += 1
+        self._en_vuelo[key] = fut
+
+        def _liberar(f: "asyncio.Future[Dict[str, Any]]") -> None:
+            if self._en_vuelo.get(key) is f:
+                del self._en_vuelo[key]
+            if not f.cancelled():
+                f.exception()  # evita "exception was never retrieved" si nadie esperaba
+
+        fut.add_done_callback(_liberar)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "en_vuelo": len(self._en_vuelo)}
+
+
+single_flight = SingleFlight()
+
+
+async def cached_ai_call(key: str, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    Devuelve el resultado cacheado para `key` o ejecuta `fn` y guarda su resultado.
+    Las llamadas concurrentes con la misma clave comparten una sola ejecución.
+    Las respuestas simuladas o con error no se cachean.
+    """
+    return await single_flight.do(key, lambda: _cached_ai_call(key, fn))
+
+
+async def _cached_ai_call(key: str, fn: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    if not AI_CACHE_ENABLED:
+        return await fn()
+
+    cached = await ai_cache.get(key)
+    if cached is not None:
+        logger.info(f"💾 Resultado de IA servido desde caché")
+        return cached
+
+    result = await fn()
+    if es_resultado_cacheable(result):
+        try:
+            await ai_cache.set(key, result)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar en caché: {e}")
+    return result
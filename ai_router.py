@@ -0,0 +1,250 @@
+"""
+Router de proveedores para la extracción de preguntas.
+
+En lugar de llamar solo al servicio elegido en el formulario (y devolver una
+respuesta simulada si falla), route_images() trata ese servicio como
+preferido y usa los demás proveedores configurados como respaldo:
+
+- Failover: si el intento falla (RECITATION, HTTP 4xx/5xx tras los
+  reintentos, JSON irrecuperable, timeout), se lanza el siguiente candidato.
+- Hedging: si el intento en curso supera el p95 de latencia reciente de su
+  proveedor, se lanza en paralelo el siguiente candidato y gana la primera
+  respuesta válida (la otra se cancela). Así la latencia de cola queda acotada
+  por la del proveedor más rápido disponible en ese momento.
+- Los candidatos de respaldo se ordenan por tasa de error y p95 recientes
+  (ventana deslizante por proveedor); los que no tienen API key o tienen el
+  circuit breaker abierto no se usan.
+- Si todos fallan se lanza SinProveedorError: una respuesta simulada nunca
+  llega al formulario como si fuera real. La respuesta simulada solo se usa
+  cuando no hay ningún proveedor configurado (modo de prueba explícito).
+
+Variables de entorno:
+- AI_HEDGE_ENABLED: "false" para desactivar el hedging (el failover sigue activo)
+- AI_HEDGE_PERCENTILE: percentil de latencia que dispara el hedge (default 0.95)
+- AI_HEDGE_DEFAULT_DELAY: espera antes del hedge sin muestras suficientes (default 10s)
+- AI_HEDGE_MIN_DELAY / AI_HEDGE_MAX_DELAY: límites de esa espera (default 2s / 30s)
+- AI_ROUTER_TIMEOUT: tiempo máximo de cada intento (default 90s)
+- AI_ROUTER_WINDOW: muestras por proveedor para latencia y tasa de error (default 50)
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from ai_services import (
+    AI_API_KEYS,
+    dispatch_prepared,
+    get_mock_response,
+    get_provider_semaphore,
+    retry_key,
+)
+from app_logging import get_logger
+from image_preprocessing import preparar_imagenes
+from metrics import ai_router_events
+from retry_policy import get_breaker
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+AI_HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "true").lower() not in ("0", "false", "no")
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "0.95"))
+AI_HEDGE_DEFAULT_DELAY = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "10"))
+AI_HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "2"))
+AI_HEDGE_MAX_DELAY = float(os.getenv("AI_HEDGE_MAX_DELAY", "30"))
+AI_ROUTER_TIMEOUT = float(os.getenv("AI_ROUTER_TIMEOUT", "90"))
+AI_ROUTER_WINDOW = int(os.getenv("AI_ROUTER_WINDOW", "50"))
+
+# Proveedores con extracción implementada (Azure todavía devuelve la respuesta simulada)
+SERVICIOS_RUTEABLES = ("gemini", "openai", "claude")
+
+# Muestras mínimas antes de confiar en el percentil observado
+MIN_MUESTRAS = 5
+
+
+class SinProveedorError(RuntimeError):
+    """Ningún proveedor devolvió una respuesta válida"""
+
+
+class EstadisticasProveedor:
+    """Latencias de los intentos exitosos y resultados recientes de un proveedor"""
+
+    def __init__(self, ventana: int):
+        self.latencias: Deque[float] = deque(maxlen=ventana)
+        self.resultados: Deque[bool] = deque(maxlen=ventana)
+        self.contadores = {"exitos": 0, "fallos": 0, "hedges": 0, "hedges_ganados": 0, "failovers": 0}
+
+    def registrar(self, duracion: float, ok: bool) -> None:
+        self.resultados.append(ok)
+        if ok:
+            self.latencias.append(duracion)
+            self.contadores["exitos"] += 1
+        else:
+            self.contadores["fallos"] += 1
+
+    def percentil(self, q: float) -> Optional[float]:
+        if len(self.latencias) < MIN_MUESTRAS:
+            return None
+        ordenadas = sorted(self.latencias)
+        return ordenadas[max(0, math.ceil(q * len(ordenadas)) - 1)]
+
+    def tasa_error(self) -> float:
+        if not self.resultados:
+            return 0.0
+        return self.resultados.count(False) / len(self.resultados)
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50 = self.percentil(0.5)
+        p95 = self.percentil(0.95)
+        return {
+            **self.contadores,
+            "muestras": len(self.resultados),
+            "tasa_error": round(self.tasa_error(), 3),
+            "p50_s": round(p50, 3) if p50 is not None else None,
+            "p95_s": round(p95, 3) if p95 is not None else None,
+        }
+
+
+_estadisticas: Dict[str, EstadisticasProveedor] = {}
+
+
+def estadisticas(service: str) -> EstadisticasProveedor:
+    if service not in _estadisticas:
+        _estadisticas[service] = EstadisticasProveedor(AI_ROUTER_WINDOW)
+    return _estadisticas[service]
+
+
+def registrar_intento(service: str, duracion: float, ok: bool) -> None:
+    """Registra un intento hecho fuera del router (p. ej. la extracción en streaming)"""
+    estadisticas(service).registrar(duracion, ok)
+
+
+def router_snapshot() -> Dict[str, Any]:
+    return {service: stats.snapshot() for service, stats in sorted(_estadisticas.items())}
+
+
+def retraso_hedge(service: str) -> float:
+    """Espera antes de lanzar el respaldo: p95 reciente del proveedor, acotado"""
+    observado = estadisticas(service).percentil(AI_HEDGE_PERCENTILE)
+    retraso = AI_HEDGE_DEFAULT_DELAY if observado is None else observado
+    return min(AI_HEDGE_MAX_DELAY, max(AI_HEDGE_MIN_DELAY, retraso))
+
+
+def disponible(service: str) -> bool:
+    return bool(AI_API_KEYS.get(service)) and get_breaker(retry_key(service)).estado != "abierto"
+
+
+def candidatos(preferido: str, excluir: Iterable[str] = ()) -> List[str]:
+    """El servicio preferido primero; los de respaldo por tasa de error y p95 recientes"""
+    excluidos = set(excluir)
+    respaldo = [s for s in SERVICIOS_RUTEABLES if s != preferido and s not in excluidos and disponible(s)]
+    respaldo.sort(key=lambda s: (
+        estadisticas(s).tasa_error(),
+        estadisticas(s).percentil(AI_HEDGE_PERCENTILE) or AI_HEDGE_DEFAULT_DELAY,
+    ))
+    if preferido in SERVICIOS_RUTEABLES and preferido not in excluidos and disponible(preferido):
+        return [preferido] + respaldo
+    return respaldo
+
+
+def modo_simulado() -> bool:
+    """Sin ningún proveedor configurado la app funciona con respuestas simuladas"""
+    return not any(AI_API_KEYS.get(s) for s in SERVICIOS_RUTEABLES)
+
+
+async def _intento(service: str, images) -> Tuple[bool, Optional[Dict[str, Any]], str]:
+    """(ok, resultado, motivo del fallo) de una llamada a un proveedor"""
+    inicio = time.perf_counter()
+    result: Optional[Dict[str, Any]] = None
+    motivo = ""
+    try:
+        async with get_provider_semaphore(service):
+            result = await asyncio.wait_for(dispatch_prepared(service, images), AI_ROUTER_TIMEOUT)
+        if result.get("error"):
+            motivo = str(result["error"])
+        elif result.get("ai_service") == "mock":
+            motivo = "respuesta inválida o error HTTP"
+    except asyncio.CancelledError:
+        # Perdió contra un hedge: su latencia es al menos la transcurrida, y cuenta para el p95
+        estadisticas(service).latencias.append(time.perf_counter() - inicio)
+        raise
+    except asyncio.TimeoutError:
+        motivo = f"timeout ({AI_ROUTER_TIMEOUT:.0f}s)"
+    except Exception as e:
+        motivo = str(e) or type(e).__name__
+    registrar_intento(service, time.perf_counter() - inicio, not motivo)
+    return not motivo, result, motivo
+
+
+async def route_images(preferido: str, raw_images: List[bytes], excluir: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    Extrae la pregunta con `preferido` y, si falla o tarda más que su p95, con
+    los demás proveedores disponibles. Devuelve la primera respuesta válida
+    (su "ai_service" indica qué proveedor respondió).
+    """
+    orden = candidatos(preferido, excluir)
+    if not orden:
+        if modo_simulado():
+            logger.warning("⚠️ No hay API keys configuradas, usando respuesta simulada")
+            return get_mock_response(preferido)
+        raise SinProveedorError("Ningún proveedor de IA disponible (sin API key o circuito abierto)")
+
+    images = await preparar_imagenes(raw_images)
+    pendientes = list(orden)
+    en_vuelo: Dict["asyncio.Task", Tuple[str, float, str]] = {}
+    fallos: List[str] = []
+    recitation: Optional[Dict[str, Any]] = None
+
+    def lanzar(evento: str) -> None:
+        service = pendientes.pop(0)
+        if evento != "primario":
+            estadisticas(service).contadores[evento + "s"] += 1
+            ai_router_events.inc(provider=service, event=evento)
+        en_vuelo[asyncio.ensure_future(_intento(service, images))] = (service, time.monotonic(), evento)
+
+    lanzar("primario")
+    try:
+        while en_vuelo:
+            espera = None
+            if AI_HEDGE_ENABLED and pendientes and len(en_vuelo) == 1:
+                service, lanzado, _ = next(iter(en_vuelo.values()))
+                espera = max(0.0, retraso_hedge(service) - (time.monotonic() - lanzado))
+
+            listas, _ = await asyncio.wait(en_vuelo, timeout=espera, return_when=asyncio.FIRST_COMPLETED)
+            if not listas:
+                lento = next(iter(en_vuelo.values()))[0]
+                logger.info(f"⏱️ {lento} supera su p95, lanzando respaldo con {pendientes[0]}")
+                lanzar("hedge")
+                continue
+
+            for tarea in listas:
+                service, _, evento = en_vuelo.pop(tarea)
+                ok, result, motivo = tarea.result()
+                if ok:
+                    if evento != "primario":
+                        logger.info(f"🔀 Respuesta servida por {service} ({evento}, preferido: {preferido})")
+                    if evento == "hedge":
+                        estadisticas(service).contadores["hedges_ganados"] += 1
+                        ai_router_events.inc(provider=service, event="hedge_ganado")
+                    return result
+                logger.warning(f"⚠️ {service} falló: {motivo}")
+                fallos.append(f"{service}: {motivo}")
+                if motivo == "RECITATION":
+                    recitation = result
+
+            if not en_vuelo and pendientes:
+                logger.info(f"🔀 Failover a {pendientes[0]}")
+                lanzar("failover")
+    finally:
+        for tarea in en_vuelo:
+            tarea.cancel()
+
+    # Si el único problema fue el bloqueo por derechos de autor, se informa como tal
+    if recitation is not None and len(fallos) == 1:
+        return recitation
+    raise SinProveedorError("Ningún proveedor de IA pudo procesar la imagen: " + "; ".join(fallos))
@@ -0,0 +1,198 @@
+"""
+Registro de esquemas de salida para el modo de salida estructurada de cada proveedor.
+
+Los esquemas se derivan de los modelos Pydantic de models.py, de modo que el
+formato que se pide a la IA y el que se valida/guarda no se desincronizan:
+
+- "extraccion": PreguntaExtraida (ai_services.get_ai_prompt)
+- "variacion": VariacionPregunta (ai_variation.get_variation_prompt)
+- "comprension": PreguntaComprension (process_comprehension_question)
+- "lote": LotePreguntas (generador_batch/generar_sinteticas.py)
+
+Con el esquema en la petición el proveedor garantiza JSON válido, así que los
+prompts ya no necesitan el ejemplo de formato ni las advertencias sobre
+markdown; extract_json sigue como red de seguridad (toma el camino rápido de
+json.loads cuando la salida ya es válida).
+
+- Gemini: generationConfig.responseMimeType + responseSchema (subconjunto OpenAPI)
+- OpenAI: response_format de tipo json_schema con strict=true
+- Claude: una herramienta cuyo input_schema es el esquema, forzada con
+  tool_choice; la respuesta llega como bloque tool_use
+
+Variables de entorno:
+- AI_STRUCTURED_OUTPUT: "false" para volver a los prompts con formato en texto (default true)
+"""
+
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Type
+
+from pydantic import BaseModel
+
+from models import LotePreguntas, PreguntaComprension, PreguntaExtraida, VariacionPregunta
+
+ESQUEMAS: Dict[str, Type[BaseModel]] = {
+    "extraccion": PreguntaExtraida,
+    "variacion": VariacionPregunta,
+    "comprension": PreguntaComprension,
+    "lote": LotePreguntas,
+}
+
+# Nombre de la herramienta de Claude por esquema
+HERRAMIENTA_CLAUDE = "responder_json"
+
+
+def structured_output_enabled() -> bool:
+    """Se lee en cada llamada: el generador batch carga su .env después de importar"""
+    return os.getenv("AI_STRUCTURED_OUTPUT", "true").lower() not in ("0", "false", "no")
+
+
+def _resolver(nodo: Any, defs: Dict[str, Any]) -> Any:
+    """Inlinea $ref, convierte Optional (anyOf con null) en nullable y quita títulos/defaults"""
+    if isinstance(nodo, list):
+        return [_resolver(n, defs) for n in nodo]
+    if not isinstance(nodo, dict):
+        return nodo
+
+    if "$ref" in nodo:
+        base = _resolver(defs[nodo["$ref"].rsplit("/", 1)[-1]], defs)
+        if "description" in nodo:
+            base = {**base, "description": nodo["description"]}
+        return base
+
+    if "anyOf" in nodo:
+        variantes = [v for v in nodo["anyOf"] if v.get("type") != "null"]
+        if len(variantes) == 1 and len(variantes) < len(nodo["anyOf"]):
+            base = _resolver(variantes[0], defs)
+            base = {**base, "nullable": True}
+            if "description" in nodo:
+                base["description"] = nodo["description"]
+            return base
+
+    salida = {}
+    for clave, valor in nodo.items():
+        if clave in ("title", "default", "$defs"):
+            continue
+        if clave == "const":  # Literal de un solo valor
+            salida["enum"] = [valor]
+            continue
+        if clave == "properties":
+            continue
+        salida[clave] = _resolver(valor, defs) if clave in ("items", "anyOf") else valor
+    if "properties" in nodo:
+        salida["properties"] = {k: _resolver(v, defs) for k, v in nodo["properties"].items()}
+    return salida
+
+
+@lru_cache(maxsize=None)
+def _esquema_base(nombre: str) -> str:
+    modelo = ESQUEMAS[nombre]
+    schema = modelo.model_json_schema()
+    return json.dumps(_resolver(schema, schema.get("$defs", {})))
+
+
+def esquema_json(nombre: str) -> Dict[str, Any]:
+    """JSON Schema autocontenido (sin $ref) del esquema registrado `nombre`"""
+    return json.loads(_esquema_base(nombre))
+
+
+def _a_gemini(nodo: Dict[str, Any]) -> Dict[str, Any]:
+    salida = {k: v for k, v in nodo.items() if k not in ("properties", "items", "additionalProperties")}
+    if "type" in salida:
+        salida["type"] = salida["type"].upper()
+    if "properties" in nodo:
+        salida["properties"] = {k: _a_gemini(v) for k, v in nodo["properties"].items()}
+        # Mismo orden de campos que el modelo (ParserIncremental emite en ese orden)
+        salida["propertyOrdering"] = list(nodo["properties"])
+    if "items" in nodo:
+        salida["items"] = _a_gemini(nodo["items"])
+    return salida
+
+
+def _a_openai(nodo: Dict[str, Any]) -> Dict[str, Any]:
+    salida = {k: v for k, v in nodo.items() if k not in ("properties", "items", "nullable")}
+    if nodo.get("nullable"):
+        salida["type"] = [nodo["type"], "null"]
+    if "properties" in nodo:
+        # Modo strict: todos los campos requeridos y sin propiedades extra
+        salida["properties"] = {k: _a_openai(v) for k, v in nodo["properties"].items()}
+        salida["required"] = list(nodo["properties"])
+        salida["additionalProperties"] = False
+    if "items" in nodo:
+        salida["items"] = _a_openai(nodo["items"])
+    return salida
+
+
+def _a_claude(nodo: Dict[str, Any]) -> Dict[str, Any]:
+    salida = {k: v for k, v in nodo.items() if k not in ("properties", "items", "nullable")}
+    if nodo.get("nullable"):
+        salida["type"] = [nodo["type"], "null"]
+    if "properties" in nodo:
+        salida["properties"] = {k: _a_claude(v) for k, v in nodo["properties"].items()}
+    if "items" in nodo:
+        salida["items"] = _a_claude(nodo["items"])
+    return salida
+
+
+def gemini_generation_config(nombre: str) -> Dict[str, Any]:
+    """Claves a añadir en generationConfig (REST, camelCase)"""
+    return {"responseMimeType": "application/json", "responseSchema": _a_gemini(esquema_json(nombre))}
+
+
+def openai_response_format(nombre: str) -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": nombre, "strict": True, "schema": _a_openai(esquema_json(nombre))},
+    }
+
+
+def claude_tool_params(nombre: str) -> Dict[str, Any]:
+    """Claves `tools` y `tool_choice` que fuerzan a Claude a responder con el esquema"""
+    descripcion = (ESQUEMAS[nombre].__doc__ or nombre).strip()
+    return {
+        "tools": [{
+            "name": HERRAMIENTA_CLAUDE,
+            "description": descripcion,
+            "input_schema": _a_claude(esquema_json(nombre)),
+        }],
+        "tool_choice": {"type": "tool", "name": HERRAMIENTA_CLAUDE},
+    }
+
+
+def aplicar_esquema(service: str, payload: Dict[str, Any], nombre: str) -> Dict[str, Any]:
+    """
+    Añade al payload del proveedor el modo de salida estructurada del esquema
+    `nombre`. No hace nada si AI_STRUCTURED_OUTPUT está desactivado o el
+    proveedor no lo soporta (Azure usa el prompt con formato en texto).
+    """
+    if not structured_output_enabled():
+        return payload
+    if service == "gemini":
+        payload.setdefault("generationConfig", {}).update(gemini_generation_config(nombre))
+    elif service == "openai":
+        payload["response_format"] = openai_response_format(nombre)
+    elif service == "claude":
+        payload.update(claude_tool_params(nombre))
+    return payload
+
+
+def texto_respuesta_claude(result: Dict[str, Any]) -> str:
+    """
+    Texto de una respuesta de Claude: el input del bloque tool_use (como JSON)
+    si se usó el esquema, o el primer bloque de texto si no.
+    """
+    bloques = result.get("content") or []
+    for bloque in bloques:
+        if bloque.get("type") == "tool_use":
+            return json.dumps(bloque.get("input", {}), ensure_ascii=False)
+    for bloque in bloques:
+        if bloque.get("type") == "text":
+            return bloque.get("text", "")
+    raise ValueError("Respuesta de Claude sin contenido")
+
+
+def usa_esquema(service: str) -> bool:
+    """True si las peticiones a `service` llevan el esquema (el prompt puede omitir el formato)"""
+    return structured_output_enabled() and service in ("gemini", "openai", "claude")
+
@@ -1,16 +1,22 @@
-import base64
 import json
 import os
-import re
-from pathlib import Path
-from typing import Dict, Any
-import httpx
+from typing import Dict, Any, List, Tuple
+from http_client import get_http_client
+from ai_cache import cached_ai_call, make_cache_key
+from retry_policy import post_with_retry
+from json_repair import extract_json
+from ai_schemas import aplicar_esquema, texto_respuesta_claude, usa_esquema
+from metrics import ai_mock_responses
+from image_preprocessing import ImagenPreparada, preparar_imagen, preparar_imagenes
+from app_logging import get_logger, volcar_payload
 import asyncio
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Configuración de APIs (variables de entorno)
 AI_API_KEYS = {
     "openai": os.getenv("OPENAI_API_KEY", ""),
@@ -27,9 +33,27 @@ AI_MODELS = {
     "azure": os.getenv("AZURE_OPENAI_MODEL", "gpt-4o")
 }
 
-print(f"🔧 API Keys cargadas:")
-for service, key in AI_API_KEYS.items():
-    print(f"  {service}: {'✅ Configurada' if key else '❌ No configurada'} | Modelo: {AI_MODELS[service]}")
+logger.info("🔧 API Keys cargadas: " + ", ".join(
+    f"{service}={'✅' if key else '❌'} ({AI_MODELS[service]})" for service, key in AI_API_KEYS.items()
+))
+
+# Máximo de llamadas simultáneas a un mismo proveedor (evita ráfagas que disparen 429)
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+_provider_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def get_provider_semaphore(service: str) -> asyncio.Semaphore:
+    """Semáforo compartido por proveedor para acotar la concurrencia"""
+    if service not in _provider_semaphores:
+        _provider_semaphores[service] = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+    return _provider_semaphores[service]
+
+def retry_key(service: str) -> str:
+    """Clave de reintentos/circuit breaker: un circuito por modelo"""
+    return f"{service}:{AI_MODELS[service]}"
+
+# Versión de los prompts: incrementarla al modificarlos invalida la caché de resultados
+PROMPT_VERSION_EXTRACCION = "v2"
+PROMPT_VERSION_EXPLICACION = "v1"
 
 MATERIAS_DISPONIBLES = [
     "Razonamiento Lógico", "Razonamiento Matemático", "Razonamiento Verbal",
@@ -41,34 +65,177 @@ MATERIAS_DISPONIBLES = [
 
 async def process_image_with_ai(service: str, image_content: bytes, filename: str) -> Dict[str, Any]:
     """Procesa una imagen usando el servicio de IA especificado"""
-    
+    return await process_images_with_ai(service, [(image_content, filename)])
+
+async def process_images_with_ai(service: str, images_content: List[Tuple[bytes, str]]) -> Dict[str, Any]:
+    """
+    Procesa una o más imágenes de la MISMA pregunta en una sola petición multimodal.
+    Las imágenes se envían en orden (p. ej. enunciado en la primera, opciones en la segunda).
+    """
+    images = [content for content, _ in images_content]
+    if not images:
+        raise ValueError("Se requiere al menos una imagen")
+
+    # Import diferido: ai_router importa este módulo
+    from ai_router import route_images
+
+    # El servicio elegido es el preferido; el router hace failover/hedging con los demás
+    key = make_cache_key(images, service, AI_MODELS.get(service, ""), "extraccion", PROMPT_VERSION_EXTRACCION)
+    return await cached_ai_call(key, lambda: route_images(service, images))
+
+async def dispatch_prepared(service: str, images: List[ImagenPreparada]) -> Dict[str, Any]:
+    """Llamada a un único proveedor; ante un fallo devuelve la respuesta simulada o el error"""
     if service == "openai":
-        return await process_with_openai(image_content)
+        return await process_with_openai(images)
     elif service == "gemini":
-        return await process_with_gemini(image_content)
+        return await process_with_gemini(images)
     elif service == "claude":
-        return await process_with_claude(image_content)
+        return await process_with_claude(images)
     elif service == "azure":
-        return await process_with_azure(image_content)
+        return await process_with_azure(images)
     else:
         raise ValueError(f"Servicio no soportado: {service}")
 
-async def process_with_openai(image_content: bytes) -> Dict[str, Any]:
-    """Procesa imagen con OpenAI GPT-4 Vision"""
+async def process_with_openai(images: List[ImagenPreparada]) -> Dict[str, Any]:
+    """Procesa imagen(es) con OpenAI GPT-4 Vision"""
     
     api_key = AI_API_KEYS["openai"]
     if not api_key:
-        return get_mock_response()  # Usar respuesta simulada si no hay API key
+        return get_mock_response("openai")  # Usar respuesta simulada si no hay API key
     
     try:
-        # Convertir imagen a base64
-        base64_image = base64.b64encode(image_content).decode('utf-8')
-        
+        url, headers, payload = build_extraction_request("openai", images)
+
+        client = get_http_client()
+        response = await post_with_retry(client, retry_key("openai"), url, headers=headers, json=payload)
+            
+        if response.status_code == 200:
+            result = response.json()
+            content = result["choices"][0]["message"]["content"]
+            return parse_ai_response(content, "openai")
+        else:
+            logger.error(f"❌ Error OpenAI HTTP {response.status_code}: {response.text[:300]}")
+            return get_mock_response("openai")
+                
+    except Exception as e:
+        logger.error(f"❌ Error procesando con OpenAI: {e}")
+        return get_mock_response("openai")
+
+async def process_with_gemini(images: List[ImagenPreparada]) -> Dict[str, Any]:
+    """Procesa imagen(es) con Google Gemini Pro Vision"""
+
+    api_key = AI_API_KEYS["gemini"]
+    if not api_key:
+        logger.warning("⚠️ No hay API key de Gemini, usando respuesta simulada")
+        return get_mock_response("gemini")
+
+    try:
+        url, headers, payload = build_extraction_request("gemini", images)
+
+        client = get_http_client()
+        response = await post_with_retry(client, retry_key("gemini"), url, headers=headers, json=payload)
+
+        if response.status_code == 200:
+            result = response.json()
+            # Respuesta completa solo para una muestra de llamadas (LOG_PAYLOAD_SAMPLE_RATE)
+            volcar_payload("gemini_extraccion", result)
+
+            # Verificar si hay error en la respuesta
+            if "error" in result:
+                logger.error(f"❌ Error en respuesta de Gemini: {result['error']}")
+                return get_mock_response("gemini")
+
+            # Verificar estructura de la respuesta
+            if "candidates" not in result or not result["candidates"]:
+                ruta = volcar_payload("gemini_sin_candidates", result, forzar=True)
+                logger.error(f"❌ No hay candidates en la respuesta de Gemini (volcado: {ruta})")
+                return get_mock_response("gemini")
+
+            candidate = result["candidates"][0]
+
+            # Verificar si el contenido fue bloqueado
+            if "content" not in candidate:
+                logger.error(
+                    f"❌ No hay 'content' en candidate",
+                    extra={"campos": {"finish_reason": candidate.get("finishReason")}},
+                )
+                if "finishReason" in candidate:
+                    finish_reason = candidate['finishReason']
+
+                    # Mensaje específico para RECITATION
+                    if finish_reason == "RECITATION":
+                        logger.warning(f"⚠️ Gemini detectó contenido protegido. Intenta con otro servicio de IA (OpenAI/Claude)")
+                        # Retornar un error más específico
+                        return {
+                            "error": "RECITATION",
+                            "message": "Gemini detectó que este contenido podría estar protegido por derechos de autor. Por favor, usa otro servicio de IA (OpenAI o Claude) o modifica la imagen.",
+                            "ai_service": "gemini"
+                        }
+                volcar_payload("gemini_sin_content", candidate, forzar=True)
+                return get_mock_response("gemini")
+
+            content = candidate["content"]["parts"][0]["text"]
+            logger.debug(f"✅ Gemini respondió exitosamente, procesando respuesta...")
+            return parse_ai_response(content, "gemini")
+        else:
+            logger.error(f"❌ Error Gemini HTTP {response.status_code}: {response.text[:300]}")
+            return get_mock_response("gemini")
+
+    except Exception as e:
+        logger.exception(f"❌ Error procesando con Gemini: {e}")
+        return get_mock_response("gemini")
+
+async def process_with_claude(images: List[ImagenPreparada]) -> Dict[str, Any]:
+    """Procesa imagen(es) con Anthropic Claude Vision"""
+    
+    api_key = AI_API_KEYS["claude"]
+    if not api_key:
+        return get_mock_response("claude")
+    
+    try:
+        url, headers, payload = build_extraction_request("claude", images)
+
+        client = get_http_client()
+        response = await post_with_retry(client, retry_key("claude"), url, headers=headers, json=payload)
+            
+        if response.status_code == 200:
+            result = response.json()
+            content = texto_respuesta_claude(result)
+            return parse_ai_response(content, "claude")
+        else:
+            logger.error(f"❌ Error Claude HTTP {response.status_code}: {response.text[:300]}")
+            return get_mock_response("claude")
+                
+    except Exception as e:
+        logger.error(f"❌ Error procesando con Claude: {e}")
+        return get_mock_response("claude")
+
+async def process_with_azure(images: List[ImagenPreparada]) -> Dict[str, Any]:
+    """Procesa imagen(es) con Azure OpenAI"""
+    
+    api_key = AI_API_KEYS["azure"]
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", "")
+    
+    if not api_key or not endpoint:
+        return get_mock_response("azure")
+    
+    # Implementación similar a OpenAI pero con endpoint de Azure
+    return get_mock_response("azure")
+
+def build_extraction_request(service: str, images: List[ImagenPreparada]) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    """
+    Construye (url, headers, payload) de la petición de extracción para el proveedor.
+    Compartido por la ruta normal y la de streaming (ai_streaming.py).
+    """
+    api_key = AI_API_KEYS[service]
+    prompt = get_ai_prompt(len(images), estructurado=usa_esquema(service))
+    encoded = [(image.base64, image.mime_type) for image in images]
+
+    if service == "openai":
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
-        
         payload = {
             "model": AI_MODELS["openai"],
             "messages": [
@@ -77,66 +244,42 @@ async def process_with_openai(image_content: bytes) -> Dict[str, Any]:
                     "content": [
                         {
                             "type": "text",
-                            "text": get_ai_prompt()
+                            "text": prompt
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "high"
+                        *[
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:{mime_type};base64,{base64_image}",
+                                    "detail": "high"
+                                }
                             }
-                        }
+                            for base64_image, mime_type in encoded
+                        ]
                     ]
                 }
             ],
             "max_tokens": 2000
         }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result["choices"][0]["message"]["content"]
-                return parse_ai_response(content, "openai")
-            else:
-                print(f"Error OpenAI: {response.status_code} - {response.text}")
-                return get_mock_response()
-                
-    except Exception as e:
-        print(f"Error procesando con OpenAI: {str(e)}")
-        return get_mock_response()
-
-async def process_with_gemini(image_content: bytes) -> Dict[str, Any]:
-    """Procesa imagen con Google Gemini Pro Vision"""
-
-    api_key = AI_API_KEYS["gemini"]
-    print(f"🔍 Gemini API Key configurada: {'✅ SÍ' if api_key else '❌ NO'}")
-
-    if not api_key:
-        print("⚠️ No hay API key de Gemini, usando respuesta simulada")
-        return get_mock_response()
-
-    try:
-        base64_image = base64.b64encode(image_content).decode('utf-8')
+        aplicar_esquema("openai", payload, "extraccion")
+        return "https://api.openai.com/v1/chat/completions", headers, payload
 
+    if service == "gemini":
         url = f"https://generativelanguage.googleapis.com/v1beta/models/{AI_MODELS['gemini']}:generateContent?key={api_key}"
-        
         payload = {
             "contents": [
                 {
                     "parts": [
-                        {"text": get_ai_prompt()},
-                        {
-                            "inline_data": {
-                                "mime_type": "image/jpeg",
-                                "data": base64_image
+                        {"text": prompt},
+                        *[
+                            {
+                                "inline_data": {
+                                    "mime_type": mime_type,
+                                    "data": base64_image
+                                }
                             }
-                        }
+                            for base64_image, mime_type in encoded
+                        ]
                     ]
                 }
             ],
@@ -145,77 +288,15 @@ async def process_with_gemini(image_content: bytes) -> Dict[str, Any]:
                 "temperature": 0.1
             }
         }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload)
-
-            if response.status_code == 200:
-                result = response.json()
-                print(f"📦 Respuesta completa de Gemini: {json.dumps(result, indent=2)}")
-
-                # Verificar si hay error en la respuesta
-                if "error" in result:
-                    print(f"❌ Error en respuesta de Gemini: {result['error']}")
-                    return get_mock_response()
-
-                # Verificar estructura de la respuesta
-                if "candidates" not in result or not result["candidates"]:
-                    print(f"❌ No hay candidates en la respuesta de Gemini")
-                    print(f"Respuesta recibida: {result}")
-                    return get_mock_response()
-
-                candidate = result["candidates"][0]
-
-                # Verificar si el contenido fue bloqueado
-                if "content" not in candidate:
-                    print(f"❌ No hay 'content' en candidate")
-                    print(f"Candidate completo: {candidate}")
-                    if "finishReason" in candidate:
-                        finish_reason = candidate['finishReason']
-                        print(f"Razón de finalización: {finish_reason}")
-
-                        # Mensaje específico para RECITATION
-                        if finish_reason == "RECITATION":
-                            print(f"⚠️ Gemini detectó contenido protegido. Intenta con otro servicio de IA (OpenAI/Claude)")
-                            # Retornar un error más específico
-                            return {
-                                "error": "RECITATION",
-                                "message": "Gemini detectó que este contenido podría estar protegido por derechos de autor. Por favor, usa otro servicio de IA (OpenAI o Claude) o modifica la imagen.",
-                                "ai_service": "gemini"
-                            }
-                    return get_mock_response()
-
-                content = candidate["content"]["parts"][0]["text"]
-                print(f"✅ Gemini respondió exitosamente, procesando respuesta...")
-                parsed_result = parse_ai_response(content, "gemini")
-                print(f"🎯 Resultado parseado - Servicio: {parsed_result.get('ai_service', 'unknown')}")
-                return parsed_result
-            else:
-                print(f"❌ Error Gemini HTTP: {response.status_code} - {response.text}")
-                return get_mock_response()
-
-    except Exception as e:
-        print(f"❌ Error procesando con Gemini: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return get_mock_response()
+        aplicar_esquema("gemini", payload, "extraccion")
+        return url, {"Content-Type": "application/json"}, payload
 
-async def process_with_claude(image_content: bytes) -> Dict[str, Any]:
-    """Procesa imagen con Anthropic Claude Vision"""
-    
-    api_key = AI_API_KEYS["claude"]
-    if not api_key:
-        return get_mock_response()
-    
-    try:
-        base64_image = base64.b64encode(image_content).decode('utf-8')
-        
+    if service == "claude":
         headers = {
             "Content-Type": "application/json",
             "x-api-key": api_key,
             "anthropic-version": "2023-06-01"
         }
-        
         payload = {
             "model": AI_MODELS["claude"],
             "max_tokens": 2000,
@@ -225,58 +306,46 @@ async def process_with_claude(image_content: bytes) -> Dict[str, Any]:
                     "content": [
                         {
                             "type": "text",
-                            "text": get_ai_prompt()
+                            "text": prompt
                         },
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": base64_image
+                        *[
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": mime_type,
+                                    "data": base64_image
+                                }
                             }
-                        }
+                            for base64_image, mime_type in encoded
+                        ]
                     ]
                 }
             ]
         }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers=headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                content = result["content"][0]["text"]
-                return parse_ai_response(content, "claude")
-            else:
-                print(f"Error Claude: {response.status_code} - {response.text}")
-                return get_mock_response()
-                
-    except Exception as e:
-        print(f"Error procesando con Claude: {str(e)}")
-        return get_mock_response()
+        aplicar_esquema("claude", payload, "extraccion")
+        return "https://api.anthropic.com/v1/messages", headers, payload
 
-async def process_with_azure(image_content: bytes) -> Dict[str, Any]:
-    """Procesa imagen con Azure OpenAI"""
-    
-    api_key = AI_API_KEYS["azure"]
-    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", "")
-    
-    if not api_key or not endpoint:
-        return get_mock_response()
-    
-    # Implementación similar a OpenAI pero con endpoint de Azure
-    return get_mock_response()
+    raise ValueError(f"Servicio no soportado: {service}")
 
-def get_ai_prompt() -> str:
-    """Obtiene el prompt para la IA"""
+def get_ai_prompt(num_imagenes: int = 1, estructurado: bool = False) -> str:
+    """
+    Obtiene el prompt para la IA. Con `estructurado` el formato lo impone el
+    esquema "extraccion" (ai_schemas.py) y el prompt omite el ejemplo de JSON.
+    """
     materias_text = ", ".join(MATERIAS_DISPONIBLES)
+
+    if num_imagenes > 1:
+        intro = (
+            f"Estas {num_imagenes} imágenes, en orden, son partes de UNA SOLA pregunta de examen "
+            "preuniversitario (por ejemplo, el enunciado continúa en la siguiente imagen o las "
+            "opciones están en otra). Combínalas y extrae TODA la información en formato JSON."
+        )
+    else:
+        intro = "Analiza esta imagen de una pregunta de examen preuniversitario y extrae TODA la información en formato JSON."
     
-    return f"""
-Analiza esta imagen de una pregunta de examen preuniversitario y extrae TODA la información en formato JSON.
+    instrucciones = f"""
+{intro}
 
 INSTRUCCIONES IMPORTANTES:
 1. Identifica la materia de la lista: {materias_text}
@@ -305,183 +374,30 @@ INSTRUCCIONES IMPORTANTES:
 8. Si hay tablas o datos numéricos, inclúyelos en la pregunta
 9. Si la imagen está borrosa o incompleta, indica menor confianza (30-50)
 
-RESPONDE ÚNICAMENTE con un JSON válido en este formato exacto:
-{{
+"""
+
+    if estructurado:
+        return instrucciones + "Responde con los campos del esquema indicado.\n"
+
+    return instrucciones + """RESPONDE ÚNICAMENTE con un JSON válido en este formato exacto:
+{
     "materia": "nombre de la materia",
     "tema": "tema descriptivo",
     "pregunta": "texto completo de la pregunta",
-    "opciones": {{
+    "opciones": {
         "A": "texto de opción A",
         "B": "texto de opción B", 
         "C": "texto de opción C",
         "D": "texto de opción D",
         "E": "texto de opción E"
-    }},
+    },
     "dificultad": 3,
     "confianza": 85
-}}
+}
 
 IMPORTANTE: Responde SOLO con el JSON, sin texto adicional antes o después.
 """
 
-def extract_json(text: str, allow_single: bool = False) -> Dict[str, Any]:
-    cleaned = text.strip()
-    # Eliminar bloques de código markdown de forma más robusta
-    cleaned = re.sub(r"^```+(?:json)?\s*", "", cleaned, flags=re.IGNORECASE)
-    cleaned = re.sub(r"```+\s*$", "", cleaned)
-    cleaned = cleaned.strip()
-
-    if not cleaned:
-        raise ValueError("Respuesta vacia de la API.")
-
-    try:
-        return json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        # Intentar recuperar el JSON con limpieza adicional
-        start = cleaned.find("{")
-        end = cleaned.rfind("}")
-        if start == -1 or end == -1 or end <= start:
-            print(f"❌ Error parseando JSON: {e}")
-            print(f"📄 Respuesta completa ({len(cleaned)} chars):")
-            print(cleaned[:1000])
-            if len(cleaned) > 1000:
-                print(f"... (truncado, total: {len(cleaned)} caracteres)")
-            raise
-
-        json_str = cleaned[start : end + 1]
-
-        # Detectar y eliminar razonamiento interno/duplicación de campos
-        # Patrón: texto seguido de \n      "campo": (indicando duplicación)
-        json_str = re.sub(
-            r'\.\s*\(.*?\)\.\s*([A-Z][^"]*?)\n\s+"(explicacion|opciones|respuesta_correcta)":\s*',
-            r'.\n    },\n    {\n      "',
-            json_str
-        )
-
-        # Eliminar comentarios internos tipo "Let's...", "Correcting...", etc.
-        json_str = re.sub(
-            r'\.\s*(Let\'s|Correcting|Ok,|I need to|I wrote|So)[^.]*?\.\s*',
-            '. ',
-            json_str
-        )
-
-        # Limpiar comillas problemáticas
-        json_str = json_str.replace('"', '"').replace('"', '"')
-        json_str = json_str.replace(''', "'").replace(''', "'")
-
-        # Remover caracteres de control inválidos (excepto \n, \r, \t que son válidos)
-        json_str = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', json_str)
-
-        # Estrategia más robusta: procesar el JSON carácter por carácter dentro de strings
-        # para escapar correctamente backslashes y saltos de línea
-        result = []
-        in_string = False
-        escape_next = False
-        i = 0
-
-        while i < len(json_str):
-            char = json_str[i]
-
-            if escape_next:
-                result.append(char)
-                escape_next = False
-                i += 1
-                continue
-
-            if char == '"':
-                in_string = not in_string
-                result.append(char)
-                i += 1
-                continue
-
-            if in_string:
-                if char == '\\':
-                    # Verificar el siguiente carácter
-                    if i + 1 < len(json_str):
-                        next_char = json_str[i + 1]
-                        # Si es una secuencia de escape JSON válida, mantenerla
-                        if next_char in ('"', '\\', '/', 'b', 'f', 'n', 'r', 't', 'u'):
-                            result.append(char)
-                            escape_next = True
-                        else:
-                            # Es un backslash de LaTeX, duplicarlo
-                            result.append('\\\\')
-                    else:
-                        result.append('\\\\')
-                    i += 1
-                elif char == '\n':
-                    result.append('\\n')
-                    i += 1
-                elif char == '\r':
-                    result.append('\\r')
-                    i += 1
-                elif char == '\t':
-                    result.append('\\t')
-                    i += 1
-                else:
-                    result.append(char)
-                    i += 1
-            else:
-                result.append(char)
-                i += 1
-
-        json_str = ''.join(result)
-        # Intentar balancear llaves/corchetes si faltan cierres
-        open_curly = json_str.count('{')
-        close_curly = json_str.count('}')
-        if close_curly < open_curly:
-            json_str += '}' * (open_curly - close_curly)
-        open_square = json_str.count('[')
-        close_square = json_str.count(']')
-        if close_square < open_square:
-            json_str += ']' * (open_square - close_square)
-
-        try:
-            result = json.loads(json_str)
-            # Si el resultado es un objeto individual en lugar de tener "preguntas", intentar arreglarlo
-            if (
-                not allow_single
-                and isinstance(result, dict)
-                and "preguntas" not in result
-                and "pregunta" in result
-            ):
-                # Es un objeto individual, necesitamos verificar si hay más
-                print("⚠️ Detectado: respuesta es objeto individual, intentando corregir...")
-                raise json.JSONDecodeError("Necesita envolver en array", json_str, 0)
-            return result
-        except json.JSONDecodeError as e2:
-            # Último intento: si el JSON son múltiples objetos separados por comas,
-            # intentar envolverlos en un array "preguntas"
-            if '"pregunta"' in json_str and '"preguntas"' not in json_str:
-                print("Intentando envolver objetos en estructura 'preguntas'...")
-                # Verificar si es un solo objeto o múltiples
-                if json_str.strip().startswith('{') and not json_str.strip().startswith('{"preguntas"'):
-                    wrapped = '{"preguntas": [' + json_str + ']}'
-                    try:
-                        return json.loads(wrapped)
-                    except json.JSONDecodeError:
-                        pass
-
-            print(f"Error parseando JSON después de limpieza: {e2}")
-            print(f"Posición del error: línea {e2.lineno}, columna {e2.colno}")
-
-            # Mostrar contexto del error
-            if hasattr(e2, 'pos'):
-                pos = e2.pos
-                context_start = max(0, pos - 100)
-                context_end = min(len(json_str), pos + 100)
-                context = json_str[context_start:context_end]
-                print(f"Contexto del error:")
-                print(f"...{context}...")
-
-            # Guardar JSON problemático para debug
-            debug_file = Path("/tmp/json_error_debug.txt")
-            debug_file.write_text(json_str, encoding="utf-8")
-            print(f"JSON guardado en: {debug_file}")
-            print(f"Longitud del JSON: {len(json_str)} caracteres")
-            raise
-
-
 def parse_ai_response(content: str, service: str) -> Dict[str, Any]:
     """Parsea la respuesta de la IA y extrae el JSON"""
     try:
@@ -498,44 +414,56 @@ def parse_ai_response(content: str, service: str) -> Dict[str, Any]:
         return parsed
 
     except json.JSONDecodeError as e:
-        print(f"❌ Error JSON en {service}: {str(e)}")
-        print(f"📄 Contenido problemático: {content[:500]}...")
-        return get_mock_response()
+        # json_repair ya dejó el contenido original en el almacén de volcados
+        logger.error(f"❌ Error JSON en {service}: {e}")
+        return get_mock_response(service)
     except Exception as e:
-        print(f"❌ Error parseando respuesta de {service}: {str(e)}")
-        return get_mock_response()
+        logger.error(f"❌ Error parseando respuesta de {service}: {e}")
+        return get_mock_response(service)
 
 async def generate_explanation_from_question(service: str, question_image: bytes, pregunta: str, respuesta_correcta: str) -> Dict[str, Any]:
     """Genera explicación directamente desde la imagen de la pregunta"""
 
     api_key = AI_API_KEYS[service]
     if not api_key:
-        return {"explanation": "Explicación generada automáticamente - API no configurada"}
+        return {"explanation": "Explicación generada automáticamente - API no configurada", "ai_service": "mock"}
 
     try:
         if service == "gemini":
-            return await generate_explanation_from_question_gemini(question_image, pregunta, respuesta_correcta)
+            key = make_cache_key(
+                [question_image], service, AI_MODELS[service], "explicacion_pregunta",
+                PROMPT_VERSION_EXPLICACION, extra=f"{pregunta}\n{respuesta_correcta}"
+            )
+            return await cached_ai_call(
+                key, lambda: generate_explanation_from_question_gemini(question_image, pregunta, respuesta_correcta)
+            )
         else:
-            return {"explanation": f"Servicio {service} no implementado para explicaciones"}
+            return {"explanation": f"Servicio {service} no implementado para explicaciones", "error": "NO_IMPLEMENTADO"}
     except Exception as e:
-        print(f"Error generando explicación desde pregunta: {str(e)}")
-        return {"explanation": "Error generando explicación automática"}
+        logger.error(f"❌ Error generando explicación desde pregunta: {e}")
+        return {"explanation": "Error generando explicación automática", "error": str(e)}
 
 async def process_solution_images_with_ai(service: str, solution_images: list, pregunta: str, respuesta_correcta: str) -> Dict[str, Any]:
     """Procesa imágenes de solución para generar explicación"""
 
     api_key = AI_API_KEYS[service]
     if not api_key:
-        return {"explanation": "Explicación generada automáticamente - API no configurada"}
+        return {"explanation": "Explicación generada automáticamente - API no configurada", "ai_service": "mock"}
 
     try:
         if service == "gemini":
-            return await process_solution_with_gemini(solution_images, pregunta, respuesta_correcta)
+            key = make_cache_key(
+                solution_images, service, AI_MODELS[service], "explicacion_solucion",
+                PROMPT_VERSION_EXPLICACION, extra=f"{pregunta}\n{respuesta_correcta}"
+            )
+            return await cached_ai_call(
+                key, lambda: process_solution_with_gemini(solution_images, pregunta, respuesta_correcta)
+            )
         else:
-            return {"explanation": f"Servicio {service} no implementado para explicaciones"}
+            return {"explanation": f"Servicio {service} no implementado para explicaciones", "error": "NO_IMPLEMENTADO"}
     except Exception as e:
-        print(f"Error procesando solución: {str(e)}")
-        return {"explanation": "Error generando explicación automática"}
+        logger.error(f"❌ Error procesando solución: {e}")
+        return {"explanation": "Error generando explicación automática", "error": str(e)}
 
 async def generate_explanation_from_question_gemini(question_image: bytes, pregunta: str, respuesta_correcta: str) -> Dict[str, Any]:
     """Genera explicación desde la imagen de la pregunta con Gemini"""
@@ -545,7 +473,7 @@ async def generate_explanation_from_question_gemini(question_image: bytes, pregu
     try:
         url = f"https://generativelanguage.googleapis.com/v1beta/models/{AI_MODELS['gemini']}:generateContent?key={api_key}"
 
-        base64_image = base64.b64encode(question_image).decode('utf-8')
+        imagen = await asyncio.to_thread(preparar_imagen, question_image)
 
         parts = [
             {"text": f"""
@@ -565,8 +493,8 @@ RESPONDE SOLO con la explicación (sin JSON ni texto extra).
             """},
             {
                 "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
+                    "mime_type": imagen.mime_type,
+                    "data": imagen.base64
                 }
             }
         ]
@@ -579,21 +507,21 @@ RESPONDE SOLO con la explicación (sin JSON ni texto extra).
             }
         }
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload)
+        client = get_http_client()
+        response = await post_with_retry(client, retry_key("gemini"), url, json=payload)
 
-            if response.status_code == 200:
-                result = response.json()
-                explanation = result["candidates"][0]["content"]["parts"][0]["text"]
-                print(f"✅ Explicación desde pregunta generada exitosamente")
-                return {"explanation": explanation.strip()}
-            else:
-                print(f"❌ Error Gemini explicación: {response.status_code}")
-                return {"explanation": "Error generando explicación con IA"}
+        if response.status_code == 200:
+            result = response.json()
+            explanation = result["candidates"][0]["content"]["parts"][0]["text"]
+            logger.info(f"✅ Explicación desde pregunta generada exitosamente")
+            return {"explanation": explanation.strip()}
+        else:
+            logger.error(f"❌ Error Gemini explicación: HTTP {response.status_code}")
+            return {"explanation": "Error generando explicación con IA", "error": f"HTTP {response.status_code}"}
 
     except Exception as e:
-        print(f"Error generando explicación desde pregunta con Gemini: {str(e)}")
-        return {"explanation": "Error procesando imagen de pregunta"}
+        logger.error(f"❌ Error generando explicación desde pregunta con Gemini: {e}")
+        return {"explanation": "Error procesando imagen de pregunta", "error": str(e)}
 
 async def process_solution_with_gemini(solution_images: list, pregunta: str, respuesta_correcta: str) -> Dict[str, Any]:
     """Procesa imágenes de solución con Gemini"""
@@ -622,13 +550,12 @@ RESPONDE SOLO con la explicación (sin JSON ni texto extra).
             """}
         ]
 
-        # Agregar imágenes
-        for i, image_content in enumerate(solution_images):
-            base64_image = base64.b64encode(image_content).decode('utf-8')
+        # Agregar imágenes (preprocesadas)
+        for imagen in await preparar_imagenes(solution_images):
             parts.append({
                 "inline_data": {
-                    "mime_type": "image/jpeg",
-                    "data": base64_image
+                    "mime_type": imagen.mime_type,
+                    "data": imagen.base64
                 }
             })
 
@@ -640,24 +567,25 @@ RESPONDE SOLO con la explicación (sin JSON ni texto extra).
             }
         }
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload)
+        client = get_http_client()
+        response = await post_with_retry(client, retry_key("gemini"), url, json=payload)
 
-            if response.status_code == 200:
-                result = response.json()
-                explanation = result["candidates"][0]["content"]["parts"][0]["text"]
-                print(f"✅ Explicación generada exitosamente")
-                return {"explanation": explanation.strip()}
-            else:
-                print(f"❌ Error Gemini explicación: {response.status_code}")
-                return {"explanation": "Error generando explicación con IA"}
+        if response.status_code == 200:
+            result = response.json()
+            explanation = result["candidates"][0]["content"]["parts"][0]["text"]
+            logger.info(f"✅ Explicación generada exitosamente")
+            return {"explanation": explanation.strip()}
+        else:
+            logger.error(f"❌ Error Gemini explicación: HTTP {response.status_code}")
+            return {"explanation": "Error generando explicación con IA", "error": f"HTTP {response.status_code}"}
 
     except Exception as e:
-        print(f"Error procesando solución con Gemini: {str(e)}")
-        return {"explanation": "Error procesando imágenes de solución"}
+        logger.error(f"❌ Error procesando solución con Gemini: {e}")
+        return {"explanation": "Error procesando imágenes de solución", "error": str(e)}
 
-def get_mock_response() -> Dict[str, Any]:
+def get_mock_response(service: str = "") -> Dict[str, Any]:
     """Respuesta simulada para cuando no hay API key o hay errores"""
+    ai_mock_responses.inc(provider=service or "desconocido")
     return {
         "materia": "Algebra",
         "tema": "ecuaciones_lineales",
@@ -709,7 +637,7 @@ async def process_comprehension_question(
         }
 
     # Preparar prompt para extraer pregunta de comprensión
-    prompt = f"""
+    prompt = """
 Analiza esta imagen que contiene una pregunta de comprensión lectora.
 
 INSTRUCCIONES:
@@ -720,55 +648,50 @@ Extrae de la imagen:
 4. Una explicación breve (máx. 2-3 oraciones, sin análisis largo)
 5. Estima la dificultad (1-3)
 
+IMPORTANTE:
+- Si la respuesta correcta no está marcada, analiza cuál es la correcta
+- Si no hay explicación, genera una breve y clara (máx. 2-3 oraciones)
+- Usa LaTeX para fórmulas matemáticas si es necesario: $$formula$$
+"""
+    if not usa_esquema(service):
+        # Sin salida estructurada el formato se describe en el prompt
+        prompt += """
 FORMATO DE SALIDA - JSON puro sin markdown:
-{{
+{
   "pregunta": "texto de la pregunta",
-  "opciones": {{
+  "opciones": {
     "A": "texto opción A",
     "B": "texto opción B",
     "C": "texto opción C",
     "D": "texto opción D",
     "E": "texto opción E"
-  }},
+  },
   "respuesta_correcta": "B",
   "explicacion": "explicación detallada paso a paso",
   "dificultad": 2
-}}
+}
 
-IMPORTANTE:
-- Devuelve SOLO el JSON, sin ```json ni markdown
-- Si la respuesta correcta no está marcada, analiza cuál es la correcta
-- Si no hay explicación, genera una breve y clara (máx. 2-3 oraciones)
-- Usa LaTeX para fórmulas matemáticas si es necesario: $$formula$$
+Devuelve SOLO el JSON, sin ```json ni markdown.
 """
 
     try:
-        base64_image = base64.b64encode(image_content).decode('utf-8')
+        imagen = await asyncio.to_thread(preparar_imagen, image_content)
+
+        async with get_provider_semaphore(service):
+            if service == "gemini":
+                result_text = await process_comp_with_gemini(imagen.base64, prompt, imagen.mime_type)
+            elif service == "openai":
+                result_text = await process_comp_with_openai(imagen.base64, prompt, imagen.mime_type)
+            elif service == "claude":
+                result_text = await process_comp_with_claude(imagen.base64, prompt, imagen.mime_type)
+            else:
+                raise ValueError(f"Servicio no soportado: {service}")
 
-        if service == "gemini":
-            result_text = await process_comp_with_gemini(base64_image, prompt)
-        elif service == "openai":
-            result_text = await process_comp_with_openai(base64_image, prompt)
-        elif service == "claude":
-            result_text = await process_comp_with_claude(base64_image, prompt)
-        else:
-            raise ValueError(f"Servicio no soportado: {service}")
-
-        # Log crudo para depuración (comprensión)
-        try:
-            suffix = f"_{idx}" if idx is not None else ""
-            debug_path = Path(f"/tmp/comp_gemini_raw{suffix}.txt")
-            debug_path.write_text(result_text, encoding="utf-8")
-            print(f"🧾 Comprensión raw guardado en: {debug_path}")
-        except Exception as log_err:
-            print(f"⚠️ No se pudo guardar log raw de comprensión: {log_err}")
-
-        # Limpiar respuesta y parsear JSON (usar extractor robusto)
-        result_text = result_text.strip()
-        result_text = re.sub(r'^```json\s*', '', result_text)
-        result_text = re.sub(r'^```\s*', '', result_text)
-        result_text = re.sub(r'\s*```$', '', result_text)
+        # Respuesta cruda para depuración, solo para una muestra de llamadas
+        suffix = f"_{idx}" if idx is not None else ""
+        volcar_payload(f"comprension_{service}{suffix}", result_text)
 
+        # Parsear JSON (el parser tolerante quita los bloques ``` y repara la salida)
         parsed = extract_json(result_text, allow_single=True)
         if isinstance(parsed, dict):
             explicacion = parsed.get("explicacion")
@@ -777,11 +700,11 @@ IMPORTANTE:
         return parsed
 
     except Exception as e:
-        print(f"Error procesando pregunta de comprensión: {e}")
+        logger.error(f"❌ Error procesando pregunta de comprensión: {e}")
         raise
 
 
-async def process_comp_with_gemini(base64_image: str, prompt: str) -> str:
+async def process_comp_with_gemini(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Procesa pregunta de comprensión con Gemini"""
     api_key = AI_API_KEYS["gemini"]
     url = f"https://generativelanguage.googleapis.com/v1beta/models/{AI_MODELS['gemini']}:generateContent?key={api_key}"
@@ -792,7 +715,7 @@ async def process_comp_with_gemini(base64_image: str, prompt: str) -> str:
                 {"text": prompt},
                 {
                     "inline_data": {
-                        "mime_type": "image/jpeg",
+                        "mime_type": mime_type,
                         "data": base64_image
                     }
                 }
@@ -803,18 +726,19 @@ async def process_comp_with_gemini(base64_image: str, prompt: str) -> str:
             "temperature": 0.4
         }
     }
+    aplicar_esquema("gemini", payload, "comprension")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=payload)
+    client = get_http_client()
+    response = await post_with_retry(client, retry_key("gemini"), url, json=payload)
 
-        if response.status_code == 200:
-            result = response.json()
-            return result["candidates"][0]["content"]["parts"][0]["text"]
-        else:
-            raise Exception(f"Error Gemini: {response.status_code} - {response.text}")
+    if response.status_code == 200:
+        result = response.json()
+        return result["candidates"][0]["content"]["parts"][0]["text"]
+    else:
+        raise Exception(f"Error Gemini: {response.status_code} - {response.text}")
 
 
-async def process_comp_with_openai(base64_image: str, prompt: str) -> str:
+async def process_comp_with_openai(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Procesa pregunta de comprensión con OpenAI"""
     api_key = AI_API_KEYS["openai"]
 
@@ -833,7 +757,7 @@ async def process_comp_with_openai(base64_image: str, prompt: str) -> str:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
+                            "url": f"data:{mime_type};base64,{base64_image}",
                             "detail": "high"
                         }
                     }
@@ -842,22 +766,24 @@ async def process_comp_with_openai(base64_image: str, prompt: str) -> str:
         ],
         "max_tokens": 1500
     }
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            raise Exception(f"Error OpenAI: {response.status_code}")
+    aplicar_esquema("openai", payload, "comprension")
+
+    client = get_http_client()
+    response = await post_with_retry(
+        client, retry_key("openai"),
+        "https://api.openai.com/v1/chat/completions",
+        headers=headers,
+        json=payload
+    )
+
+    if response.status_code == 200:
+        result = response.json()
+        return result["choices"][0]["message"]["content"]
+    else:
+        raise Exception(f"Error OpenAI: {response.status_code}")
 
 
-async def process_comp_with_claude(base64_image: str, prompt: str) -> str:
+async def process_comp_with_claude(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Procesa pregunta de comprensión con Claude"""
     api_key = AI_API_KEYS["claude"]
 
@@ -878,7 +804,7 @@ async def process_comp_with_claude(base64_image: str, prompt: str) -> str:
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/jpeg",
+                            "media_type": mime_type,
                             "data": base64_image
                         }
                     },
@@ -890,16 +816,18 @@ async def process_comp_with_claude(base64_image: str, prompt: str) -> str:
             }
         ]
     }
-
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=payload
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            return result["content"][0]["text"]
-        else:
-            raise Exception(f"Error Claude: {response.status_code}")
+    aplicar_esquema("claude", payload, "comprension")
+
+    client = get_http_client()
+    response = await post_with_retry(
+        client, retry_key("claude"),
+        "https://api.anthropic.com/v1/messages",
+        headers=headers,
+        json=payload
+    )
+
+    if response.status_code == 200:
+        result = response.json()
+        return texto_respuesta_claude(result)
+    else:
+        raise Exception(f"Error Claude: {response.status_code}")
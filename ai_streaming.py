@@ -0,0 +1,283 @@
+"""
+Extracción de preguntas con respuesta en streaming.
+
+En lugar de esperar la respuesta completa del proveedor (5-20 s con imágenes),
+se pide en modo streaming y el texto se va pasando por ParserIncremental
+(json_repair.py): cada campo que termina de llegar ("materia", "pregunta",
+"opciones.A", ...) se emite de inmediato para que el formulario se rellene
+mientras el modelo sigue escribiendo.
+
+Eventos que produce stream_extraction():
+- {"tipo": "campo", "ruta": "opciones.A", "valor": "..."}: vista previa de un campo
+- {"tipo": "resultado", "data": {...}}: resultado definitivo (mismo formato que
+  process_images_with_ai), parseado sobre el texto completo y guardado en caché
+
+Proveedores con streaming: OpenAI (stream=true), Gemini (streamGenerateContent
+con alt=sse) y Claude (stream=true). Azure, los servicios sin API key y
+cualquier fallo del stream usan la ruta normal a través del router de
+proveedores (ai_router.py: reintentos, circuit breaker y failover a otro
+proveedor); su resultado reemplaza lo que se hubiera mostrado. Tras un
+RECITATION de Gemini el router continúa solo con los demás proveedores.
+
+Una extracción en streaming ocupa el mismo lugar en SingleFlight (ai_cache.py)
+que la ruta normal: una petición idéntica que llegue mientras tanto espera su
+resultado en lugar de abrir otro stream.
+"""
+
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from ai_cache import AI_CACHE_ENABLED, ai_cache, es_resultado_cacheable, make_cache_key, single_flight
+from ai_services import (
+    AI_API_KEYS,
+    AI_MODELS,
+    PROMPT_VERSION_EXTRACCION,
+    build_extraction_request,
+    get_provider_semaphore,
+    parse_ai_response,
+    process_images_with_ai,
+    retry_key,
+)
+from ai_router import SinProveedorError, registrar_intento, route_images
+from http_client import get_http_client
+from image_preprocessing import preparar_imagenes
+from json_repair import ParserIncremental
+from retry_policy import DEFINITIVO, RESPUESTA_INVALIDA, classify_error, get_breaker, retry_metrics
+from metrics import ai_request_duration, registrar_tokens, separar_clave, tokens_de_respuesta
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+SERVICIOS_STREAMING = ("openai", "gemini", "claude")
+
+MENSAJE_RECITATION = (
+    "Gemini detectó que este contenido podría estar protegido por derechos de autor. "
+    "Por favor, usa otro servicio de IA (OpenAI o Claude) o modifica la imagen."
+)
+
+
+class _RecitationError(Exception):
+    """Gemini cortó la respuesta por RECITATION"""
+
+
+class _StatusStreamError(RuntimeError):
+    """Respuesta HTTP no 200 al abrir el stream (status_code para classify_error)"""
+
+    def __init__(self, status_code: int, cuerpo: bytes):
+        super().__init__(f"HTTP {status_code}: {cuerpo!r}")
+        self.status_code = status_code
+
+
+def _request_streaming(service: str, images) -> Tuple[str, Dict[str, str], Dict[str, Any]]:
+    """Misma petición que la ruta normal, en su variante de streaming"""
+    url, headers, payload = build_extraction_request(service, images)
+    if service == "gemini":
+        url = url.replace(":generateContent?", ":streamGenerateContent?alt=sse&", 1)
+    else:
+        payload["stream"] = True
+    if service == "openai":
+        # El uso de tokens solo llega en el último evento si se pide
+        payload["stream_options"] = {"include_usage": True}
+    return url, headers, payload
+
+
+def _uso_de_evento(evento: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+    """Tokens (entrada, salida) reportados en un evento del stream, si los hay"""
+    if evento.get("type") == "message_start":  # Claude: entrada al inicio, salida en message_delta
+        return tokens_de_respuesta(evento.get("message"))
+    return tokens_de_respuesta(evento)
+
+
+async def _eventos_sse(response) -> AsyncIterator[str]:
+    """Devuelve el campo `data` de cada evento Server-Sent Events"""
+    data: List[str] = []
+    async for linea in response.aiter_lines():
+        if not linea:
+            if data:
+                yield "\n".join(data)
+                data = []
+            continue
+        if linea.startswith("data:"):
+            valor = linea[5:]
+            data.append(valor[1:] if valor.startswith(" ") else valor)
+    if data:
+        yield "\n".join(data)
+
+
+def _fragmento(service: str, evento: Dict[str, Any]) -> str:
+    """Texto incremental de un evento del proveedor"""
+    if service == "openai":
+        choices = evento.get("choices") or []
+        if not choices:
+            return ""
+        return (choices[0].get("delta") or {}).get("content") or ""
+
+    if service == "gemini":
+        if "error" in evento:
+            raise RuntimeError(f"Error en stream de Gemini: {evento['error']}")
+        candidates = evento.get("candidates") or []
+        if not candidates:
+            return ""
+        candidate = candidates[0]
+        if candidate.get("finishReason") == "RECITATION":
+            raise _RecitationError()
+        parts = (candidate.get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    # claude
+    tipo = evento.get("type")
+    if tipo == "error":
+        raise RuntimeError(f"Error en stream de Claude: {evento.get('error')}")
+    if tipo == "content_block_delta":
+        delta = evento.get("delta") or {}
+        # Con salida estructurada el JSON llega como argumentos de la herramienta
+        if delta.get("type") == "input_json_delta":
+            return delta.get("partial_json") or ""
+        return delta.get("text") or ""
+    return ""
+
+
+async def stream_extraction(service: str, images_content: List[Tuple[bytes, str]]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Extrae la pregunta de una o más imágenes emitiendo los campos a medida que
+    el proveedor los genera. El último evento siempre es {"tipo": "resultado"}.
+    """
+    images = [content for content, _ in images_content]
+    if not images:
+        raise ValueError("Se requiere al menos una imagen")
+
+    key_retry = retry_key(service) if service in AI_MODELS else service
+    if (
+        service not in SERVICIOS_STREAMING
+        or not AI_API_KEYS.get(service)
+        or get_breaker(key_retry).estado == "abierto"
+    ):
+        yield {"tipo": "resultado", "data": await process_images_with_ai(service, images_content)}
+        return
+
+    cache_key = make_cache_key(images, service, AI_MODELS[service], "extraccion", PROMPT_VERSION_EXTRACCION)
+    if AI_CACHE_ENABLED:
+        cached = await ai_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"💾 Resultado de IA servido desde caché")
+            yield {"tipo": "resultado", "data": cached}
+            return
+
+    # Misma imagen ya en proceso (doble clic, otro revisor): esperar ese resultado
+    if single_flight.en_curso(cache_key) is not None:
+        yield {"tipo": "resultado", "data": await single_flight.esperar(cache_key)}
+        return
+
+    fut = single_flight.reservar(cache_key)
+    result: Optional[Dict[str, Any]] = None
+    try:
+        async for evento in _stream_lider(service, images, cache_key):
+            if evento["tipo"] == "resultado":
+                result = evento["data"]
+            else:
+                yield evento
+        single_flight.completar(fut, result)
+    except Exception as e:
+        single_flight.completar(fut, exc=e)
+        raise
+    finally:
+        if not fut.done():
+            # Cliente desconectado antes del final: las peticiones en espera fallan
+            single_flight.completar(fut, exc=RuntimeError("La petición original se canceló"))
+    yield {"tipo": "resultado", "data": result}
+
+
+async def _guardar_en_cache(cache_key: str, result: Dict[str, Any]) -> None:
+    if AI_CACHE_ENABLED and es_resultado_cacheable(result):
+        try:
+            await ai_cache.set(cache_key, result)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo guardar en caché: {e}")
+
+
+async def _stream_lider(service: str, images: List[bytes], cache_key: str) -> AsyncIterator[Dict[str, Any]]:
+    """Llamada en streaming al proveedor; el último evento es el resultado"""
+    prepared = await preparar_imagenes(images)
+    url, headers, payload = _request_streaming(service, prepared)
+    parser = ParserIncremental()
+    partes: List[str] = []
+    fallo: Optional[str] = None
+    clase_fallo: Optional[str] = None
+    entrada: Optional[int] = None
+    salida: Optional[int] = None
+    key = retry_key(service)
+    inicio = time.perf_counter()
+    resultado_http = "error_red"
+
+    try:
+        async with get_provider_semaphore(service):
+            client = get_http_client()
+            async with client.stream("POST", url, headers=headers, json=payload) as response:
+                resultado_http = str(response.status_code)
+                if response.status_code != 200:
+                    cuerpo = (await response.aread())[:300]
+                    raise _StatusStreamError(response.status_code, cuerpo)
+                async for data in _eventos_sse(response):
+                    if data == "[DONE]":
+                        break
+                    try:
+                        evento = json.loads(data)
+                    except json.JSONDecodeError:
+                        continue
+                    uso = _uso_de_evento(evento)
+                    entrada = uso[0] or entrada
+                    salida = uso[1] or salida
+                    texto = _fragmento(service, evento)
+                    if not texto:
+                        continue
+                    partes.append(texto)
+                    for ruta, valor in parser.feed(texto):
+                        yield {"tipo": "campo", "ruta": ruta, "valor": valor}
+    except _RecitationError:
+        logger.warning(f"⚠️ Gemini detectó contenido protegido, se intenta con otro proveedor")
+        fallo = "RECITATION"
+        clase_fallo = DEFINITIVO
+    except Exception as e:
+        fallo = str(e)
+        clase_fallo = classify_error(e)
+    finally:
+        duracion = time.perf_counter() - inicio
+        _, modelo = separar_clave(key)
+        ai_request_duration.observe(duracion, provider=service, model=modelo, outcome=resultado_http)
+        registrar_tokens(key, entrada, salida)
+
+    result: Optional[Dict[str, Any]] = None
+    if fallo is None and partes:
+        for ruta, valor in parser.close():
+            yield {"tipo": "campo", "ruta": ruta, "valor": valor}
+        result = parse_ai_response("".join(partes), service)
+        if result.get("ai_service") == "mock":
+            fallo = "JSON inválido"
+            clase_fallo = RESPUESTA_INVALIDA
+    registrar_intento(service, duracion, fallo is None and result is not None)
+
+    # Mismo circuito por modelo que las llamadas con async_call_with_retry: un
+    # proveedor caído deja de recibir streams en cuanto se abre
+    breaker = get_breaker(key)
+    if clase_fallo is not None:
+        retry_metrics.error(key, clase_fallo)
+        if breaker.record_failure(clase_fallo):
+            retry_metrics.incr(key, "circuito_abierto")
+            logger.warning(f"🔌 Circuito abierto para {key} durante {breaker.reset_timeout:.0f}s")
+    elif result is not None:
+        breaker.record_success()
+
+    if result is None or fallo is not None:
+        # El router tiene reintentos, circuit breaker y failover; su resultado reemplaza la vista previa
+        logger.warning(f"⚠️ Stream de {service} falló ({fallo or 'respuesta vacía'}), usando la ruta sin streaming")
+        excluir = (service,) if fallo == "RECITATION" else ()
+        try:
+            result = await route_images(service, images, excluir=excluir)
+        except SinProveedorError:
+            if fallo != "RECITATION":
+                raise
+            result = {"error": "RECITATION", "message": MENSAJE_RECITATION, "ai_service": "gemini"}
+
+    await _guardar_en_cache(cache_key, result)
+    yield {"tipo": "resultado", "data": result}
@@ -7,18 +7,23 @@ Este módulo permite generar variaciones de preguntas existentes de tres formas:
 - Hacer más compleja: Añade complejidad sin cambiar datos de la imagen
 """
 
-import base64
-import json
+import asyncio
 import os
-import re
 from typing import Dict, Any
-from pathlib import Path
-import httpx
+from http_client import get_http_client
+from ai_cache import cached_ai_call, make_cache_key
+from retry_policy import post_with_retry
+from json_repair import extract_json
+from ai_schemas import aplicar_esquema, texto_respuesta_claude, usa_esquema
+from image_preprocessing import preparar_imagen
+from app_logging import get_logger, volcar_payload
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
+logger = get_logger(__name__)
+
 # Configuración de APIs
 AI_API_KEYS = {
     "openai": os.getenv("OPENAI_API_KEY", ""),
@@ -34,12 +39,41 @@ AI_MODELS = {
     "azure": os.getenv("AZURE_OPENAI_MODEL", "gpt-4o")
 }
 
+def retry_key(service: str) -> str:
+    """Clave de reintentos/circuit breaker: un circuito por modelo"""
+    return f"{service}:{AI_MODELS[service]}"
+
+# Versión de los prompts de variación: incrementarla al modificarlos invalida la caché
+PROMPT_VERSION_VARIACION = "v2"
+
+
+# Formato de salida en texto: solo se envía cuando el proveedor no recibe el
+# esquema "variacion" (ai_schemas.py)
+_FORMATO_VARIACION = """
+FORMATO DE SALIDA - JSON puro sin markdown:
+{{
+  "pregunta_original": "pregunta extraída de la imagen",
+  "pregunta_variada": "{variada}",
+  "descripcion_cambios": "{cambios}",
+  "numeros_mantenidos": ["lista de números/valores que se mantuvieron iguales"]
+}}
+"""
 
-def get_variation_prompt(tipo_variacion: str) -> str:
-    """Genera el prompt según el tipo de variación solicitada"""
+_REGLAS_FORMATO_JSON = """- Devuelve SOLO el JSON, sin ```json ni markdown
+- NO uses comillas dobles escapadas (\") dentro del texto, usa comillas simples (')
+- Asegúrate de completar TODOS los campos del JSON
+"""
+
+
+def get_variation_prompt(tipo_variacion: str, estructurado: bool = False) -> str:
+    """
+    Genera el prompt según el tipo de variación solicitada. Con `estructurado`
+    el formato lo impone el esquema y se omiten el ejemplo y las reglas de JSON.
+    """
 
     prompts = {
-        "contexto": """
+        "contexto": {
+            "cuerpo": """
 Analiza esta imagen de una pregunta de examen y genera una VARIACIÓN de la pregunta.
 
 REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
@@ -50,24 +84,16 @@ REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
    - El objeto o situación (mantén los números idénticos)
 3. La pregunta variada debe ser compatible con la MISMA imagen
 4. Usa LaTeX para ecuaciones matemáticas: $$formula$$
-
-FORMATO DE SALIDA - JSON puro sin markdown:
-{
-  "pregunta_original": "pregunta extraída de la imagen",
-  "pregunta_variada": "nueva versión con mismo números pero diferente contexto",
-  "descripcion_cambios": "breve descripción de qué cambiaste",
-  "numeros_mantenidos": ["lista de números/valores que se mantuvieron iguales"]
-}
-
-IMPORTANTE:
-- Devuelve SOLO el JSON, sin ```json ni markdown
-- Los números DEBEN ser idénticos a los de la imagen
+""",
+            "variada": "nueva versión con mismo números pero diferente contexto",
+            "cambios": "breve descripción de qué cambiaste",
+            "importante": """- Los números DEBEN ser idénticos a los de la imagen
 - Solo cambia el contexto/redacción, NO los datos numéricos
-- NO uses comillas dobles escapadas (\") dentro del texto, usa comillas simples (')
-- Asegúrate de completar TODOS los campos del JSON
 """,
+        },
 
-        "paso_adicional": """
+        "paso_adicional": {
+            "cuerpo": """
 Analiza esta imagen de una pregunta de examen y genera una VARIACIÓN más compleja.
 
 REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
@@ -76,24 +102,16 @@ REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
 3. La pregunta base debe ser la misma, pero con un inciso adicional
 4. La imagen sigue siendo válida para la pregunta variada
 5. Usa LaTeX para ecuaciones matemáticas: $$formula$$
-
-FORMATO DE SALIDA - JSON puro sin markdown:
-{
-  "pregunta_original": "pregunta extraída de la imagen",
-  "pregunta_variada": "misma pregunta base + paso adicional",
-  "descripcion_cambios": "qué paso adicional se añadió",
-  "numeros_mantenidos": ["lista de números/valores que se mantuvieron iguales"]
-}
-
-IMPORTANTE:
-- Devuelve SOLO el JSON, sin ```json ni markdown
-- Los números DEBEN ser idénticos a los de la imagen
+""",
+            "variada": "misma pregunta base + paso adicional",
+            "cambios": "qué paso adicional se añadió",
+            "importante": """- Los números DEBEN ser idénticos a los de la imagen
 - El paso adicional debe requerir usar el resultado del problema original
-- NO uses comillas dobles escapadas (\") dentro del texto, usa comillas simples (')
-- Asegúrate de completar TODOS los campos del JSON
 """,
+        },
 
-        "mas_compleja": """
+        "mas_compleja": {
+            "cuerpo": """
 Analiza esta imagen de una pregunta de examen y genera una VARIACIÓN más desafiante.
 
 REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
@@ -104,162 +122,20 @@ REGLAS CRÍTICAS - DEBES SEGUIR ESTRICTAMENTE:
    - Relaciones adicionales entre variables
 3. La imagen debe seguir siendo válida para el diagrama/figura mostrada
 4. Usa LaTeX para ecuaciones matemáticas: $$formula$$
-
-FORMATO DE SALIDA - JSON puro sin markdown:
-{
-  "pregunta_original": "pregunta extraída de la imagen",
-  "pregunta_variada": "versión más compleja manteniendo números originales",
-  "descripcion_cambios": "qué elementos de complejidad se añadieron",
-  "numeros_mantenidos": ["lista de números/valores que se mantuvieron iguales"]
-}
-
-IMPORTANTE:
-- Devuelve SOLO el JSON, sin ```json ni markdown
-- Los números de la imagen DEBEN mantenerse iguales
+""",
+            "variada": "versión más compleja manteniendo números originales",
+            "cambios": "qué elementos de complejidad se añadieron",
+            "importante": """- Los números de la imagen DEBEN mantenerse iguales
 - La complejidad adicional debe ser razonable y resolver el mismo diagrama
-- NO uses comillas dobles escapadas (\") dentro del texto, usa comillas simples (')
-- Asegúrate de completar TODOS los campos del JSON
-"""
+""",
+        },
     }
 
-    return prompts.get(tipo_variacion, prompts["contexto"])
-
-
-def extract_json(text: str, allow_single: bool = True) -> Dict[str, Any]:
-    """Extrae y parsea JSON de la respuesta de la IA con manejo robusto de errores"""
-    cleaned = text.strip()
-
-    # Eliminar bloques de código markdown de forma más robusta
-    cleaned = re.sub(r"^```+(?:json)?\s*", "", cleaned, flags=re.IGNORECASE)
-    cleaned = re.sub(r"```+\s*$", "", cleaned)
-    cleaned = cleaned.strip()
-
-    if not cleaned:
-        raise ValueError("Respuesta vacía de la API.")
-
-    try:
-        return json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        # Intentar recuperar el JSON con limpieza adicional
-        start = cleaned.find("{")
-        end = cleaned.rfind("}")
-        if start == -1 or end == -1 or end <= start:
-            print(f"❌ Error parseando JSON: {e}")
-            print(f"📄 Respuesta completa ({len(cleaned)} chars):")
-            print(cleaned[:1000])
-            if len(cleaned) > 1000:
-                print(f"... (truncado, total: {len(cleaned)} caracteres)")
-            raise
-
-        json_str = cleaned[start : end + 1]
-
-        # Limpiar comillas problemáticas
-        json_str = json_str.replace('"', '"').replace('"', '"')
-        json_str = json_str.replace(''', "'").replace(''', "'")
-
-        # Remover caracteres de control inválidos (excepto \n, \r, \t que son válidos)
-        json_str = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', json_str)
-
-        # Arreglar comillas escapadas incorrectamente dentro de strings JSON
-        # La IA a veces devuelve: "text: \"x\"" cuando debería ser "text: \\\"x\\\""
-        # Primero, encontrar todos los strings y arreglar las comillas escapadas dentro
-        def fix_escaped_quotes(match):
-            content = match.group(1)
-            # Reemplazar \" por ' para evitar problemas de parsing
-            # (las comillas simples no causan problemas en JSON strings)
-            content = content.replace('\\"', "'")
-            return f'"{content}"'
-
-        # Aplicar la corrección a todos los valores de string en el JSON
-        json_str = re.sub(r'"([^"]*(?:\\"[^"]*)*)"', fix_escaped_quotes, json_str)
-
-        # Estrategia más robusta: procesar el JSON carácter por carácter dentro de strings
-        # para escapar correctamente backslashes y saltos de línea
-        result = []
-        in_string = False
-        escape_next = False
-        i = 0
-
-        while i < len(json_str):
-            char = json_str[i]
-
-            if escape_next:
-                result.append(char)
-                escape_next = False
-                i += 1
-                continue
-
-            if char == '"':
-                in_string = not in_string
-                result.append(char)
-                i += 1
-                continue
-
-            if in_string:
-                if char == '\\':
-                    # Verificar el siguiente carácter
-                    if i + 1 < len(json_str):
-                        next_char = json_str[i + 1]
-                        # Si es una secuencia de escape JSON válida, mantenerla
-                        if next_char in ('"', '\\', '/', 'b', 'f', 'n', 'r', 't', 'u'):
-                            result.append(char)
-                            escape_next = True
-                        else:
-                            # Es un backslash de LaTeX, duplicarlo
-                            result.append('\\\\')
-                    else:
-                        result.append('\\\\')
-                    i += 1
-                elif char == '\n':
-                    result.append('\\n')
-                    i += 1
-                elif char == '\r':
-                    result.append('\\r')
-                    i += 1
-                elif char == '\t':
-                    result.append('\\t')
-                    i += 1
-                else:
-                    result.append(char)
-                    i += 1
-            else:
-                result.append(char)
-                i += 1
-
-        json_str = ''.join(result)
-
-        # Intentar balancear llaves/corchetes si faltan cierres
-        open_curly = json_str.count('{')
-        close_curly = json_str.count('}')
-        if close_curly < open_curly:
-            json_str += '}' * (open_curly - close_curly)
-        open_square = json_str.count('[')
-        close_square = json_str.count(']')
-        if close_square < open_square:
-            json_str += ']' * (open_square - close_square)
-
-        try:
-            result = json.loads(json_str)
-            return result
-        except json.JSONDecodeError as e2:
-            print(f"Error parseando JSON después de limpieza: {e2}")
-            print(f"Posición del error: línea {e2.lineno}, columna {e2.colno}")
-
-            # Mostrar contexto del error
-            if hasattr(e2, 'pos'):
-                pos = e2.pos
-                context_start = max(0, pos - 100)
-                context_end = min(len(json_str), pos + 100)
-                context = json_str[context_start:context_end]
-                print(f"Contexto del error:")
-                print(f"...{context}...")
-
-            # Guardar JSON problemático para debug
-            debug_file = Path("/tmp/json_error_debug_variation.txt")
-            debug_file.write_text(json_str, encoding="utf-8")
-            print(f"JSON guardado en: {debug_file}")
-            print(f"Longitud del JSON: {len(json_str)} caracteres")
-            raise
+    partes = prompts.get(tipo_variacion, prompts["contexto"])
+    if estructurado:
+        return partes["cuerpo"] + "\nIMPORTANTE:\n" + partes["importante"]
+    formato = _FORMATO_VARIACION.format(variada=partes["variada"], cambios=partes["cambios"])
+    return partes["cuerpo"] + formato + "\nIMPORTANTE:\n" + partes["importante"] + _REGLAS_FORMATO_JSON
 
 
 async def generate_question_variation(service: str, image_content: bytes, tipo_variacion: str) -> Dict[str, Any]:
@@ -284,27 +160,28 @@ async def generate_question_variation(service: str, image_content: bytes, tipo_v
             "ai_service": "mock"
         }
 
+    key = make_cache_key([image_content], service, AI_MODELS.get(service, ""), f"variacion_{tipo_variacion}", PROMPT_VERSION_VARIACION)
+    return await cached_ai_call(key, lambda: _generate_question_variation(service, image_content, tipo_variacion))
+
+
+async def _generate_question_variation(service: str, image_content: bytes, tipo_variacion: str) -> Dict[str, Any]:
     try:
-        prompt = get_variation_prompt(tipo_variacion)
-        base64_image = base64.b64encode(image_content).decode('utf-8')
+        prompt = get_variation_prompt(tipo_variacion, estructurado=usa_esquema(service))
+        imagen = await asyncio.to_thread(preparar_imagen, image_content)
+        base64_image, mime_type = imagen.base64, imagen.mime_type
 
         if service == "gemini":
-            result_text = await generate_variation_gemini(base64_image, prompt)
+            result_text = await generate_variation_gemini(base64_image, prompt, mime_type)
         elif service == "openai":
-            result_text = await generate_variation_openai(base64_image, prompt)
+            result_text = await generate_variation_openai(base64_image, prompt, mime_type)
         elif service == "claude":
-            result_text = await generate_variation_claude(base64_image, prompt)
+            result_text = await generate_variation_claude(base64_image, prompt, mime_type)
         elif service == "azure":
-            result_text = await generate_variation_azure(base64_image, prompt)
+            result_text = await generate_variation_azure(base64_image, prompt, mime_type)
         else:
             raise ValueError(f"Servicio no soportado: {service}")
 
-        # Limpiar y parsear respuesta
-        result_text = result_text.strip()
-        result_text = re.sub(r'^```json\s*', '', result_text)
-        result_text = re.sub(r'^```\s*', '', result_text)
-        result_text = re.sub(r'\s*```$', '', result_text)
-
+        # Parsear respuesta (el parser tolerante quita los bloques ``` y repara la salida)
         parsed = extract_json(result_text)
         parsed["ai_service"] = service
         parsed["tipo_variacion"] = tipo_variacion
@@ -312,11 +189,11 @@ async def generate_question_variation(service: str, image_content: bytes, tipo_v
         return parsed
 
     except Exception as e:
-        print(f"Error generando variación con {service}: {str(e)}")
+        logger.error(f"❌ Error generando variación con {service}: {e}")
         raise
 
 
-async def generate_variation_gemini(base64_image: str, prompt: str) -> str:
+async def generate_variation_gemini(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Genera variación de pregunta con Gemini"""
     api_key = AI_API_KEYS["gemini"]
     url = f"https://generativelanguage.googleapis.com/v1beta/models/{AI_MODELS['gemini']}:generateContent?key={api_key}"
@@ -327,7 +204,7 @@ async def generate_variation_gemini(base64_image: str, prompt: str) -> str:
                 {"text": prompt},
                 {
                     "inline_data": {
-                        "mime_type": "image/jpeg",
+                        "mime_type": mime_type,
                         "data": base64_image
                     }
                 }
@@ -338,42 +215,43 @@ async def generate_variation_gemini(base64_image: str, prompt: str) -> str:
             "temperature": 0.3
         }
     }
+    aplicar_esquema("gemini", payload, "variacion")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(url, json=payload)
+    client = get_http_client()
+    response = await post_with_retry(client, retry_key("gemini"), url, json=payload)
 
-        if response.status_code == 200:
-            result = response.json()
+    if response.status_code == 200:
+        result = response.json()
 
-            # Manejar errores de Gemini
-            if "error" in result:
-                raise Exception(f"Error Gemini: {result['error']}")
+        # Manejar errores de Gemini
+        if "error" in result:
+            raise Exception(f"Error Gemini: {result['error']}")
 
-            if "candidates" not in result or not result["candidates"]:
-                raise Exception("No se recibió respuesta válida de Gemini")
+        if "candidates" not in result or not result["candidates"]:
+            raise Exception("No se recibió respuesta válida de Gemini")
 
-            candidate = result["candidates"][0]
+        candidate = result["candidates"][0]
 
-            if "content" not in candidate:
-                finish_reason = candidate.get("finishReason", "UNKNOWN")
-                if finish_reason == "RECITATION":
-                    raise Exception("Gemini detectó contenido protegido. Usa otro servicio de IA.")
-                raise Exception(f"Gemini no devolvió contenido. Razón: {finish_reason}")
+        if "content" not in candidate:
+            finish_reason = candidate.get("finishReason", "UNKNOWN")
+            if finish_reason == "RECITATION":
+                raise Exception("Gemini detectó contenido protegido. Usa otro servicio de IA.")
+            raise Exception(f"Gemini no devolvió contenido. Razón: {finish_reason}")
 
-            # Log para debug
-            finish_reason = candidate.get("finishReason", "NONE")
-            text_response = candidate["content"]["parts"][0]["text"]
-            print(f"🤖 Gemini finishReason: {finish_reason}")
-            print(f"📝 Respuesta longitud: {len(text_response)} caracteres")
-            if finish_reason != "STOP":
-                print(f"⚠️ ADVERTENCIA: Respuesta posiblemente incompleta. FinishReason: {finish_reason}")
+        finish_reason = candidate.get("finishReason", "NONE")
+        text_response = candidate["content"]["parts"][0]["text"]
+        campos = {"finish_reason": finish_reason, "caracteres": len(text_response)}
+        logger.debug(f"🤖 Variación de Gemini recibida", extra={"campos": campos})
+        if finish_reason != "STOP":
+            ruta = volcar_payload("gemini_variacion_incompleta", text_response, forzar=True)
+            logger.warning(f"⚠️ Respuesta posiblemente incompleta (volcado: {ruta})", extra={"campos": campos})
 
-            return text_response
-        else:
-            raise Exception(f"Error HTTP Gemini: {response.status_code} - {response.text}")
+        return text_response
+    else:
+        raise Exception(f"Error HTTP Gemini: {response.status_code} - {response.text}")
 
 
-async def generate_variation_openai(base64_image: str, prompt: str) -> str:
+async def generate_variation_openai(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Genera variación de pregunta con OpenAI"""
     api_key = AI_API_KEYS["openai"]
 
@@ -392,7 +270,7 @@ async def generate_variation_openai(base64_image: str, prompt: str) -> str:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
+                            "url": f"data:{mime_type};base64,{base64_image}",
                             "detail": "high"
                         }
                     }
@@ -401,22 +279,24 @@ async def generate_variation_openai(base64_image: str, prompt: str) -> str:
         ],
         "max_tokens": 2000
     }
+    aplicar_esquema("openai", payload, "variacion")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
+    client = get_http_client()
+    response = await post_with_retry(
+        client, retry_key("openai"),
+        "https://api.openai.com/v1/chat/completions",
+        headers=headers,
+        json=payload
+    )
 
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            raise Exception(f"Error OpenAI: {response.status_code} - {response.text}")
+    if response.status_code == 200:
+        result = response.json()
+        return result["choices"][0]["message"]["content"]
+    else:
+        raise Exception(f"Error OpenAI: {response.status_code} - {response.text}")
 
 
-async def generate_variation_claude(base64_image: str, prompt: str) -> str:
+async def generate_variation_claude(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Genera variación de pregunta con Claude"""
     api_key = AI_API_KEYS["claude"]
 
@@ -437,7 +317,7 @@ async def generate_variation_claude(base64_image: str, prompt: str) -> str:
                         "type": "image",
                         "source": {
                             "type": "base64",
-                            "media_type": "image/jpeg",
+                            "media_type": mime_type,
                             "data": base64_image
                         }
                     },
@@ -449,22 +329,24 @@ async def generate_variation_claude(base64_image: str, prompt: str) -> str:
             }
         ]
     }
+    aplicar_esquema("claude", payload, "variacion")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=payload
-        )
+    client = get_http_client()
+    response = await post_with_retry(
+        client, retry_key("claude"),
+        "https://api.anthropic.com/v1/messages",
+        headers=headers,
+        json=payload
+    )
 
-        if response.status_code == 200:
-            result = response.json()
-            return result["content"][0]["text"]
-        else:
-            raise Exception(f"Error Claude: {response.status_code} - {response.text}")
+    if response.status_code == 200:
+        result = response.json()
+        return texto_respuesta_claude(result)
+    else:
+        raise Exception(f"Error Claude: {response.status_code} - {response.text}")
 
 
-async def generate_variation_azure(base64_image: str, prompt: str) -> str:
+async def generate_variation_azure(base64_image: str, prompt: str, mime_type: str = "image/jpeg") -> str:
     """Genera variación de pregunta con Azure OpenAI"""
     api_key = AI_API_KEYS["azure"]
     endpoint = os.getenv("AZURE_OPENAI_ENDPOINT", "")
@@ -486,7 +368,7 @@ async def generate_variation_azure(base64_image: str, prompt: str) -> str:
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": f"data:{mime_type};base64,{base64_image}"
                         }
                     }
                 ]
@@ -495,15 +377,16 @@ async def generate_variation_azure(base64_image: str, prompt: str) -> str:
         "max_tokens": 2000
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        response = await client.post(
-            f"{endpoint}/openai/deployments/{AI_MODELS['azure']}/chat/completions?api-version=2024-02-15-preview",
-            headers=headers,
-            json=payload
-        )
-
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            raise Exception(f"Error Azure: {response.status_code} - {response.text}")
\ No newline at end of file
+    client = get_http_client()
+    response = await post_with_retry(
+        client, retry_key("azure"),
+        f"{endpoint}/openai/deployments/{AI_MODELS['azure']}/chat/completions?api-version=2024-02-15-preview",
+        headers=headers,
+        json=payload
+    )
+
+    if response.status_code == 200:
+        result = response.json()
+        return result["choices"][0]["message"]["content"]
+    else:
+        raise Exception(f"Error Azure: {response.status_code} - {response.text}")
\ No newline at end of file
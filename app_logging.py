@@ -0,0 +1,224 @@
+"""
+Logging estructurado, no bloqueante y con correlación por petición.
+
+- get_logger(__name__) devuelve un logger del árbol "banco". Los registros van
+  a una cola (QueueHandler) y un hilo aparte (QueueListener) los formatea y
+  escribe: una llamada a logger.info nunca espera a la consola o al disco.
+- Cada registro lleva el request_id de la petición HTTP en curso (contextvar
+  que fija el middleware de main.py a partir de X-Request-ID o uno nuevo) y
+  los campos de `extra={"campos": {...}}`.
+- Los volcados de payloads crudos (respuestas completas de la IA) se guardan
+  solo para una muestra de las llamadas, como archivos con nombre único en un
+  almacén acotado (se borran los más antiguos), nunca en /tmp con nombres fijos.
+
+Variables de entorno:
+- LOG_LEVEL: nivel mínimo (default INFO)
+- LOG_FORMAT: "json" (una línea JSON por registro) o "texto" (default texto)
+- LOG_PAYLOAD_SAMPLE_RATE: fracción de llamadas cuyo payload crudo se guarda (default 0.01)
+- DEBUG_ARTIFACTS_DIR: directorio de los volcados (default .cache/debug_artifacts)
+- DEBUG_ARTIFACTS_MAX_FILES: volcados que se conservan (default 200)
+"""
+
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "texto").lower()
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+DEBUG_ARTIFACTS_DIR = Path(os.getenv("DEBUG_ARTIFACTS_DIR", ".cache/debug_artifacts"))
+DEBUG_ARTIFACTS_MAX_FILES = int(os.getenv("DEBUG_ARTIFACTS_MAX_FILES", "200"))
+
+RAIZ = "banco"
+
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_handler: Optional[logging.Handler] = None
+_config_lock = threading.Lock()
+
+
+class _ContextoFilter(logging.Filter):
+    """Añade request_id y campos estructurados a cada registro"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        if not hasattr(record, "campos"):
+            record.campos = {}
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Como QueueHandler, pero deja la traza en exc_text en vez de pegarla al mensaje"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class _FormatoJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        datos = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "nivel": record.levelname,
+            "logger": record.name,
+            "request_id": record.request_id,
+            "mensaje": record.getMessage(),
+            **record.campos,
+        }
+        if record.exc_text:
+            datos["exc"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class _FormatoTexto(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s [%(request_id)s] %(message)s", "%H:%M:%S")
+
+    def format(self, record: logging.LogRecord) -> str:
+        texto = super().format(record)
+        if record.campos:
+            texto += " " + " ".join(f"{k}={v}" for k, v in record.campos.items())
+        return texto
+
+
+def configurar_logging() -> None:
+    """Instala el QueueHandler del árbol "banco" (idempotente)"""
+    global _listener, _handler
+    with _config_lock:
+        if _listener is not None:
+            return
+        cola: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+        salida = logging.StreamHandler()
+        salida.setFormatter(_FormatoJSON() if LOG_FORMAT == "json" else _FormatoTexto())
+
+        _handler = _QueueHandler(cola)
+        # El filtro corre en el hilo que registra: ahí está el contextvar de la petición
+        _handler.addFilter(_ContextoFilter())
+
+        raiz = logging.getLogger(RAIZ)
+        raiz.setLevel(LOG_LEVEL)
+        raiz.addHandler(_handler)
+        raiz.propagate = False
+
+        _listener = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+        _listener.start()
+
+
+def detener_logging() -> None:
+    """Vacía la cola de registros y los volcados pendientes (al apagar la app)"""
+    global _listener, _handler
+    with _config_lock:
+        if _listener is not None:
+            logging.getLogger(RAIZ).removeHandler(_handler)
+            _listener.stop()
+            _listener = _handler = None
+    _artefactos.cerrar()
+
+
+def get_logger(nombre: str) -> logging.Logger:
+    configurar_logging()
+    return logging.getLogger(f"{RAIZ}.{nombre}")
+
+
+def nuevo_request_id(valor: Optional[str] = None) -> str:
+    """Fija el request_id del contexto actual (el recibido o uno nuevo) y lo devuelve"""
+    request_id = valor if valor and _ID_VALIDO.match(valor) else uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    return request_id
+
+
+_ID_VALIDO = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+_NOMBRE_SEGURO = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+class _AlmacenArtefactos:
+    """
+    Volcados de depuración con nombre único (fecha, request_id, tipo, sufijo
+    aleatorio) escritos por un hilo propio. Se conservan los últimos
+    DEBUG_ARTIFACTS_MAX_FILES; al superar el límite se borran los más antiguos.
+    """
+
+    def __init__(self, directorio: Path, max_archivos: int):
+        self.directorio = directorio
+        self.max_archivos = max_archivos
+        self._archivos: Optional[Deque[Path]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artefactos")
+            return self._executor
+
+    def _escribir(self, ruta: Path, contenido: str) -> None:
+        try:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            if self._archivos is None:
+                existentes = sorted(self.directorio.glob("*"), key=lambda p: p.stat().st_mtime)
+                self._archivos = deque(existentes)
+            ruta.write_text(contenido, encoding="utf-8")
+            self._archivos.append(ruta)
+            while len(self._archivos) > self.max_archivos:
+                self._archivos.popleft().unlink(missing_ok=True)
+        except OSError as e:
+            get_logger(__name__).warning(f"⚠️ No se pudo guardar el volcado {ruta.name}: {e}")
+
+    def guardar(self, tipo: str, contenido: str, extension: str = "txt") -> Path:
+        nombre = "_".join([
+            time.strftime("%Y%m%d-%H%M%S"),
+            request_id_var.get(),
+            _NOMBRE_SEGURO.sub("-", tipo),
+            uuid.uuid4().hex[:8],
+        ]) + f".{extension}"
+        ruta = self.directorio / nombre
+        self._pool().submit(self._escribir, ruta, contenido)
+        return ruta
+
+    def cerrar(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_artefactos = _AlmacenArtefactos(DEBUG_ARTIFACTS_DIR, DEBUG_ARTIFACTS_MAX_FILES)
+
+
+def debe_muestrear(tasa: Optional[float] = None) -> bool:
+    tasa = LOG_PAYLOAD_SAMPLE_RATE if tasa is None else tasa
+    return tasa > 0 and random.random() < tasa
+
+
+def volcar_payload(tipo: str, contenido: Any, forzar: bool = False, extension: str = "txt") -> Optional[Path]:
+    """
+    Guarda un payload crudo en el almacén de artefactos para una muestra de las
+    llamadas (o siempre con `forzar`, p. ej. cuando el parseo falló). Devuelve
+    la ruta del volcado o None si no se guardó. La escritura no bloquea.
+    """
+    if not forzar and not debe_muestrear():
+        return None
+    if not isinstance(contenido, str):
+        contenido = json.dumps(contenido, ensure_ascii=False, indent=2, default=str)
+        extension = "json"
+    return _artefactos.guardar(tipo, contenido, extension)
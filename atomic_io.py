@@ -0,0 +1,146 @@
+"""
+Escrituras atómicas y bloqueos por archivo.
+
+- escribir_atomico: escribe en un temporal del mismo directorio y lo renombra
+  (os.replace), así un lector nunca ve un JSON a medio escribir.
+- bloqueo_archivo / bloqueo_archivo_async: exclusión mutua por ruta, dentro del
+  proceso (threading.Lock / asyncio.Lock) y entre procesos con fcntl.flock sobre
+  un archivo `.lock` al lado del recurso (uvicorn con varios workers).
+
+En plataformas sin fcntl (Windows) solo se aplica el bloqueo dentro del proceso.
+"""
+
+import asyncio
+import os
+import stat
+import tempfile
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, Union
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+RutaArchivo = Union[str, Path]
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+_async_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _leer_umask() -> int:
+    # os.umask solo se puede leer cambiándola: se hace una vez, al importar el módulo
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+_MODO_NUEVO = 0o666 & ~_leer_umask()
+
+
+def _clave(path: RutaArchivo) -> str:
+    return os.path.abspath(str(path))
+
+
+def _ruta_lock(path: RutaArchivo) -> Path:
+    path = Path(path)
+    return path.with_name(f".{path.name}.lock")
+
+
+def _thread_lock(clave: str) -> threading.Lock:
+    with _thread_locks_guard:
+        lock = _thread_locks.get(clave)
+        if lock is None:
+            lock = _thread_locks[clave] = threading.Lock()
+        return lock
+
+
+def _abrir_flock(path: RutaArchivo) -> int:
+    """Abre el archivo .lock y toma el flock exclusivo (bloqueante)"""
+    lock_path = _ruta_lock(path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(str(lock_path), os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+    return fd
+
+
+def _cerrar_flock(fd: int) -> None:
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _soltar_si_tomado(toma: "asyncio.Future[int]") -> None:
+    if not toma.cancelled() and toma.exception() is None:
+        _cerrar_flock(toma.result())
+
+
+@contextmanager
+def bloqueo_archivo(path: RutaArchivo) -> Iterator[None]:
+    """Bloqueo exclusivo de una ruta para código síncrono (hilos y procesos)"""
+    with _thread_lock(_clave(path)):
+        fd = _abrir_flock(path)
+        try:
+            yield
+        finally:
+            _cerrar_flock(fd)
+
+
+@asynccontextmanager
+async def bloqueo_archivo_async(path: RutaArchivo) -> AsyncIterator[None]:
+    """Bloqueo exclusivo de una ruta para corrutinas; el flock se toma en un hilo"""
+    clave = _clave(path)
+    lock = _async_locks.get(clave)
+    if lock is None:
+        lock = _async_locks[clave] = asyncio.Lock()
+    async with lock:
+        toma = asyncio.ensure_future(asyncio.to_thread(_abrir_flock, path))
+        try:
+            fd = await asyncio.shield(toma)
+        except asyncio.CancelledError:
+            # El hilo sigue y acaba tomando el flock: soltarlo cuando termine
+            toma.add_done_callback(_soltar_si_tomado)
+            raise
+        try:
+            yield
+        finally:
+            _cerrar_flock(fd)
+
+
+def escribir_atomico(path: RutaArchivo, contenido: Union[str, bytes], encoding: str = "utf-8") -> None:
+    """
+    Escribe en un archivo temporal y lo renombra sobre el destino. mkstemp crea
+    el temporal con permisos 0600: antes del rename se le dan los del destino
+    (o los de un archivo nuevo según la umask), como haría un write_text normal.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = contenido.encode(encoding) if isinstance(contenido, str) else contenido
+    try:
+        modo = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        modo = _MODO_NUEVO
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, modo)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
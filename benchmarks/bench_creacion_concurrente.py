@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Prueba de estrés: cientos de creaciones simultáneas de preguntas sobre el
+mismo materia/tema, repartidas en varios procesos (como uvicorn con varios
+workers) y varios hilos por proceso.
+
+Al final verifica que el JSON del tema tenga TODAS las preguntas, con
+id_temporal únicos, y que cada imagen tenga un nombre distinto.
+
+Uso:
+    python benchmarks/bench_creacion_concurrente.py --procesos 4 --hilos 16 --por-hilo 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MATERIA = "algebra"
+TEMA = "estres_concurrente"
+
+
+def _crear(i: int) -> str:
+    from utils import guardar_imagen, guardar_pregunta_json, reservar_id_temporal
+
+    materia_dir = Path("banco_preguntas") / MATERIA
+    imagenes_dir = materia_dir / "imagenes"
+    archivo_json = materia_dir / f"{TEMA}.json"
+    imagenes_dir.mkdir(parents=True, exist_ok=True)
+
+    nombre_imagen = guardar_imagen(imagenes_dir, f"{MATERIA}_{TEMA}", "png", io.BytesIO(b"img-%d" % i))
+    id_temporal = reservar_id_temporal(archivo_json, MATERIA, TEMA)
+    guardar_pregunta_json(archivo_json, MATERIA, TEMA, {
+        "id_temporal": id_temporal,
+        "tipo_clasificacion": "normal",
+        "pregunta": f"Pregunta de estrés {i}",
+        "dificultad": 1,
+        "opciones": {"A": "1", "B": "2", "C": "3", "D": "4", "E": "5"},
+        "respuesta_correcta": "A",
+        "explicacion": "-",
+        "imagenes": [nombre_imagen],
+    })
+    return id_temporal
+
+
+def _worker_proceso(workdir: str, inicio: int, hilos: int, por_hilo: int) -> List[str]:
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    total = hilos * por_hilo
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        ids = list(pool.map(_crear, range(inicio, inicio + total)))
+    # Los procesos del pool salen sin atexit: se vuelca aquí la exportación
+    # programada del JSON del tema antes de que main() lo lea
+    from question_store import question_store
+    question_store.exportar_pendientes()
+    return ids
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Estrés de creación concurrente de preguntas.")
+    parser.add_argument("--procesos", type=int, default=4)
+    parser.add_argument("--hilos", type=int, default=16)
+    parser.add_argument("--por-hilo", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench_creacion_")
+    os.environ["QUESTION_STORE_PATH"] = str(Path(workdir) / "banco.sqlite3")
+    por_proceso = args.hilos * args.por_hilo
+    esperado = args.procesos * por_proceso
+
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.procesos) as pool:
+        futuros = [
+            pool.submit(_worker_proceso, workdir, p * por_proceso, args.hilos, args.por_hilo)
+            for p in range(args.procesos)
+        ]
+        ids = [i for f in futuros for i in f.result()]
+    elapsed = time.perf_counter() - t0
+
+    archivo_json = Path(workdir) / "banco_preguntas" / MATERIA / f"{TEMA}.json"
+    data = json.loads(archivo_json.read_text(encoding="utf-8"))
+    preguntas = data["preguntas"]
+    ids_json = [p["id_temporal"] for p in preguntas]
+    imagenes = [img for p in preguntas for img in p["imagenes"]]
+    en_disco = list((archivo_json.parent / "imagenes").glob(f"{MATERIA}_{TEMA}_*.png"))
+
+    print(f"Creaciones: {esperado} en {elapsed:.2f}s ({esperado / elapsed:.1f}/s)")
+    print(f"Preguntas en JSON: {len(preguntas)} | IDs únicos: {len(set(ids_json))} | IDs devueltos únicos: {len(set(ids))}")
+    print(f"Imágenes referenciadas únicas: {len(set(imagenes))} | Imágenes en disco: {len(en_disco)}")
+    print(f"Directorio de trabajo: {workdir}")
+
+    ok = (
+        len(preguntas) == esperado
+        and len(set(ids_json)) == esperado
+        and len(set(ids)) == esperado
+        and len(set(imagenes)) == esperado
+        and len(en_disco) == esperado
+    )
+    print("OK: no se perdió ninguna pregunta" if ok else "FALLO: se perdieron o duplicaron preguntas")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Latencia de llamadas de IA mientras se guardan preguntas en bloque.
+
+Simula N "llamadas de IA" concurrentes (esperas de red con asyncio.sleep) en el
+mismo event loop en el que se hace una carga masiva de guardar_pregunta_json
+sobre un tema grande. Compara dos modos:
+- inline: el guardado se ejecuta directamente en el event loop (comportamiento anterior)
+- pool:   el guardado se ejecuta con run_storage (pool de hilos dedicado)
+
+Reporta llamadas de IA completadas por segundo y el retraso p50/p99 del loop
+(cuánto tarda en despertar una corrutina respecto de lo esperado).
+
+Uso:
+    python benchmarks/bench_event_loop_storage.py --guardados 200 --preexistentes 3000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _pregunta(i: int) -> Dict:
+    return {
+        "id_temporal": f"alg_ben_{i:03d}",
+        "tipo_clasificacion": "normal",
+        "pregunta": f"Pregunta {i}: resuelve $$x^2 + {i}x + 1 = 0$$ " + "texto " * 40,
+        "dificultad": 2,
+        "opciones": {k: f"$$x = {i}$$" for k in "ABCDE"},
+        "respuesta_correcta": "A",
+        "explicacion": "explicación " * 30,
+        "imagenes": None,
+    }
+
+
+async def _llamada_ia(latencia: float, retrasos: List[float]) -> None:
+    """Repite esperas de red simuladas hasta ser cancelada"""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(latencia)
+        retrasos.append(time.perf_counter() - t0 - latencia)
+
+
+async def _escenario(modo: str, archivo: Path, guardados: int, llamadas: int, latencia: float) -> Dict[str, float]:
+    from storage_pool import run_storage
+    from utils import guardar_pregunta_json
+
+    retrasos: List[float] = []
+    duracion_guardado = 0.0
+
+    async def carga_masiva() -> None:
+        nonlocal duracion_guardado
+        t0 = time.perf_counter()
+        for i in range(guardados):
+            pregunta = _pregunta(100000 + i)
+            if modo == "inline":
+                guardar_pregunta_json(archivo, "algebra", "bench", pregunta)
+                await asyncio.sleep(0)
+            else:
+                await run_storage(guardar_pregunta_json, archivo, "algebra", "bench", pregunta)
+        duracion_guardado = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    tarea_guardado = asyncio.create_task(carga_masiva())
+    # Las llamadas de IA corren mientras dura la carga masiva
+    tareas_ia = [asyncio.create_task(_llamada_ia(latencia, retrasos)) for _ in range(llamadas)]
+    await tarea_guardado
+    for t in tareas_ia:
+        t.cancel()
+    elapsed = time.perf_counter() - t0
+    retrasos.sort()
+    return {
+        "ia_por_seg": len(retrasos) / elapsed,
+        "retraso_p50_ms": statistics.median(retrasos) * 1000 if retrasos else 0.0,
+        "retraso_p99_ms": retrasos[int(len(retrasos) * 0.99) - 1] * 1000 if retrasos else 0.0,
+        "guardado_s": duracion_guardado,
+    }
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Throughput de IA durante guardados masivos.")
+    parser.add_argument("--guardados", type=int, default=200, help="Preguntas a guardar en la carga masiva")
+    parser.add_argument("--preexistentes", type=int, default=3000, help="Tamaño inicial del tema")
+    parser.add_argument("--llamadas", type=int, default=50, help="Llamadas de IA concurrentes simuladas")
+    parser.add_argument("--latencia", type=float, default=0.05, help="Latencia simulada de cada llamada (s)")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="bench_loop_")
+    os.environ["QUESTION_STORE_PATH"] = str(Path(workdir) / "banco.sqlite3")
+    os.chdir(workdir)
+    sys.path.insert(0, str(ROOT))
+    from question_store import question_store
+
+    resultados = {}
+    for modo in ("inline", "pool"):
+        archivo = Path("banco_preguntas") / "algebra" / f"bench_{modo}.json"
+        archivo.parent.mkdir(parents=True, exist_ok=True)
+        for i in range(1, args.preexistentes + 1):
+            question_store.agregar_pregunta(archivo, "algebra", "bench", _pregunta(i))
+        resultados[modo] = asyncio.run(_escenario(modo, archivo, args.guardados, args.llamadas, args.latencia))
+
+    print(f"{'modo':<8}{'IA/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'guardado s':>12}")
+    for modo, r in resultados.items():
+        print(f"{modo:<8}{r['ia_por_seg']:>10.1f}{r['retraso_p50_ms']:>10.2f}{r['retraso_p99_ms']:>10.2f}{r['guardado_s']:>12.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Corpus, fuzz y escalado del parser JSON tolerante (json_repair.py).
+
+1. Corpus: cada caso de benchmarks/json_repair_corpus.jsonl debe parsear y
+   contener los campos esperados (comparación por subconjunto).
+2. Fuzz: muta los casos del corpus (truncar, insertar backslashes, comillas,
+   comillas tipográficas, llaves, borrar caracteres) y verifica que el parser
+   solo lance ValueError y que ninguna entrada tarde más de lo razonable.
+3. Escalado: entradas adversarias de tamaño creciente (comillas internas sin
+   escapar, anidamiento profundo, backslashes, espacios). El tiempo por carácter
+   debe mantenerse aproximadamente constante (lineal).
+
+Uso:
+    python benchmarks/bench_json_repair.py
+    python benchmarks/bench_json_repair.py --fuzz 20000 --max-size 400000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Las entradas irreparables del fuzz se registran como error y se vuelcan como
+# artefacto: a un directorio temporal, no a .cache/debug_artifacts del proyecto
+os.environ["DEBUG_ARTIFACTS_DIR"] = tempfile.mkdtemp(prefix="bench_json_repair_")
+
+from json_repair import extract_json  # noqa: E402
+
+logging.getLogger("banco.json_repair").setLevel(logging.CRITICAL)
+
+CORPUS = Path(__file__).resolve().parent / "json_repair_corpus.jsonl"
+
+
+def _contiene(obtenido: Any, esperado: Any) -> bool:
+    """`esperado` es subconjunto de `obtenido` (dicts por clave, listas por posición)"""
+    if isinstance(esperado, dict):
+        return isinstance(obtenido, dict) and all(
+            k in obtenido and _contiene(obtenido[k], v) for k, v in esperado.items()
+        )
+    if isinstance(esperado, list):
+        return (
+            isinstance(obtenido, list)
+            and len(obtenido) >= len(esperado)
+            and all(_contiene(o, e) for o, e in zip(obtenido, esperado))
+        )
+    return obtenido == esperado
+
+
+def cargar_corpus() -> List[Dict[str, Any]]:
+    with CORPUS.open(encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def correr_corpus(casos: List[Dict[str, Any]]) -> int:
+    fallos = 0
+    for caso in casos:
+        try:
+            obtenido = extract_json(caso["entrada"])
+            ok = _contiene(obtenido, caso["esperado"])
+        except ValueError as e:
+            obtenido, ok = f"{type(e).__name__}: {e}", False
+        if not ok:
+            fallos += 1
+            print(f"  ✗ {caso['nombre']}: {obtenido!r:.200}")
+    print(f"Corpus: {len(casos) - fallos}/{len(casos)} casos correctos")
+    return fallos
+
+
+def _mutar(texto: str, rng: random.Random) -> str:
+    for _ in range(rng.randint(1, 4)):
+        if not texto:
+            break
+        i = rng.randrange(len(texto) + 1)
+        op = rng.randrange(6)
+        if op == 0:
+            texto = texto[:i]
+        elif op == 1:
+            texto = texto[:i] + "\\" + rng.choice("bfnrtux(){[\\\"") + texto[i:]
+        elif op == 2:
+            texto = texto[:i] + rng.choice(['"', "“", "”", "'"]) + texto[i:]
+        elif op == 3:
+            texto = texto[:i] + rng.choice("{}[],:") + texto[i:]
+        elif op == 4:
+            texto = texto[:i] + texto[i + rng.randint(1, 20):]
+        else:
+            texto = texto[:i] + rng.choice(["\n", "\t", "\x00", "   ", "```"]) + texto[i:]
+    return texto
+
+
+def correr_fuzz(casos: List[Dict[str, Any]], iteraciones: int, semilla: int) -> int:
+    rng = random.Random(semilla)
+    recuperados = errores_inesperados = 0
+    peor = 0.0
+    for _ in range(iteraciones):
+        entrada = _mutar(rng.choice(casos)["entrada"], rng)
+        t0 = time.perf_counter()
+        try:
+            extract_json(entrada)
+            recuperados += 1
+        except ValueError:
+            pass
+        except Exception as e:  # cualquier otra excepción es un bug del parser
+            errores_inesperados += 1
+            print(f"  ✗ {type(e).__name__}: {e} con entrada {entrada!r:.200}")
+        peor = max(peor, time.perf_counter() - t0)
+    print(
+        f"Fuzz: {iteraciones} mutaciones, {recuperados} recuperadas, "
+        f"{errores_inesperados} excepciones inesperadas, peor caso {peor * 1000:.2f} ms"
+    )
+    return errores_inesperados
+
+
+ADVERSARIOS: Dict[str, Callable[[int], str]] = {
+    # Rompía la regex "([^"]*(?:\\"[^"]*)*)" de la versión anterior
+    "comillas_escapadas": lambda n: '{"a": "' + '\\"x' * (n // 3),
+    "comillas_internas": lambda n: '{"a": "' + 'x "y" ' * (n // 7) + '"}',
+    "anidamiento": lambda n: "[" * (n // 2) + "]" * (n // 2),
+    "anidamiento_truncado": lambda n: '{"a": ' * (n // 6),
+    "backslashes_latex": lambda n: '{"a": "' + "\\frac{1}{2} \\nu " * (n // 16) + '"}',
+    "espacios_y_comillas": lambda n: '{"a": "' + 'x"    ' * (n // 6) + '"}',
+    "comas_duplicadas": lambda n: "[1" + ",," * (n // 2) + "]",
+    "objetos_sueltos": lambda n: '{"p": 1}, ' * (n // 10),
+}
+
+
+def correr_escalado(max_size: int) -> int:
+    tamaños = []
+    size = 10_000
+    while size <= max_size:
+        tamaños.append(size)
+        size *= 2
+    no_lineales = 0
+    print(f"Escalado (µs por KB) para tamaños {tamaños[0]}..{tamaños[-1]}:")
+    for nombre, gen in ADVERSARIOS.items():
+        por_kb = []
+        for size in tamaños:
+            entrada = gen(size)
+            t0 = time.perf_counter()
+            try:
+                extract_json(entrada)
+            except ValueError:
+                pass
+            por_kb.append((time.perf_counter() - t0) / max(len(entrada), 1) * 1024 * 1e6)
+        # Lineal: el costo por KB no crece con el tamaño. Se compara el tamaño mayor
+        # con el intermedio (x4 de entrada): cuadrático daría ~x4, lineal ~x1
+        crecimiento = por_kb[-1] / max(por_kb[len(por_kb) // 2], 1e-9)
+        marca = "✓" if crecimiento < 2 else "✗"
+        if crecimiento >= 2:
+            no_lineales += 1
+        print(f"  {marca} {nombre:<22} " + " ".join(f"{v:8.1f}" for v in por_kb) + f"   x{crecimiento:.1f}")
+    return no_lineales
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Corpus, fuzz y escalado de json_repair")
+    parser.add_argument("--fuzz", type=int, default=5000, help="Número de mutaciones")
+    parser.add_argument("--seed", type=int, default=1234, help="Semilla del fuzz")
+    parser.add_argument("--max-size", type=int, default=160_000, help="Tamaño máximo de entrada adversaria")
+    args = parser.parse_args(argv)
+
+    casos = cargar_corpus()
+    fallos = correr_corpus(casos)
+    fallos += correr_fuzz(casos, args.fuzz, args.seed)
+    fallos += correr_escalado(args.max_size)
+    return 1 if fallos else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
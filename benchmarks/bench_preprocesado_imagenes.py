@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Bytes enviados y latencia con y sin preprocesado de imágenes.
+
+Para cada imagen compara:
+- bytes del cuerpo JSON (base64) enviado al proveedor sin procesar vs procesada
+- tiempo de preprocesado (rotar, recortar, reducir, recodificar)
+- latencia estimada de subida con el ancho de banda indicado (--mbps)
+
+Con --servicio (openai/gemini/claude) y la API key configurada, además mide la
+latencia real de extremo a extremo llamando al proveedor con ambas variantes.
+
+Uso:
+    python benchmarks/bench_preprocesado_imagenes.py banco_preguntas/geometria/imagenes --mbps 10
+    python benchmarks/bench_preprocesado_imagenes.py foto_celular.jpg --servicio gemini
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from image_preprocessing import ImagenPreparada, detectar_mime, preparar_imagen  # noqa: E402
+from utils import EXTENSIONES_IMAGEN  # noqa: E402
+
+
+def _b64_len(n: int) -> int:
+    return 4 * ((n + 2) // 3)
+
+
+def _recolectar(rutas: List[str]) -> List[Path]:
+    archivos: List[Path] = []
+    for ruta in rutas:
+        p = Path(ruta)
+        if p.is_dir():
+            archivos.extend(sorted(f for f in p.rglob("*") if f.suffix.lower() in EXTENSIONES_IMAGEN))
+        elif p.exists():
+            archivos.append(p)
+    return archivos
+
+
+async def _llamada_real(servicio: str, imagen: ImagenPreparada) -> float:
+    import ai_services
+
+    proveedor = getattr(ai_services, f"process_with_{servicio}")
+    t0 = time.perf_counter()
+    await proveedor([imagen])
+    return time.perf_counter() - t0
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Compara bytes y latencia con/sin preprocesado de imágenes.")
+    parser.add_argument("rutas", nargs="*", default=[str(ROOT / "banco_preguntas")], help="Imágenes o directorios")
+    parser.add_argument("--mbps", type=float, default=10.0, help="Ancho de banda de subida simulado (Mbit/s)")
+    parser.add_argument("--servicio", default=None, choices=["openai", "gemini", "claude"], help="Medir latencia real")
+    args = parser.parse_args(argv)
+
+    archivos = _recolectar(args.rutas)
+    if not archivos:
+        print("No se encontraron imágenes", file=sys.stderr)
+        return 2
+
+    bytes_por_seg = args.mbps * 1_000_000 / 8
+    total_raw = total_proc = 0
+    total_t_raw = total_t_proc = 0.0
+
+    print(f"{'imagen':<48}{'raw KB':>10}{'proc KB':>10}{'prep ms':>10}{'subida raw s':>14}{'subida proc s':>15}")
+    for archivo in archivos:
+        data = archivo.read_bytes()
+        t0 = time.perf_counter()
+        imagen = preparar_imagen(data)
+        prep = time.perf_counter() - t0
+
+        raw_b64 = _b64_len(len(data))
+        proc_b64 = _b64_len(len(imagen.data))
+        t_raw = raw_b64 / bytes_por_seg
+        t_proc = prep + proc_b64 / bytes_por_seg
+        total_raw += raw_b64
+        total_proc += proc_b64
+        total_t_raw += t_raw
+        total_t_proc += t_proc
+
+        linea = f"{archivo.name[:47]:<48}{raw_b64 / 1024:>10.1f}{proc_b64 / 1024:>10.1f}{prep * 1000:>10.1f}{t_raw:>14.2f}{t_proc:>15.2f}"
+        if args.servicio:
+            original = ImagenPreparada(data=data, mime_type=detectar_mime(data), bytes_originales=len(data))
+            lat_raw = asyncio.run(_llamada_real(args.servicio, original))
+            lat_proc = prep + asyncio.run(_llamada_real(args.servicio, imagen))
+            linea += f"  real raw={lat_raw:.2f}s proc={lat_proc:.2f}s"
+        print(linea)
+
+    ahorro = 100 * (1 - total_proc / total_raw) if total_raw else 0.0
+    print(f"\nTotal enviado: {total_raw / 1024:.1f} KB -> {total_proc / 1024:.1f} KB ({ahorro:.1f}% menos)")
+    print(f"Subida estimada a {args.mbps} Mbit/s: {total_t_raw:.2f}s -> {total_t_proc:.2f}s (incluye preprocesado)")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,393 @@
+"""
+Importación por lotes de exámenes escaneados (POST /api/importar-lote).
+
+Un examen de 100 preguntas eran 200 peticiones (una extracción y un guardado
+por pregunta). Aquí se sube un ZIP de imágenes o un PDF de varias páginas y:
+
+1. Se divide en páginas: cada imagen del ZIP (en orden natural de nombre:
+   p2 antes que p10) o cada página del PDF. Con PyMuPDF instalado las páginas
+   se renderizan; sin él se extraen las imágenes JPEG incrustadas, que es como
+   guardan las páginas los escáneres (en el orden en que aparecen en el archivo).
+2. Cada página se extrae con la misma función que /api/process-image-ai
+   (caché, router de proveedores, figuras conocidas), con como máximo
+   IMPORT_CONCURRENCY extracciones a la vez; los semáforos por proveedor de
+   ai_services.py siguen aplicando por encima.
+3. Las páginas y sus resultados quedan en un área de revisión
+   (IMPORT_STAGING_DIR/<id>/lote.json + imágenes): nada entra al banco hasta
+   que un revisor guarda cada pregunta con /crear-pregunta.
+
+El lote corre en una tarea propia: si el cliente que sigue el progreso se
+desconecta, el lote continúa y se consulta con GET /api/importar-lote/{id}.
+
+Las páginas se guardan en el área de revisión antes de empezar y cada
+extracción vuelve a leer su imagen de ahí: en memoria solo quedan las
+IMPORT_CONCURRENCY páginas que se están extrayendo.
+
+Variables de entorno:
+- IMPORT_CONCURRENCY: extracciones simultáneas por lote (default 4)
+- IMPORT_MAX_BYTES: tamaño máximo del archivo subido y del total de sus
+  páginas una vez descomprimidas o renderizadas (default 200 MB)
+- IMPORT_MAX_PAGES: páginas máximas por lote (default 200)
+- IMPORT_MAX_PAGE_BYTES: tamaño máximo de cada imagen extraída (default 15 MB)
+- IMPORT_PDF_DPI: resolución al renderizar páginas con PyMuPDF (default 150)
+- IMPORT_STAGING_DIR: directorio del área de revisión (default .cache/importaciones)
+"""
+
+import asyncio
+import io
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from ai_router import SinProveedorError
+from app_logging import get_logger
+from atomic_io import escribir_atomico
+from image_preprocessing import detectar_mime
+from metrics import import_pages
+from storage_pool import run_storage
+from utils import EXTENSIONES_IMAGEN
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # pragma: no cover - PyMuPDF es opcional
+    fitz = None
+
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "4"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(200 * 1024 * 1024)))
+IMPORT_MAX_PAGES = int(os.getenv("IMPORT_MAX_PAGES", "200"))
+IMPORT_MAX_PAGE_BYTES = int(os.getenv("IMPORT_MAX_PAGE_BYTES", str(15 * 1024 * 1024)))
+IMPORT_PDF_DPI = int(os.getenv("IMPORT_PDF_DPI", "150"))
+IMPORT_STAGING_DIR = Path(os.getenv("IMPORT_STAGING_DIR", ".cache/importaciones"))
+
+MANIFIESTO = "lote.json"
+
+_ID_LOTE = re.compile(r"^[0-9a-f]{12}$")
+_EXTENSION_MIME = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif", "image/bmp": "bmp"}
+
+# Lotes que se están procesando en este proceso
+_en_curso: Dict[str, Tuple["Importacion", "asyncio.Task"]] = {}
+
+# Función de extracción: [(bytes, nombre)] -> resultado con el formato de /api/process-image-ai
+Extractor = Callable[[List[Tuple[bytes, str]]], Awaitable[Dict[str, Any]]]
+
+
+class LoteInvalidoError(ValueError):
+    """El archivo subido no es un ZIP/PDF utilizable"""
+
+
+class LoteDemasiadoGrandeError(LoteInvalidoError):
+    """El archivo (o sus páginas ya extraídas) supera IMPORT_MAX_BYTES"""
+
+
+@dataclass
+class Pagina:
+    nombre: str
+    data: bytes
+
+
+# ----- división en páginas -----
+
+async def leer_subida(archivo: Any, bloque: int = 1024 * 1024) -> bytes:
+    """Lee el UploadFile por bloques y corta en cuanto supera IMPORT_MAX_BYTES"""
+    partes: List[bytes] = []
+    total = 0
+    while True:
+        parte = await archivo.read(bloque)
+        if not parte:
+            return b"".join(partes)
+        total += len(parte)
+        if total > IMPORT_MAX_BYTES:
+            raise LoteDemasiadoGrandeError(f"El archivo supera el tamaño máximo ({IMPORT_MAX_BYTES} bytes)")
+        partes.append(parte)
+
+
+def _orden_natural(nombre: str) -> List[Any]:
+    return [int(parte) if parte.isdigit() else parte.lower() for parte in re.split(r"(\d+)", nombre)]
+
+
+def dividir_zip(data: bytes) -> List[Pagina]:
+    """Imágenes del ZIP en orden natural de nombre (se ignoran carpetas y archivos ocultos)"""
+    try:
+        archivo = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise LoteInvalidoError(f"ZIP inválido: {e}")
+
+    entradas = []
+    for info in archivo.infolist():
+        nombre = Path(info.filename)
+        if info.is_dir() or any(p.startswith((".", "__MACOSX")) for p in nombre.parts):
+            continue
+        if nombre.suffix.lower() not in EXTENSIONES_IMAGEN:
+            continue
+        if info.file_size > IMPORT_MAX_PAGE_BYTES:
+            raise LoteInvalidoError(f"{info.filename} supera el tamaño máximo por página")
+        entradas.append(info)
+
+    if len(entradas) > IMPORT_MAX_PAGES:
+        raise LoteInvalidoError(f"El ZIP tiene {len(entradas)} imágenes (máximo {IMPORT_MAX_PAGES})")
+    entradas.sort(key=lambda info: _orden_natural(info.filename))
+    # Se lee con límite: file_size viene del propio ZIP y no es de fiar
+    paginas = []
+    total = 0
+    for info in entradas:
+        with archivo.open(info) as f:
+            contenido = f.read(IMPORT_MAX_PAGE_BYTES + 1)
+        if len(contenido) > IMPORT_MAX_PAGE_BYTES:
+            raise LoteInvalidoError(f"{info.filename} supera el tamaño máximo por página")
+        total += len(contenido)
+        if total > IMPORT_MAX_BYTES:
+            raise LoteDemasiadoGrandeError(f"Las imágenes del ZIP superan en total el tamaño máximo ({IMPORT_MAX_BYTES} bytes)")
+        paginas.append(Pagina(Path(info.filename).name, contenido))
+    return paginas
+
+
+_OBJETO_STREAM = re.compile(rb"\d+\s+\d+\s+obj\s*<<(.*?)>>\s*stream\r?\n", re.DOTALL)
+_LONGITUD_DIRECTA = re.compile(rb"/Length\s+(\d+)(?!\s+\d+\s+R)")
+
+
+def _jpegs_incrustados(data: bytes) -> List[Pagina]:
+    """Imágenes JPEG (DCTDecode) de un PDF, sin renderizar: las páginas de un escáner"""
+    paginas = []
+    for m in _OBJETO_STREAM.finditer(data):
+        dic = m.group(1)
+        if b"endobj" in dic or not re.search(rb"/Subtype\s*/Image", dic) or b"/DCTDecode" not in dic:
+            continue
+        inicio = m.end()
+        longitud = _LONGITUD_DIRECTA.search(dic)
+        if longitud:
+            contenido = data[inicio:inicio + int(longitud.group(1))]
+        else:
+            fin = data.find(b"endstream", inicio)
+            contenido = data[inicio:fin if fin != -1 else len(data)].rstrip(b"\r\n")
+        if not contenido.startswith(b"\xff\xd8"):
+            continue
+        if len(contenido) > IMPORT_MAX_PAGE_BYTES:
+            raise LoteInvalidoError(f"La imagen {len(paginas) + 1} del PDF supera el tamaño máximo por página")
+        paginas.append(Pagina(f"pagina_{len(paginas) + 1:03d}.jpg", contenido))
+        if len(paginas) > IMPORT_MAX_PAGES:
+            raise LoteInvalidoError(f"El PDF tiene más de {IMPORT_MAX_PAGES} imágenes")
+    return paginas
+
+
+def dividir_pdf(data: bytes) -> List[Pagina]:
+    """Una imagen por página (PyMuPDF) o las imágenes JPEG incrustadas (sin PyMuPDF)"""
+    if fitz is None:
+        paginas = _jpegs_incrustados(data)
+        if not paginas:
+            raise LoteInvalidoError(
+                "El PDF no tiene páginas escaneadas como JPEG; instala PyMuPDF para renderizar PDFs de otro tipo"
+            )
+        return paginas
+
+    try:
+        documento = fitz.open(stream=data, filetype="pdf")
+    except Exception as e:
+        raise LoteInvalidoError(f"PDF inválido: {e}")
+    with documento:
+        if documento.page_count > IMPORT_MAX_PAGES:
+            raise LoteInvalidoError(f"El PDF tiene {documento.page_count} páginas (máximo {IMPORT_MAX_PAGES})")
+        paginas = []
+        total = 0
+        for numero, pagina in enumerate(documento, start=1):
+            contenido = pagina.get_pixmap(dpi=IMPORT_PDF_DPI).tobytes("png")
+            total += len(contenido)
+            if total > IMPORT_MAX_BYTES:
+                raise LoteDemasiadoGrandeError(f"Las páginas del PDF superan en total el tamaño máximo ({IMPORT_MAX_BYTES} bytes)")
+            paginas.append(Pagina(f"pagina_{numero:03d}.png", contenido))
+        return paginas
+
+
+def dividir_archivo(data: bytes) -> List[Pagina]:
+    """ZIP o PDF (según su firma) -> páginas; bloqueante, se ejecuta fuera del event loop"""
+    if data[:4] == b"PK\x03\x04":
+        paginas = dividir_zip(data)
+    elif data[:5] == b"%PDF-":
+        paginas = dividir_pdf(data)
+    else:
+        raise LoteInvalidoError("El archivo debe ser un ZIP de imágenes o un PDF")
+    if not paginas:
+        raise LoteInvalidoError("El archivo no contiene imágenes")
+    return paginas
+
+
+# ----- área de revisión -----
+
+def directorio_lote(lote_id: str) -> Path:
+    if not _ID_LOTE.match(lote_id):
+        raise KeyError(lote_id)
+    return IMPORT_STAGING_DIR / lote_id
+
+
+def leer_lote(lote_id: str) -> Dict[str, Any]:
+    """Manifiesto del lote (estado, páginas y resultados); KeyError si no existe"""
+    ruta = directorio_lote(lote_id) / MANIFIESTO
+    try:
+        return json.loads(ruta.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        raise KeyError(lote_id)
+
+
+def ruta_imagen(lote_id: str, indice: int) -> Path:
+    """Imagen de la página `indice` (1-based) del lote; KeyError si no existe"""
+    for item in leer_lote(lote_id)["items"]:
+        if item["indice"] == indice:
+            return directorio_lote(lote_id) / item["imagen"]
+    raise KeyError(indice)
+
+
+def borrar_lote(lote_id: str) -> None:
+    """Descarta un lote ya revisado; KeyError si no existe, RuntimeError si sigue en curso"""
+    directorio = directorio_lote(lote_id)
+    if not directorio.exists():
+        raise KeyError(lote_id)
+    if lote_id in _en_curso:
+        raise RuntimeError("El lote sigue en proceso")
+    shutil.rmtree(directorio)
+
+
+def _preparar_lote(lote_id: str, archivo: str, servicio: str, paginas: List[Pagina]) -> Dict[str, Any]:
+    directorio = directorio_lote(lote_id)
+    directorio.mkdir(parents=True, exist_ok=True)
+    items = []
+    for indice, pagina in enumerate(paginas, start=1):
+        imagen = f"{indice:03d}.{_EXTENSION_MIME.get(detectar_mime(pagina.data), 'jpg')}"
+        (directorio / imagen).write_bytes(pagina.data)
+        items.append({"indice": indice, "origen": pagina.nombre, "imagen": imagen, "estado": "pendiente"})
+    manifiesto = {
+        "id": lote_id,
+        "archivo": archivo,
+        "servicio": servicio,
+        "creado": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "estado": "procesando",
+        "total": len(items),
+        "completadas": 0,
+        "errores": 0,
+        "items": items,
+    }
+    escribir_atomico(directorio / MANIFIESTO, json.dumps(manifiesto, ensure_ascii=False, indent=2))
+    return manifiesto
+
+
+# ----- procesamiento -----
+
+class Importacion:
+    """Un lote en curso: extrae las páginas y publica el progreso en una cola"""
+
+    def __init__(self, manifiesto: Dict[str, Any], extraer: Extractor):
+        self.manifiesto = manifiesto
+        self.extraer = extraer
+        self.eventos: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        self._guardado = asyncio.Lock()
+        self.iniciada = False
+
+    async def _guardar_manifiesto(self) -> None:
+        async with self._guardado:
+            contenido = json.dumps(self.manifiesto, ensure_ascii=False, indent=2)
+            await run_storage(escribir_atomico, directorio_lote(self.manifiesto["id"]) / MANIFIESTO, contenido)
+
+    async def _procesar(self, item: Dict[str, Any], limite: asyncio.Semaphore) -> None:
+        async with limite:
+            inicio = time.perf_counter()
+            try:
+                # La imagen se relee del área de revisión: solo las páginas en curso ocupan memoria
+                imagen = directorio_lote(self.manifiesto["id"]) / item["imagen"]
+                result = await self.extraer([(await run_storage(imagen.read_bytes), item["origen"])])
+                if result.get("error"):
+                    raise RuntimeError(result.get("message") or result["error"])
+                item.update(estado="ok", ai_service=result.get("ai_service"), data=result)
+                import_pages.inc(outcome="figura_conocida" if result.get("ai_service") == "banco" else "ok")
+            except Exception as e:
+                # Una página fallida (sin proveedor, RECITATION, error HTTP) no detiene el lote
+                item.update(estado="error", error=str(e) if isinstance(e, SinProveedorError) else f"{type(e).__name__}: {e}")
+                self.manifiesto["errores"] += 1
+                import_pages.inc(outcome="error")
+            item["duracion_s"] = round(time.perf_counter() - inicio, 2)
+
+        self.manifiesto["completadas"] += 1
+        await self._guardar_manifiesto()
+        await self.eventos.put({
+            "tipo": "progreso",
+            "indice": item["indice"],
+            "estado": item["estado"],
+            "ai_service": item.get("ai_service"),
+            "error": item.get("error"),
+            "completadas": self.manifiesto["completadas"],
+            "total": self.manifiesto["total"],
+        })
+
+    async def ejecutar(self) -> None:
+        self.iniciada = True
+        lote_id = self.manifiesto["id"]
+        inicio = time.perf_counter()
+        limite = asyncio.Semaphore(max(1, IMPORT_CONCURRENCY))
+        try:
+            await asyncio.gather(*[self._procesar(item, limite) for item in self.manifiesto["items"]])
+            self.manifiesto["estado"] = "listo"
+        except asyncio.CancelledError:
+            self.manifiesto["estado"] = "cancelado"
+            raise
+        except Exception as e:
+            logger.exception(f"❌ Error en el lote {lote_id}: {e}")
+            self.manifiesto["estado"] = "error"
+            self.manifiesto["error"] = str(e)
+        finally:
+            await self._guardar_manifiesto()
+            logger.info(
+                f"📦 Lote {lote_id} terminado en {time.perf_counter() - inicio:.1f}s",
+                extra={"campos": {k: self.manifiesto[k] for k in ("total", "completadas", "errores", "estado")}},
+            )
+            await self.eventos.put({"tipo": "fin", **{k: self.manifiesto[k] for k in ("id", "estado", "total", "completadas", "errores")}})
+            await self.eventos.put(None)
+
+
+async def iniciar_importacion(
+    nombre_archivo: str, data: bytes, servicio: str, extraer: Extractor
+) -> Tuple[Dict[str, Any], Importacion]:
+    """
+    Divide el archivo, prepara el área de revisión y lanza el lote en segundo
+    plano. Devuelve (manifiesto inicial, importación) para seguir su progreso.
+    """
+    paginas = await asyncio.to_thread(dividir_archivo, data)
+    lote_id = uuid.uuid4().hex[:12]
+    manifiesto = await run_storage(_preparar_lote, lote_id, nombre_archivo, servicio, paginas)
+    importacion = Importacion(manifiesto, extraer)
+    tarea = asyncio.create_task(importacion.ejecutar())
+    _en_curso[lote_id] = (importacion, tarea)
+    tarea.add_done_callback(lambda _: _en_curso.pop(lote_id, None))
+    logger.info(f"📦 Lote {lote_id}: {manifiesto['total']} página(s) de {nombre_archivo} con {servicio}")
+    return manifiesto, importacion
+
+
+async def progreso(importacion: Importacion) -> AsyncIterator[Dict[str, Any]]:
+    """Eventos de progreso del lote hasta el evento "fin" incluido"""
+    while True:
+        evento = await importacion.eventos.get()
+        if evento is None:
+            return
+        yield evento
+
+
+async def cancelar_importaciones() -> None:
+    """Cancela los lotes en curso al apagar la app (quedan con las páginas ya procesadas)"""
+    lotes = list(_en_curso.values())
+    for _, tarea in lotes:
+        tarea.cancel()
+    await asyncio.gather(*(tarea for _, tarea in lotes), return_exceptions=True)
+    for importacion, _ in lotes:
+        if not importacion.iniciada:
+            # Cancelada antes de empezar: ejecutar() no llegó a guardar el estado
+            importacion.manifiesto["estado"] = "cancelado"
+            await importacion._guardar_manifiesto()
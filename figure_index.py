@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+Índice de figuras por hash perceptual.
+
+La misma figura se guardaba una y otra vez con nombres nuevos
+(geometria_..._001.jpeg, geometria_..._002.jpeg). Cada imagen de
+banco_preguntas/ y banco_procesos/ se resume en:
+- sha256 de sus bytes: copia exacta
+- dHash de 64 bits (gris, orientación EXIF, márgenes recortados como en
+  image_preprocessing.py, reducida a 9x8; un bit por cada par de píxeles
+  vecinos): sobrevive a recompresión, cambio de tamaño y capturas de pantalla
+  de la misma figura. Dos figuras son "la misma" si sus dHash difieren en
+  pocos bits (distancia de Hamming).
+
+Los dHash están en un árbol BK: la búsqueda por distancia de Hamming solo
+recorre las ramas que pueden contener resultados (desigualdad triangular).
+
+Con esto:
+- al guardar una imagen (crear_pregunta) una copia exacta ya presente en la
+  misma carpeta se reutiliza y una de otra carpeta se enlaza (hard link):
+  el banco no almacena dos veces los mismos bytes
+- las preguntas que comparten figura (exacta o casi) quedan vinculadas y se
+  informan en "figuras_compartidas" y en GET /api/figuras/compartidas
+- si se sube a la extracción con IA una copia exacta (sha256) de una figura
+  registrada en una sola pregunta, se devuelve esa pregunta sin llamar al
+  proveedor (ai_service "banco"); si la usan varias, se extrae normalmente.
+  Una figura casi igual puede traer cambios pequeños que cambian la pregunta
+  (un número, una etiqueta): aceptarlas por dHash es opcional
+  (FIGURE_SHORTCUT_MAX_DISTANCE)
+
+Las huellas se guardan en SQLite y al iniciar solo se vuelven a calcular las
+de las imágenes nuevas o modificadas. Sin Pillow solo se detectan copias exactas.
+
+Variables de entorno:
+- FIGURE_INDEX_PATH: archivo SQLite del índice (default .cache/figure_index.sqlite3)
+- FIGURE_HASH_MAX_DISTANCE: bits de diferencia para considerar dos figuras iguales (default 6 de 64)
+- FIGURE_SHORTCUT: "false" para llamar siempre a la IA aunque la figura sea conocida (default true)
+- FIGURE_SHORTCUT_MAX_DISTANCE: si se define, reutiliza también la pregunta de figuras casi iguales
+  a esa distancia de dHash o menos (default vacío: solo copias exactas)
+
+Uso por consola:
+    python figure_index.py sincronizar
+    python figure_index.py compartidas
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+from image_preprocessing import recortar_contenido
+from question_index import leer_archivos_banco
+from question_store import BASES_BANCO, RutaArchivo
+from utils import EXTENSIONES_IMAGEN, guardar_imagen, reservar_numero_imagen
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow es opcional en scripts
+    Image = None
+
+FIGURE_INDEX_PATH = Path(os.getenv("FIGURE_INDEX_PATH", ".cache/figure_index.sqlite3"))
+FIGURE_HASH_MAX_DISTANCE = int(os.getenv("FIGURE_HASH_MAX_DISTANCE", "6"))
+FIGURE_SHORTCUT = os.getenv("FIGURE_SHORTCUT", "true").lower() not in ("0", "false", "no")
+FIGURE_SHORTCUT_MAX_DISTANCE = (
+    int(os.environ["FIGURE_SHORTCUT_MAX_DISTANCE"]) if os.getenv("FIGURE_SHORTCUT_MAX_DISTANCE") else None
+)
+
+
+def calcular_dhash(data: bytes) -> Optional[int]:
+    """dHash de 64 bits de una imagen, o None sin Pillow o si no se puede decodificar"""
+    if Image is None:
+        return None
+    try:
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        if img.mode not in ("RGB", "L"):
+            # Fondo blanco para PNG/WebP con transparencia (como en el preprocesado)
+            fondo = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            fondo.paste(rgba, mask=rgba.split()[-1])
+            img = fondo
+        img = recortar_contenido(img.convert("L"))
+        pixeles = list(img.resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo calcular el hash de la imagen: {e}")
+        return None
+    valor = 0
+    for fila in range(8):
+        for col in range(8):
+            valor = (valor << 1) | (pixeles[fila * 9 + col] > pixeles[fila * 9 + col + 1])
+    return valor
+
+
+def distancia(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class _NodoBK:
+    __slots__ = ("valor", "rutas", "hijos")
+
+    def __init__(self, valor: int, ruta: str):
+        self.valor = valor
+        self.rutas: Set[str] = {ruta}
+        self.hijos: Dict[int, "_NodoBK"] = {}
+
+
+class ArbolBK:
+    """Árbol BK sobre la distancia de Hamming; las imágenes con el mismo hash comparten nodo"""
+
+    def __init__(self):
+        self._raiz: Optional[_NodoBK] = None
+        self.nodos = 0
+
+    def agregar(self, valor: int, ruta: str) -> None:
+        if self._raiz is None:
+            self._raiz = _NodoBK(valor, ruta)
+            self.nodos = 1
+            return
+        nodo = self._raiz
+        while True:
+            d = distancia(valor, nodo.valor)
+            if d == 0:
+                nodo.rutas.add(ruta)
+                return
+            if d not in nodo.hijos:
+                nodo.hijos[d] = _NodoBK(valor, ruta)
+                self.nodos += 1
+                return
+            nodo = nodo.hijos[d]
+
+    def quitar(self, valor: int, ruta: str) -> None:
+        """Quita la ruta; el nodo queda (sin rutas) porque sostiene a sus hijos"""
+        nodo = self._raiz
+        while nodo is not None:
+            d = distancia(valor, nodo.valor)
+            if d == 0:
+                nodo.rutas.discard(ruta)
+                return
+            nodo = nodo.hijos.get(d)
+
+    def buscar(self, valor: int, radio: int) -> List[Tuple[int, str]]:
+        """(distancia, ruta) de las imágenes a `radio` bits o menos, de la más cercana a la más lejana"""
+        if self._raiz is None:
+            return []
+        encontradas: List[Tuple[int, str]] = []
+        pendientes = [self._raiz]
+        while pendientes:
+            nodo = pendientes.pop()
+            d = distancia(valor, nodo.valor)
+            if d <= radio:
+                encontradas.extend((d, ruta) for ruta in nodo.rutas)
+            # Por la desigualdad triangular solo las ramas en [d - radio, d + radio] pueden tener resultados
+            for k, hijo in nodo.hijos.items():
+                if d - radio <= k <= d + radio:
+                    pendientes.append(hijo)
+        encontradas.sort()
+        return encontradas
+
+
+def _rutas_imagenes_de(archivo: str, pregunta: Dict[str, Any]) -> List[str]:
+    """Rutas de las imágenes de una pregunta (se guardan en <materia>/imagenes/)"""
+    nombres = pregunta.get("imagenes") or pregunta.get("imagen") or []
+    if isinstance(nombres, str):
+        nombres = [nombres]
+    carpeta = Path(archivo).parent / "imagenes"
+    return [(carpeta / nombre).as_posix() for nombre in nombres if isinstance(nombre, str) and nombre]
+
+
+class IndiceFiguras:
+    """Huellas de las imágenes (SQLite, una conexión por hilo) y árbol BK en memoria"""
+
+    def __init__(self, path: RutaArchivo = FIGURE_INDEX_PATH):
+        self.path = Path(path)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._arbol = ArbolBK()
+        self._huellas: Dict[str, Tuple[str, Optional[int]]] = {}
+        self._por_sha: Dict[str, Set[str]] = {}
+        self._preguntas: Dict[str, Set[Tuple[str, str]]] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS figuras (
+                    ruta TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    dhash TEXT,
+                    huella TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_figuras_sha256 ON figuras(sha256);
+                """
+            )
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _huella(ruta: Path) -> str:
+        stat = ruta.stat()
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    # ----- memoria (con self._lock tomado) -----
+
+    def _recordar(self, ruta: str, sha: str, valor: Optional[int]) -> None:
+        self._olvidar(ruta)
+        self._huellas[ruta] = (sha, valor)
+        self._por_sha.setdefault(sha, set()).add(ruta)
+        if valor is not None:
+            self._arbol.agregar(valor, ruta)
+
+    def _olvidar(self, ruta: str) -> None:
+        anterior = self._huellas.pop(ruta, None)
+        if anterior is None:
+            return
+        sha, valor = anterior
+        self._por_sha.get(sha, set()).discard(ruta)
+        if valor is not None:
+            self._arbol.quitar(valor, ruta)
+
+    def _cercanas(self, sha: str, valor: Optional[int], radio: Optional[int]) -> List[Tuple[int, str]]:
+        """
+        (distancia, ruta) de las copias exactas (distancia 0) y las figuras casi
+        iguales; con radio None solo las copias exactas
+        """
+        cercanas = {ruta: 0 for ruta in self._por_sha.get(sha, ())}
+        if valor is not None and radio is not None:
+            for d, ruta in self._arbol.buscar(valor, radio):
+                cercanas.setdefault(ruta, d)
+        return sorted((d, ruta) for ruta, d in cercanas.items())
+
+    # ----- escritura -----
+
+    def _registrar(self, ruta: str, sha: str, valor: Optional[int]) -> None:
+        self._db().execute(
+            "INSERT OR REPLACE INTO figuras (ruta, sha256, dhash, huella) VALUES (?, ?, ?, ?)",
+            (ruta, sha, None if valor is None else f"{valor:016x}", self._huella(Path(ruta))),
+        )
+        with self._lock:
+            self._recordar(ruta, sha, valor)
+
+    def sincronizar(self, archivos: Dict[str, Dict[str, Any]], bases: Optional[Iterable[Path]] = None) -> Dict[str, int]:
+        """
+        Calcula la huella de las imágenes nuevas o modificadas, quita las
+        eliminadas y vincula las figuras con las preguntas de `archivos`
+        ({ruta: contenido}, los mismos que carga el índice de preguntas)
+        """
+        inicio = time.perf_counter()
+        actuales: Dict[str, Path] = {}
+        for base in bases or BASES_BANCO:
+            if base.exists():
+                for path in base.rglob("*"):
+                    if path.parent.name == "imagenes" and path.suffix.lower() in EXTENSIONES_IMAGEN and path.is_file():
+                        actuales[path.as_posix()] = path
+
+        conn = self._db()
+        guardadas = {ruta: (sha, dhash, huella) for ruta, sha, dhash, huella in conn.execute("SELECT * FROM figuras")}
+        nuevas = 0
+        for ruta, path in sorted(actuales.items()):
+            huella = self._huella(path)
+            if ruta in guardadas and guardadas[ruta][2] == huella:
+                continue
+            data = path.read_bytes()
+            valor = calcular_dhash(data)
+            conn.execute(
+                "INSERT OR REPLACE INTO figuras (ruta, sha256, dhash, huella) VALUES (?, ?, ?, ?)",
+                (ruta, hashlib.sha256(data).hexdigest(), None if valor is None else f"{valor:016x}", huella),
+            )
+            nuevas += 1
+        eliminadas = [ruta for ruta in guardadas if ruta not in actuales]
+        conn.executemany("DELETE FROM figuras WHERE ruta = ?", [(ruta,) for ruta in eliminadas])
+
+        with self._lock:
+            self._arbol = ArbolBK()
+            self._huellas.clear()
+            self._por_sha.clear()
+            self._preguntas.clear()
+            for ruta, sha, dhash in conn.execute("SELECT ruta, sha256, dhash FROM figuras"):
+                self._recordar(ruta, sha, int(dhash, 16) if dhash else None)
+            for archivo, data in archivos.items():
+                self._vincular_archivo(Path(archivo).as_posix(), data)
+            total = len(self._huellas)
+
+        resumen = {"imagenes": total, "imagenes_nuevas": nuevas, "imagenes_eliminadas": len(eliminadas)}
+        logger.info(
+            f"🖼️ Índice de figuras sincronizado en {time.perf_counter() - inicio:.2f}s",
+            extra={"campos": resumen},
+        )
+        return resumen
+
+    def _vincular_archivo(self, archivo: str, data: Dict[str, Any]) -> None:
+        for posicion, pregunta in enumerate(data.get("preguntas") or []):
+            if isinstance(pregunta, dict):
+                id_pregunta = pregunta.get("id_temporal") or f"#{posicion}"
+                for ruta in _rutas_imagenes_de(archivo, pregunta):
+                    self._preguntas.setdefault(ruta, set()).add((archivo, id_pregunta))
+
+    def vincular(self, archivo: RutaArchivo, pregunta: Dict[str, Any]) -> None:
+        """Asocia las imágenes de una pregunta recién guardada con ella"""
+        with self._lock:
+            self._vincular_archivo(Path(archivo).as_posix(), {"preguntas": [pregunta]})
+
+    def _enlazar(self, origen: str, imagenes_dir: Path, prefijo: str, extension: str, contenido: bytes) -> str:
+        """Hard link a una copia exacta de otra carpeta con el nombre que toca (o copia si no se puede)"""
+        while True:
+            numero = reservar_numero_imagen(imagenes_dir, prefijo)
+            destino = imagenes_dir / f"{prefijo}_{numero:03d}.{extension}"
+            try:
+                os.link(origen, destino)
+                return destino.name
+            except FileExistsError:
+                continue
+            except OSError:
+                return guardar_imagen(imagenes_dir, prefijo, extension, io.BytesIO(contenido))
+
+    def guardar(self, imagenes_dir: Path, prefijo: str, extension: str, contenido: bytes) -> Dict[str, Any]:
+        """
+        Guarda una imagen subida evitando copias: si los mismos bytes ya están
+        en `imagenes_dir` se reutiliza ese archivo, si están en otra carpeta se
+        enlaza. Devuelve el nombre del archivo, cómo se guardó y las preguntas
+        que ya usan la misma figura (o una casi igual).
+        """
+        sha = hashlib.sha256(contenido).hexdigest()
+        valor = calcular_dhash(contenido)
+        carpeta = imagenes_dir.as_posix()
+        with self._lock:
+            copias = sorted(r for r in self._por_sha.get(sha, ()) if Path(r).exists())
+
+        misma_carpeta = [r for r in copias if Path(r).parent.as_posix() == carpeta]
+        if misma_carpeta:
+            nombre, modo = Path(misma_carpeta[0]).name, "reutilizada"
+        else:
+            if copias:
+                nombre, modo = self._enlazar(copias[0], imagenes_dir, prefijo, extension, contenido), "enlazada"
+            else:
+                nombre, modo = guardar_imagen(imagenes_dir, prefijo, extension, io.BytesIO(contenido)), "nueva"
+            self._registrar((imagenes_dir / nombre).as_posix(), sha, valor)
+
+        ruta = (imagenes_dir / nombre).as_posix()
+        return {"nombre": nombre, "almacenamiento": modo, "compartida_con": self._compartida_con(ruta, sha, valor)}
+
+    # ----- lectura -----
+
+    def _compartida_con(self, ruta: str, sha: str, valor: Optional[int]) -> List[Dict[str, Any]]:
+        """Preguntas cuyas imágenes son la misma figura (exacta o casi) que `ruta`"""
+        resultado: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        with self._lock:
+            for d, otra in self._cercanas(sha, valor, FIGURE_HASH_MAX_DISTANCE):
+                for archivo, id_pregunta in sorted(self._preguntas.get(otra, ())):
+                    if (archivo, id_pregunta) not in resultado:
+                        resultado[(archivo, id_pregunta)] = {
+                            "archivo": archivo,
+                            "id_temporal": id_pregunta,
+                            "imagen": Path(otra).name,
+                            "distancia": d,
+                            "misma_imagen": otra == ruta,
+                        }
+        return list(resultado.values())
+
+    def pregunta_de_imagenes(self, imagenes: List[bytes]) -> Optional[Dict[str, Any]]:
+        """
+        La pregunta del banco que ya usa todas las figuras subidas (copias
+        exactas, o a FIGURE_SHORTCUT_MAX_DISTANCE bits o menos si está
+        definida), o None. Si varias preguntas distintas comparten esas figuras
+        también es None: la subida puede ser otra pregunta más sobre la misma
+        figura y hay que extraerla.
+        Devuelve {"archivo", "id_temporal", "distancia"}.
+        """
+        comunes: Optional[Dict[Tuple[str, str], int]] = None
+        for data in imagenes:
+            sha = hashlib.sha256(data).hexdigest()
+            valor = None if FIGURE_SHORTCUT_MAX_DISTANCE is None else calcular_dhash(data)
+            de_esta: Dict[Tuple[str, str], int] = {}
+            with self._lock:
+                for d, ruta in self._cercanas(sha, valor, FIGURE_SHORTCUT_MAX_DISTANCE):
+                    for clave in self._preguntas.get(ruta, ()):
+                        de_esta[clave] = min(d, de_esta.get(clave, d))
+            if comunes is None:
+                comunes = de_esta
+            else:
+                comunes = {k: max(d, de_esta[k]) for k, d in comunes.items() if k in de_esta}
+            if not comunes:
+                return None
+        if not comunes or len(comunes) > 1:
+            return None
+        (archivo, id_pregunta), d = next(iter(comunes.items()))
+        return {"archivo": archivo, "id_temporal": id_pregunta, "distancia": d}
+
+    def grupos_compartidos(self) -> List[Dict[str, Any]]:
+        """Grupos de preguntas que usan la misma figura (exacta o casi), los más grandes primero"""
+        with self._lock:
+            padre: Dict[str, str] = {}
+
+            def raiz(ruta: str) -> str:
+                while padre.setdefault(ruta, ruta) != ruta:
+                    padre[ruta] = padre[padre[ruta]]
+                    ruta = padre[ruta]
+                return ruta
+
+            con_pregunta = [r for r in self._preguntas if r in self._huellas]
+            for ruta in con_pregunta:
+                sha, valor = self._huellas[ruta]
+                for _, otra in self._cercanas(sha, valor, FIGURE_HASH_MAX_DISTANCE):
+                    if otra in self._preguntas:
+                        padre[raiz(otra)] = raiz(ruta)
+
+            grupos: Dict[str, Dict[str, Any]] = {}
+            for ruta in con_pregunta:
+                grupo = grupos.setdefault(raiz(ruta), {"imagenes": set(), "preguntas": set()})
+                grupo["imagenes"].add(ruta)
+                grupo["preguntas"].update(self._preguntas[ruta])
+
+        resultado = [
+            {
+                "imagenes": sorted(g["imagenes"]),
+                "preguntas": [{"archivo": a, "id_temporal": i} for a, i in sorted(g["preguntas"])],
+            }
+            for g in grupos.values()
+            if len(g["preguntas"]) > 1
+        ]
+        resultado.sort(key=lambda g: (-len(g["preguntas"]), g["imagenes"][0]))
+        return resultado
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "imagenes": len(self._huellas),
+                "imagenes_distintas": sum(1 for rutas in self._por_sha.values() if rutas),
+                "imagenes_con_pregunta": sum(1 for r in self._preguntas if r in self._huellas),
+                "nodos_bk": self._arbol.nodos,
+                "hash_perceptual": Image is not None,
+            }
+
+
+indice_figuras = IndiceFiguras()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Índice de figuras por hash perceptual.")
+    sub = parser.add_subparsers(dest="accion", required=True)
+    sub.add_parser("sincronizar", help="Calcula las huellas de las imágenes nuevas o modificadas")
+    sub.add_parser("compartidas", help="Lista las preguntas que comparten figura")
+    args = parser.parse_args(argv)
+
+    resumen = indice_figuras.sincronizar(leer_archivos_banco())
+    if args.accion == "sincronizar":
+        print(f"OK: {resumen} {indice_figuras.get_stats()}")
+    else:
+        for grupo in indice_figuras.grupos_compartidos():
+            preguntas = ", ".join(f"{p['archivo']} [{p['id_temporal']}]" for p in grupo["preguntas"])
+            print(f"{len(grupo['imagenes'])} imagen(es): {preguntas}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -20,6 +20,9 @@ PROVIDER="gemini"
 PREGUNTAS=15
 LOTE=5
 SLEEP=1.0
+WORKERS=1             # >1 para generar temas y lotes en paralelo
+RPM=0                 # límite de peticiones por minuto (0 = sin límite)
+TPM=0                 # límite de tokens por minuto (0 = sin límite)
 OUT_DIR="salida"
 DEBUG_FLAG="--debug"   # "" para desactivar debug
 
@@ -63,6 +66,9 @@ fi
   --preguntas "$PREGUNTAS" \
   --lote "$LOTE" \
   --sleep "$SLEEP" \
+  --workers "$WORKERS" \
+  --rpm "$RPM" \
+  --tpm "$TPM" \
   --start-from "$START_FROM" \
   --out-dir "$OUT_PATH" \
   ${DEBUG_FLAG}
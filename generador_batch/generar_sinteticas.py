@@ -12,11 +12,28 @@ import os
 import random
 import re
 import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+# json_repair.py y retry_policy.py viven en la raíz del proyecto (compartidos con ai_services.py)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from json_repair import extract_json  # noqa: E402
+from retry_policy import RetryPolicy, call_with_retry, retry_metrics  # noqa: E402
+try:
+    from ai_schemas import gemini_generation_config, structured_output_enabled  # noqa: E402
+except ImportError:
+    # ai_schemas necesita pydantic (dependencia de google-genai); sin él, p. ej. con
+    # --provider stub, se usan los prompts con el formato en texto
+    gemini_generation_config = None
+
+    def structured_output_enabled() -> bool:
+        return False
+from near_dup import NEAR_DUP_THRESHOLD, IndiceDuplicados, filtrar_duplicadas  # noqa: E402
+
 
 def normalizar_texto(texto: str) -> str:
     """
@@ -70,6 +87,61 @@ class ThemeBlock:
     contenido: str
 
 
+class TokenBucket:
+    """
+    Limitador por cubeta de fichas para peticiones por minuto (rpm) y tokens por
+    minuto (tpm). Las cubetas se rellenan de forma continua; `acquire` bloquea
+    el hilo hasta que hay capacidad para una petición de `tokens` tokens.
+    Un límite de 0 desactiva esa cubeta.
+    """
+
+    def __init__(self, rpm: float = 0.0, tpm: float = 0.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._req = float(rpm)
+        self._tok = float(tpm)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._req = min(self.rpm, self._req + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            self._tok = min(self.tpm, self._tok + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int = 0) -> None:
+        if not self.rpm and not self.tpm:
+            return
+        # Una petición más grande que la cubeta entera nunca cabría
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                wait = 0.0
+                if self.rpm and self._req < 1:
+                    wait = max(wait, (1 - self._req) * 60.0 / self.rpm)
+                if self.tpm and self._tok < tokens:
+                    wait = max(wait, (tokens - self._tok) * 60.0 / self.tpm)
+                if wait <= 0:
+                    if self.rpm:
+                        self._req -= 1
+                    if self.tpm:
+                        self._tok -= tokens
+                    return
+            time.sleep(wait)
+
+
+# Tokens de salida estimados por pregunta generada (enunciado + 5 opciones + explicación)
+TOKENS_SALIDA_POR_PREGUNTA = 400
+
+
+def estimate_tokens(prompt: str, preguntas_por_lote: int) -> int:
+    """Estimación gruesa: ~4 caracteres por token de entrada más la salida esperada"""
+    return len(prompt) // 4 + preguntas_por_lote * TOKENS_SALIDA_POR_PREGUNTA
+
+
 def read_text_file(path: Path) -> str:
     try:
         return path.read_text(encoding="utf-8")
@@ -164,8 +236,10 @@ def build_prompt(
     contexto: str,
     preguntas_por_lote: int,
     id_inicio: int,
+    estructurado: bool = False,
+    evitar: Optional[List[str]] = None,
 ) -> str:
-    return f"""
+    prompt = f"""
 Eres un generador de preguntas tipo examen. Crea preguntas NUEVAS y ORIGINALES basadas en los ejemplos.
 
 INSTRUCCIONES IMPORTANTES:
@@ -194,6 +268,28 @@ IMPORTANTE - Formato LaTeX:
 Contexto (ejemplos base del tema con sus resoluciones):
 \"\"\"\n{contexto}\n\"\"\"
 
+Reglas ESTRICTAS:
+- Genera exactamente {preguntas_por_lote} preguntas en "preguntas".
+- CAMBIA todos los valores numéricos del contexto (usa números diferentes)
+- CAMBIA los contextos narrativos (nombres, lugares, situaciones)
+- MANTÉN el proceso de solución mostrado en las resoluciones
+- La "explicacion" debe mostrar el proceso de solución con los NUEVOS datos
+- "respuesta_correcta" debe coincidir con una de las opciones (A, B, C, D o E).
+- "dificultad" debe ser un entero entre 1 y 3 (similar al nivel del contexto).
+- Las preguntas deben pertenecer al tema "{titulo_tema}".
+- Usa LaTeX solo cuando sea necesario para expresiones matemáticas.
+
+"""
+    if evitar:
+        # Reemplazos de preguntas descartadas por casi duplicadas
+        prompt += "Ya existen estas preguntas del tema; las nuevas deben ser DISTINTAS (otro planteamiento y otros datos):\n"
+        prompt += "".join(f"- {texto}\n" for texto in evitar) + "\n"
+
+    if estructurado:
+        # El esquema "lote" (ai_schemas.py) fija la estructura; solo se piden los datos
+        return prompt
+
+    return prompt + f"""
 FORMATO DE SALIDA - MUY IMPORTANTE:
 - Devuelve ÚNICAMENTE un JSON válido, sin texto extra ni markdown (NO uses ```json ni ```)
 - La estructura DEBE ser un objeto con clave "preguntas" que contiene un ARRAY
@@ -201,6 +297,7 @@ FORMATO DE SALIDA - MUY IMPORTANTE:
 - NO incluyas saltos de línea dentro de los strings JSON (usa espacios en su lugar)
 - Mantén todo el texto en una sola línea por campo
 - Asegúrate de que el JSON sea parseable
+- "imagen" debe ser null.
 
 El JSON debe seguir EXACTAMENTE esta estructura (con {preguntas_por_lote} preguntas en el array):
 {{
@@ -221,18 +318,6 @@ El JSON debe seguir EXACTAMENTE esta estructura (con {preguntas_por_lote} pregun
   ]
 }}
 
-Reglas ESTRICTAS:
-- Genera exactamente {preguntas_por_lote} preguntas en "preguntas".
-- CAMBIA todos los valores numéricos del contexto (usa números diferentes)
-- CAMBIA los contextos narrativos (nombres, lugares, situaciones)
-- MANTÉN el proceso de solución mostrado en las resoluciones
-- La "explicacion" debe mostrar el proceso de solución con los NUEVOS datos
-- "respuesta_correcta" debe coincidir con una de las opciones (A, B, C, D o E).
-- "dificultad" debe ser un entero entre 1 y 3 (similar al nivel del contexto).
-- "imagen" debe ser null.
-- Las preguntas deben pertenecer al tema "{titulo_tema}".
-- Usa LaTeX solo cuando sea necesario para expresiones matemáticas.
-
 IMPORTANTE - Formato de salida:
 - NO incluyas razonamiento interno, comentarios, ni correcciones en el JSON
 - NO dupliques campos (cada pregunta tiene UNA explicacion, UN respuesta_correcta, etc.)
@@ -248,150 +333,30 @@ IMPORTANTE - Formato de salida:
 """
 
 
-def extract_json(text: str) -> Dict[str, Any]:
-    cleaned = text.strip()
-    cleaned = re.sub(r"^```(?:json)?\s*", "", cleaned)
-    cleaned = re.sub(r"```\s*$", "", cleaned)
-    if not cleaned:
-        raise ValueError("Respuesta vacia de la API.")
-
-    try:
-        return json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        # Intentar recuperar el JSON con limpieza adicional
-        start = cleaned.find("{")
-        end = cleaned.rfind("}")
-        if start == -1 or end == -1 or end <= start:
-            print(f"Error parseando JSON: {e}")
-            print(f"Primeros 500 chars: {cleaned[:500]}")
-            raise
-
-        json_str = cleaned[start : end + 1]
-
-        # Detectar y eliminar razonamiento interno/duplicación de campos
-        # Patrón: texto seguido de \n      "campo": (indicando duplicación)
-        json_str = re.sub(
-            r'\.\s*\(.*?\)\.\s*([A-Z][^"]*?)\n\s+"(explicacion|opciones|respuesta_correcta)":\s*',
-            r'.\n    },\n    {\n      "',
-            json_str
-        )
-
-        # Eliminar comentarios internos tipo "Let's...", "Correcting...", etc.
-        json_str = re.sub(
-            r'\.\s*(Let\'s|Correcting|Ok,|I need to|I wrote|So)[^.]*?\.\s*',
-            '. ',
-            json_str
-        )
-
-        # Limpiar comillas problemáticas
-        json_str = json_str.replace('"', '"').replace('"', '"')
-        json_str = json_str.replace(''', "'").replace(''', "'")
-
-        # Remover caracteres de control inválidos (excepto \n, \r, \t que son válidos)
-        json_str = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', json_str)
-
-        # Estrategia más robusta: procesar el JSON carácter por carácter dentro de strings
-        # para escapar correctamente backslashes y saltos de línea
-        result = []
-        in_string = False
-        escape_next = False
-        i = 0
-
-        while i < len(json_str):
-            char = json_str[i]
-
-            if escape_next:
-                result.append(char)
-                escape_next = False
-                i += 1
-                continue
-
-            if char == '"':
-                in_string = not in_string
-                result.append(char)
-                i += 1
-                continue
-
-            if in_string:
-                if char == '\\':
-                    # Verificar el siguiente carácter
-                    if i + 1 < len(json_str):
-                        next_char = json_str[i + 1]
-                        # Si es una secuencia de escape JSON válida, mantenerla
-                        if next_char in ('"', '\\', '/', 'b', 'f', 'n', 'r', 't', 'u'):
-                            result.append(char)
-                            escape_next = True
-                        else:
-                            # Es un backslash de LaTeX, duplicarlo
-                            result.append('\\\\')
-                    else:
-                        result.append('\\\\')
-                    i += 1
-                elif char == '\n':
-                    result.append('\\n')
-                    i += 1
-                elif char == '\r':
-                    result.append('\\r')
-                    i += 1
-                elif char == '\t':
-                    result.append('\\t')
-                    i += 1
-                else:
-                    result.append(char)
-                    i += 1
-            else:
-                result.append(char)
-                i += 1
-
-        json_str = ''.join(result)
-
-        try:
-            result = json.loads(json_str)
-            # Si el resultado es un objeto individual en lugar de tener "preguntas", intentar arreglarlo
-            if isinstance(result, dict) and "preguntas" not in result and "pregunta" in result:
-                # Es un objeto individual, necesitamos verificar si hay más
-                print("⚠️ Detectado: respuesta es objeto individual, intentando corregir...")
-                raise json.JSONDecodeError("Necesita envolver en array", json_str, 0)
-            return result
-        except json.JSONDecodeError as e2:
-            # Último intento: si el JSON son múltiples objetos separados por comas,
-            # intentar envolverlos en un array "preguntas"
-            if '"pregunta"' in json_str and '"preguntas"' not in json_str:
-                print("Intentando envolver objetos en estructura 'preguntas'...")
-                # Verificar si es un solo objeto o múltiples
-                if json_str.strip().startswith('{') and not json_str.strip().startswith('{"preguntas"'):
-                    wrapped = '{"preguntas": [' + json_str + ']}'
-                    try:
-                        return json.loads(wrapped)
-                    except json.JSONDecodeError:
-                        pass
-
-            print(f"Error parseando JSON después de limpieza: {e2}")
-            print(f"Posición del error: línea {e2.lineno}, columna {e2.colno}")
-
-            # Mostrar contexto del error
-            if hasattr(e2, 'pos'):
-                pos = e2.pos
-                context_start = max(0, pos - 100)
-                context_end = min(len(json_str), pos + 100)
-                context = json_str[context_start:context_end]
-                print(f"Contexto del error:")
-                print(f"...{context}...")
-
-            # Guardar JSON problemático para debug
-            debug_file = Path("/tmp/json_error_debug.txt")
-            debug_file.write_text(json_str, encoding="utf-8")
-            print(f"JSON guardado en: {debug_file}")
-            print(f"Longitud del JSON: {len(json_str)} caracteres")
-            raise
-
-
 def normalize_model_name(model: str) -> str:
     if model.startswith(("models/", "tunedModels/")):
         return model
     return f"models/{model}"
 
 
+# Configuración para salida más determinista y estructurada (interactivo y batch)
+GENERATION_CONFIG = {
+    "temperature": 0.7,  # Menos aleatorio
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+
+
+def generation_config() -> Dict[str, Any]:
+    """GENERATION_CONFIG más el esquema "lote" (ai_schemas.py) si la salida estructurada está activa"""
+    config = dict(GENERATION_CONFIG)
+    if structured_output_enabled():
+        config["response_mime_type"] = "application/json"
+        config["response_schema"] = gemini_generation_config("lote")["responseSchema"]
+    return config
+
+
 def call_gemini(prompt: str, model: str, api_key: str) -> str:
     try:
         from google import genai
@@ -400,13 +365,7 @@ def call_gemini(prompt: str, model: str, api_key: str) -> str:
         raise RuntimeError("Falta instalar google-genai") from exc
     client = genai.Client(api_key=api_key)
 
-    # Configuración para salida más determinista y estructurada
-    config = types.GenerateContentConfig(
-        temperature=0.7,  # Menos aleatorio
-        top_p=0.95,
-        top_k=40,
-        max_output_tokens=8192,
-    )
+    config = types.GenerateContentConfig(**generation_config())
 
     response = client.models.generate_content(
         model=normalize_model_name(model),
@@ -432,19 +391,15 @@ def simulate_response(prompt: str) -> str:
     preguntas = []
     for i in range(1, n + 1):
         qid = f"{materia}_{numero_tema:03d}_{i:03d}"
+        # Datos distintos en cada pregunta, como pide el prompt (si no, el filtro de duplicados las descarta)
+        a, x = random.randint(1, 999), random.randint(1, 999)
         preguntas.append(
             {
                 "id_temporal": qid,
-                "pregunta": f"Pregunta sintetica {i} sobre {titulo_tema} con $$x^2$$.",
+                "pregunta": f"Pregunta sintetica {i} sobre {titulo_tema}: si $$x + {a} = {a + x}$$, halle x.",
                 "dificultad": random.choice([1, 2, 3]),
-                "opciones": {
-                    "A": "$$x = 1$$",
-                    "B": "$$x = 2$$",
-                    "C": "$$x = 3$$",
-                    "D": "$$x = 4$$",
-                    "E": "$$x = 5$$",
-                },
-                "respuesta_correcta": random.choice(["A", "B", "C", "D", "E"]),
+                "opciones": {letra: f"$$x = {x + k}$$" for k, letra in enumerate("ABCDE")},
+                "respuesta_correcta": "A",
                 "explicacion": "Se aplica la regla y se obtiene el valor correcto.",
                 "imagen": None,
             }
@@ -466,51 +421,38 @@ def call_api(prompt: str, provider: str, model: str, api_key: str) -> str:
     return simulate_response(prompt)
 
 
-def generate_questions_for_theme(
+def build_theme_prompts(
     materia: str,
     theme: ThemeBlock,
     total_temas: int,
     preguntas_total: int,
     preguntas_por_lote: int,
-    sleep_s: float,
-    provider: str,
-    model: str,
-    api_key: str,
-    retries: int,
-) -> Dict[str, Any]:
-    all_preguntas: List[Dict[str, Any]] = []
+) -> List[str]:
+    """Un prompt por lote, en orden"""
     num_lotes = (preguntas_total + preguntas_por_lote - 1) // preguntas_por_lote
-
-    for lote in range(num_lotes):
-        id_inicio = lote * preguntas_por_lote + 1
-        prompt = build_prompt(
+    return [
+        build_prompt(
             materia=materia,
             numero_tema=theme.numero_tema,
             total_temas=total_temas,
             titulo_tema=theme.titulo_tema,
             contexto=theme.contenido,
             preguntas_por_lote=preguntas_por_lote,
-            id_inicio=id_inicio,
+            id_inicio=lote * preguntas_por_lote + 1,
+            estructurado=structured_output_enabled(),
         )
-        last_err: Optional[Exception] = None
-        for _ in range(retries + 1):
-            try:
-                raw = call_api(prompt, provider=provider, model=model, api_key=api_key)
-                data = extract_json(raw)
-                preguntas = data.get("preguntas", [])
-                if not isinstance(preguntas, list):
-                    raise ValueError("La API devolvio un JSON sin 'preguntas' como lista.")
-                all_preguntas.extend(preguntas)
-                last_err = None
-                break
-            except Exception as exc:
-                last_err = exc
-                time.sleep(1.0)
-        if last_err:
-            raise last_err
-        if sleep_s:
-            time.sleep(sleep_s)
+        for lote in range(num_lotes)
+    ]
+
 
+def build_theme_payload(
+    materia: str,
+    theme: ThemeBlock,
+    total_temas: int,
+    preguntas_total: int,
+    all_preguntas: List[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Arma el JSON del tema a partir de las preguntas de todos sus lotes (en orden)"""
     # Normalizar materia y tema para IDs
     materia_norm = normalizar_texto(materia)
     tema_norm = normalizar_texto(theme.titulo_tema)
@@ -533,12 +475,454 @@ def generate_questions_for_theme(
     return payload
 
 
+def generate_lote(
+    prompt: str,
+    preguntas_por_lote: int,
+    sleep_s: float,
+    provider: str,
+    model: str,
+    api_key: str,
+    policy: RetryPolicy,
+    limiter: Optional[TokenBucket] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Genera un lote; cada intento pasa por el limitador. Los 429/5xx se reintentan
+    con espera exponencial (respetando Retry-After) y un JSON inválido se vuelve
+    a pedir; los errores definitivos (API key inválida, modelo inexistente) no.
+    """
+    def intento() -> List[Dict[str, Any]]:
+        if limiter is not None:
+            limiter.acquire(estimate_tokens(prompt, preguntas_por_lote))
+        raw = call_api(prompt, provider=provider, model=model, api_key=api_key)
+        data = extract_json(raw, allow_single=False)
+        preguntas = data.get("preguntas", [])
+        if not isinstance(preguntas, list):
+            raise ValueError("La API devolvio un JSON sin 'preguntas' como lista.")
+        return preguntas
+
+    # Si el circuito del modelo se abre, todos los hilos esperan en vez de abortar la corrida
+    preguntas = call_with_retry(intento, key=f"{provider}:{model}", policy=policy, wait_on_open=True)
+    if sleep_s:
+        time.sleep(sleep_s)
+    return preguntas
+
+
+def generate_questions_for_theme(
+    materia: str,
+    theme: ThemeBlock,
+    total_temas: int,
+    preguntas_total: int,
+    preguntas_por_lote: int,
+    sleep_s: float,
+    provider: str,
+    model: str,
+    api_key: str,
+    policy: RetryPolicy,
+    limiter: Optional[TokenBucket] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
+    dedup: Optional[IndiceDuplicados] = None,
+    dedup_rondas: int = 2,
+) -> Dict[str, Any]:
+    """
+    Genera las preguntas de un tema. Con `executor` los lotes se lanzan en
+    paralelo, pero se concatenan en orden de lote para que la salida (y los IDs)
+    sea la misma que en modo secuencial.
+
+    Con `dedup` se descartan las casi duplicadas (entre sí o con las que ya
+    están en el índice) y se piden reemplazos, hasta `dedup_rondas` llamadas
+    extra; si aun así faltan, el tema se guarda con menos preguntas.
+    """
+    lote_args = (preguntas_por_lote, sleep_s, provider, model, api_key, policy, limiter)
+    all_preguntas = generate_theme_lotes(materia, theme, total_temas, preguntas_total, lote_args, executor)
+
+    if dedup is not None:
+        all_preguntas = replace_near_duplicates(
+            materia, theme, total_temas, preguntas_total, all_preguntas, dedup, dedup_rondas, lote_args
+        )
+
+    return build_theme_payload(materia, theme, total_temas, preguntas_total, all_preguntas)
+
+
+def generate_theme_lotes(
+    materia: str,
+    theme: ThemeBlock,
+    total_temas: int,
+    preguntas_total: int,
+    lote_args: Tuple[Any, ...],
+    executor: Optional[ThreadPoolExecutor] = None,
+) -> List[Dict[str, Any]]:
+    """Preguntas crudas de un tema (sin deduplicar), concatenadas en orden de lote"""
+    all_preguntas: List[Dict[str, Any]] = []
+    prompts = build_theme_prompts(materia, theme, total_temas, preguntas_total, lote_args[0])
+
+    if executor is None:
+        for prompt in prompts:
+            all_preguntas.extend(generate_lote(prompt, *lote_args))
+    else:
+        futures = [executor.submit(generate_lote, prompt, *lote_args) for prompt in prompts]
+        try:
+            for future in futures:
+                all_preguntas.extend(future.result())
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return all_preguntas
+
+
+def replace_near_duplicates(
+    materia: str,
+    theme: ThemeBlock,
+    total_temas: int,
+    preguntas_total: int,
+    preguntas: List[Dict[str, Any]],
+    dedup: IndiceDuplicados,
+    rondas: int,
+    lote_args: Tuple[Any, ...],
+) -> List[Dict[str, Any]]:
+    """Filtra las casi duplicadas y pide reemplazos con la lista de enunciados a evitar"""
+    prefijo = f"tema_{theme.numero_tema:03d}"
+    unicas, descartadas = filtrar_duplicadas(preguntas[:preguntas_total], dedup, prefijo)
+    total_descartadas = len(descartadas)
+
+    for _ in range(rondas):
+        faltan = preguntas_total - len(unicas)
+        if faltan <= 0:
+            break
+        prompt = build_prompt(
+            materia=materia,
+            numero_tema=theme.numero_tema,
+            total_temas=total_temas,
+            titulo_tema=theme.titulo_tema,
+            contexto=theme.contenido,
+            preguntas_por_lote=faltan,
+            id_inicio=len(unicas) + 1,
+            estructurado=structured_output_enabled(),
+            evitar=[str(q.get("pregunta", ""))[:200] for q in unicas],
+        )
+        nuevas, descartadas = filtrar_duplicadas(generate_lote(prompt, faltan, *lote_args[1:])[:faltan], dedup, prefijo)
+        unicas.extend(nuevas)
+        total_descartadas += len(descartadas)
+
+    if total_descartadas:
+        print(
+            f"[dedup] tema {theme.numero_tema}: {total_descartadas} casi duplicada(s) descartada(s), "
+            f"{len(unicas)}/{preguntas_total} preguntas"
+        )
+    return unicas
+
+
+def print_retry_summary() -> None:
+    for key, m in retry_metrics.snapshot().items():
+        print(
+            f"[reintentos] {key}: llamadas={m['llamadas']} intentos={m['intentos']} "
+            f"reintentos={m['reintentos']} fallos={m['fallos']} espera={m['espera_s']:.1f}s "
+            f"errores={m['errores']} circuito={m['circuito']}"
+        )
+
+
+def write_theme_file(out_file: Path, payload: Dict[str, Any]) -> None:
+    """Escribe en un temporal y renombra: un tema a medio escribir nunca cuenta como existente"""
+    tmp = out_file.with_name(f".{out_file.name}.tmp")
+    tmp.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, out_file)
+
+
+def pending_themes(
+    themes: List[ThemeBlock],
+    materia_dir: Path,
+    start_from: int,
+    debug: bool,
+) -> List[Tuple[ThemeBlock, Path]]:
+    """Temas por generar: desde start_from y sin archivo de salida (reanudación)"""
+    pending: List[Tuple[ThemeBlock, Path]] = []
+    for theme in themes:
+        # Saltar temas anteriores al start-from
+        if theme.numero_tema < start_from:
+            if debug:
+                print(f"[debug] saltando tema {theme.numero_tema}: {theme.titulo_tema}")
+            continue
+
+        # Verificar si el archivo ya existe
+        tema_norm = normalizar_texto(theme.titulo_tema)
+        out_file = materia_dir / f"tema_{theme.numero_tema:03d}_{tema_norm}.json"
+
+        if out_file.exists():
+            if debug:
+                print(f"[debug] ya existe tema {theme.numero_tema}: {out_file.name}")
+            continue
+        pending.append((theme, out_file))
+    return pending
+
+
 def iter_input_files(input_path: Path) -> List[Path]:
     if input_path.is_dir():
         return sorted(p for p in input_path.glob("*.txt") if p.is_file())
     return [input_path]
 
 
+# ----- Modo batch -----
+#
+# preparar: escribe un prompt por lote en lotes.jsonl (formato de la Batch API de
+#           Gemini: {"key", "request"}) y el manifiesto con los datos de cada tema
+# enviar:   sube el archivo y crea el trabajo batch (gemini) o lo ejecuta con el
+#           ejecutor local (stub), dejando las respuestas en resultados.jsonl
+# ingerir:  descarga los resultados si el trabajo terminó y escribe
+#           salida/<materia>/tema_XXX_*.json (los temas ya existentes se saltan)
+# local:    preparar + ejecutor local + ingerir, para probar sin conexión
+
+BATCH_LOTES = "lotes.jsonl"
+BATCH_MANIFIESTO = "manifiesto.json"
+BATCH_TRABAJO = "trabajo.json"
+BATCH_RESULTADOS = "resultados.jsonl"
+
+BATCH_ESTADOS_FINALES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+def _camel(name: str) -> str:
+    head, *rest = name.split("_")
+    return head + "".join(part.title() for part in rest)
+
+
+def batch_request(prompt: str) -> Dict[str, Any]:
+    """GenerateContentRequest en JSON (REST) con la misma configuración que call_gemini"""
+    return {
+        "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+        "generationConfig": {_camel(k): v for k, v in generation_config().items()},
+    }
+
+
+def batch_prepare(
+    pending: List[Tuple[ThemeBlock, Path, int]],
+    batch_dir: Path,
+    materia: str,
+    preguntas_total: int,
+    preguntas_por_lote: int,
+    model: str,
+) -> int:
+    """Escribe lotes.jsonl y manifiesto.json; devuelve el número de lotes"""
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    temas: List[Dict[str, Any]] = []
+    num_lotes = 0
+    with (batch_dir / BATCH_LOTES).open("w", encoding="utf-8") as f:
+        for theme, out_file, total_temas in pending:
+            prompts = build_theme_prompts(materia, theme, total_temas, preguntas_total, preguntas_por_lote)
+            keys = []
+            for lote, prompt in enumerate(prompts):
+                key = f"{out_file.stem}:{lote:03d}"
+                f.write(json.dumps({"key": key, "request": batch_request(prompt)}, ensure_ascii=False) + "\n")
+                keys.append(key)
+            num_lotes += len(keys)
+            temas.append(
+                {
+                    "archivo_salida": out_file.name,
+                    "numero_tema": theme.numero_tema,
+                    "titulo_tema": theme.titulo_tema,
+                    "total_temas": total_temas,
+                    "lotes": keys,
+                }
+            )
+    manifiesto = {
+        "materia": materia,
+        "modelo": model,
+        "preguntas": preguntas_total,
+        "lote": preguntas_por_lote,
+        "creado": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "temas": temas,
+    }
+    write_theme_file(batch_dir / BATCH_MANIFIESTO, manifiesto)
+    # Resultados de una corrida anterior ya no corresponden a este archivo de lotes
+    for stale in (BATCH_RESULTADOS, BATCH_TRABAJO):
+        (batch_dir / stale).unlink(missing_ok=True)
+    return num_lotes
+
+
+def batch_run_local(batch_dir: Path, provider: str, model: str, api_key: str, policy: RetryPolicy) -> int:
+    """
+    Ejecutor local que sustituye a la Batch API: procesa lotes.jsonl llamando al
+    proveedor uno por uno y escribe resultados.jsonl con el mismo formato de
+    salida que Gemini ({"key", "response"} o {"key", "error"}).
+    """
+    n = 0
+    tmp = batch_dir / f".{BATCH_RESULTADOS}.tmp"
+    with (batch_dir / BATCH_LOTES).open(encoding="utf-8") as src, tmp.open("w", encoding="utf-8") as out:
+        for line in src:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            prompt = "".join(p.get("text", "") for p in item["request"]["contents"][0]["parts"])
+            try:
+                text = call_with_retry(
+                    lambda: call_api(prompt, provider=provider, model=model, api_key=api_key),
+                    key=f"{provider}:{model}",
+                    policy=policy,
+                    wait_on_open=True,
+                )
+                result = {"key": item["key"], "response": {"candidates": [{"content": {"parts": [{"text": text}]}}]}}
+            except Exception as exc:
+                result = {"key": item["key"], "error": {"message": str(exc)}}
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            n += 1
+    os.replace(tmp, batch_dir / BATCH_RESULTADOS)
+    return n
+
+
+def _gemini_client(api_key: str):
+    try:
+        from google import genai
+    except Exception as exc:
+        raise RuntimeError("Falta instalar google-genai") from exc
+    return genai.Client(api_key=api_key)
+
+
+def batch_submit_gemini(batch_dir: Path, model: str, api_key: str) -> str:
+    """Sube lotes.jsonl y crea el trabajo en la Batch API de Gemini; guarda su nombre"""
+    from google.genai import types
+
+    client = _gemini_client(api_key)
+    uploaded = client.files.upload(
+        file=str(batch_dir / BATCH_LOTES),
+        config=types.UploadFileConfig(display_name=f"lotes-{batch_dir.name}", mime_type="jsonl"),
+    )
+    job = client.batches.create(
+        model=normalize_model_name(model),
+        src=uploaded.name,
+        config={"display_name": f"sinteticas-{batch_dir.name}"},
+    )
+    write_theme_file(batch_dir / BATCH_TRABAJO, {"nombre": job.name, "archivo_lotes": uploaded.name, "modelo": model})
+    return job.name
+
+
+def batch_fetch_gemini(batch_dir: Path, api_key: str) -> Optional[str]:
+    """Descarga los resultados si el trabajo terminó; devuelve el estado del trabajo"""
+    trabajo_file = batch_dir / BATCH_TRABAJO
+    if not trabajo_file.exists():
+        return None
+    trabajo = json.loads(trabajo_file.read_text(encoding="utf-8"))
+    client = _gemini_client(api_key)
+    job = client.batches.get(name=trabajo["nombre"])
+    state = getattr(job.state, "name", str(job.state))
+    if state == "JOB_STATE_SUCCEEDED" and job.dest and job.dest.file_name:
+        content = client.files.download(file=job.dest.file_name)
+        tmp = batch_dir / f".{BATCH_RESULTADOS}.tmp"
+        tmp.write_bytes(content)
+        os.replace(tmp, batch_dir / BATCH_RESULTADOS)
+    return state
+
+
+def _response_text(result: Dict[str, Any]) -> str:
+    if "error" in result:
+        raise RuntimeError(result["error"].get("message", "error en el lote"))
+    candidates = result.get("response", {}).get("candidates") or []
+    if not candidates:
+        raise ValueError("Lote sin candidatos en la respuesta.")
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(p.get("text", "") for p in parts)
+
+
+def batch_ingest(
+    batch_dir: Path, materia_dir: Path, dedup: Optional[IndiceDuplicados] = None
+) -> Tuple[int, List[str]]:
+    """
+    Convierte resultados.jsonl en archivos de tema; devuelve (escritos, errores).
+    Con `dedup` se descartan las casi duplicadas (sin reemplazo: el lote ya terminó).
+    """
+    manifiesto = json.loads((batch_dir / BATCH_MANIFIESTO).read_text(encoding="utf-8"))
+    resultados: Dict[str, Dict[str, Any]] = {}
+    with (batch_dir / BATCH_RESULTADOS).open(encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                resultados[item["key"]] = item
+
+    escritos = 0
+    errores: List[str] = []
+    for tema in manifiesto["temas"]:
+        out_file = materia_dir / tema["archivo_salida"]
+        if out_file.exists():
+            continue
+        theme = ThemeBlock(tema["numero_tema"], tema["titulo_tema"], "")
+        all_preguntas: List[Dict[str, Any]] = []
+        try:
+            for key in tema["lotes"]:
+                if key not in resultados:
+                    raise ValueError(f"falta el resultado del lote {key}")
+                data = extract_json(_response_text(resultados[key]), allow_single=False)
+                preguntas = data.get("preguntas", [])
+                if not isinstance(preguntas, list):
+                    raise ValueError(f"lote {key} sin 'preguntas' como lista")
+                all_preguntas.extend(preguntas)
+        except Exception as exc:
+            errores.append(f"tema {tema['numero_tema']} ({tema['titulo_tema']}): {exc}")
+            continue
+        if dedup is not None:
+            all_preguntas, descartadas = filtrar_duplicadas(
+                all_preguntas[:manifiesto["preguntas"]], dedup, f"tema_{theme.numero_tema:03d}"
+            )
+            if descartadas:
+                print(f"[dedup] tema {theme.numero_tema}: {len(descartadas)} casi duplicada(s) descartada(s)")
+        payload = build_theme_payload(
+            manifiesto["materia"], theme, tema["total_temas"], manifiesto["preguntas"], all_preguntas
+        )
+        write_theme_file(out_file, payload)
+        escritos += 1
+    return escritos, errores
+
+
+def run_batch_mode(
+    args: argparse.Namespace,
+    pending: List[Tuple[ThemeBlock, Path, int]],
+    batch_dir: Path,
+    materia_dir: Path,
+    model: str,
+    api_key: str,
+    policy: RetryPolicy,
+    dedup: Optional[IndiceDuplicados] = None,
+) -> int:
+    mode = args.batch_mode
+    if mode in ("preparar", "local"):
+        if not pending:
+            print("No hay temas pendientes: todos los archivos de salida ya existen.")
+            return 0
+        n = batch_prepare(pending, batch_dir, args.materia, args.preguntas, args.lote, model)
+        print(f"Batch: {n} lote(s) de {len(pending)} tema(s) en {batch_dir / BATCH_LOTES}")
+
+    if mode in ("enviar", "local"):
+        if not (batch_dir / BATCH_LOTES).exists():
+            print(f"No existe {batch_dir / BATCH_LOTES}; ejecuta primero --batch-mode preparar", file=sys.stderr)
+            return 2
+        if args.provider == "gemini" and mode == "enviar":
+            name = batch_submit_gemini(batch_dir, model, api_key)
+            print(f"Batch: trabajo creado {name}. Ejecuta --batch-mode ingerir cuando termine.")
+            return 0
+        n = batch_run_local(batch_dir, args.provider, model, api_key, policy)
+        print(f"Batch: ejecutor local procesó {n} lote(s)")
+
+    if mode in ("ingerir", "local"):
+        if not (batch_dir / BATCH_MANIFIESTO).exists():
+            print(f"No existe {batch_dir / BATCH_MANIFIESTO}; ejecuta primero --batch-mode preparar", file=sys.stderr)
+            return 2
+        if args.provider == "gemini" and not (batch_dir / BATCH_RESULTADOS).exists():
+            state = batch_fetch_gemini(batch_dir, api_key)
+            if state not in BATCH_ESTADOS_FINALES:
+                print(f"Batch: el trabajo aún no termina (estado: {state}).")
+                return 3
+            if state != "JOB_STATE_SUCCEEDED":
+                print(f"Batch: el trabajo terminó con estado {state}.", file=sys.stderr)
+                return 1
+        if not (batch_dir / BATCH_RESULTADOS).exists():
+            print(f"No existe {batch_dir / BATCH_RESULTADOS}; ejecuta primero --batch-mode enviar", file=sys.stderr)
+            return 2
+        escritos, errores = batch_ingest(batch_dir, materia_dir, dedup)
+        for err in errores:
+            print(f"Error en {err}", file=sys.stderr)
+        print(f"Batch: {escritos} tema(s) escritos en {materia_dir}/")
+        if errores:
+            print(f"{len(errores)} tema(s) fallaron; vuelve a preparar el batch para reintentarlos.", file=sys.stderr)
+            return 1
+    return 0
+
+
 def main(argv: List[str]) -> int:
     parser = argparse.ArgumentParser(description="Generador de preguntas sinteticas por tema.")
     parser.add_argument("--input", required=True, help="Ruta a .txt o directorio con .txt")
@@ -550,9 +934,24 @@ def main(argv: List[str]) -> int:
     parser.add_argument("--provider", default="stub", choices=["stub", "gemini"], help="Proveedor LLM")
     parser.add_argument("--model", default=None, help="Modelo a usar (override de GEMINI_MODEL)")
     parser.add_argument("--retries", type=int, default=2, help="Reintentos por lote")
+    parser.add_argument("--backoff-base", type=float, default=2.0, help="Espera base entre reintentos (s), crece exponencialmente")
+    parser.add_argument("--backoff-max", type=float, default=60.0, help="Espera maxima entre reintentos (s)")
+    parser.add_argument("--workers", type=int, default=1, help="Llamadas a la API en paralelo (temas y lotes)")
+    parser.add_argument("--rpm", type=float, default=0.0, help="Limite de peticiones por minuto (0 = sin limite)")
+    parser.add_argument("--tpm", type=float, default=0.0, help="Limite de tokens por minuto, estimados (0 = sin limite)")
     parser.add_argument("--min-content-chars", type=int, default=80, help="Minimo de contenido para aceptar tema")
     parser.add_argument("--clean-prefix", action="append", default=[], help="Prefijo adicional a limpiar")
     parser.add_argument("--start-from", type=int, default=1, help="Empezar desde el tema N (para continuar interrupciones)")
+    parser.add_argument(
+        "--batch-mode",
+        choices=["preparar", "enviar", "ingerir", "local"],
+        default=None,
+        help="Generar via Batch API: preparar JSONL, enviar, ingerir resultados (local = todo con ejecutor local)",
+    )
+    parser.add_argument("--batch-dir", default=None, help="Directorio del trabajo batch (default: <out-dir>/.batch/<materia>)")
+    parser.add_argument("--dedup-umbral", type=float, default=NEAR_DUP_THRESHOLD, help="Similitud desde la que una pregunta se descarta por casi duplicada")
+    parser.add_argument("--dedup-rondas", type=int, default=2, help="Llamadas extra por tema para reemplazar casi duplicadas")
+    parser.add_argument("--sin-dedup", action="store_true", help="No filtrar preguntas casi duplicadas")
     parser.add_argument("--debug", action="store_true", help="Imprime resumen de parseo")
     parser.add_argument("--debug-all", action="store_true", help="Imprime todos los temas detectados")
     args = parser.parse_args(argv)
@@ -581,6 +980,18 @@ def main(argv: List[str]) -> int:
         print("Falta GEMINI_API_KEY en el entorno.", file=sys.stderr)
         return 2
 
+    workers = max(1, args.workers)
+    policy = RetryPolicy(max_retries=args.retries, base_delay=args.backoff_base, max_delay=args.backoff_max)
+    limiter = TokenBucket(rpm=args.rpm, tpm=args.tpm) if (args.rpm or args.tpm) else None
+
+    batch_pending: List[Tuple[ThemeBlock, Path, int]] = []
+
+    # Índice de casi duplicados de la materia, con las preguntas ya generadas en corridas anteriores
+    dedup: Optional[IndiceDuplicados] = None
+    if not args.sin_dedup:
+        dedup = IndiceDuplicados(args.dedup_umbral)
+        dedup.cargar_directorio(out_dir / normalizar_texto(args.materia))
+
     for file_path in iter_input_files(input_path):
         text = read_text_file(file_path)
         themes = parse_themes(text, clean_prefixes, args.min_content_chars)
@@ -600,38 +1011,74 @@ def main(argv: List[str]) -> int:
         imagenes_dir = materia_dir / "imagenes"
         imagenes_dir.mkdir(exist_ok=True)
 
-        for theme in themes:
-            # Saltar temas anteriores al start-from
-            if theme.numero_tema < args.start_from:
-                if args.debug:
-                    print(f"[debug] saltando tema {theme.numero_tema}: {theme.titulo_tema}")
-                continue
+        pending = pending_themes(themes, materia_dir, args.start_from, args.debug)
+        if args.batch_mode:
+            batch_pending.extend((theme, out_file, total_temas) for theme, out_file in pending)
+            continue
 
-            # Verificar si el archivo ya existe
-            tema_norm = normalizar_texto(theme.titulo_tema)
-            out_file = materia_dir / f"tema_{theme.numero_tema:03d}_{tema_norm}.json"
+        if workers == 1:
+            for theme, out_file in pending:
+                payload = generate_questions_for_theme(
+                    materia=args.materia,
+                    theme=theme,
+                    total_temas=total_temas,
+                    preguntas_total=args.preguntas,
+                    preguntas_por_lote=args.lote,
+                    sleep_s=args.sleep,
+                    provider=args.provider,
+                    model=model,
+                    api_key=api_key,
+                    policy=policy,
+                    limiter=limiter,
+                    dedup=dedup,
+                    dedup_rondas=args.dedup_rondas,
+                )
+                # Cada tema se guarda al terminar, así una interrupción conserva lo ya generado
+                write_theme_file(out_file, payload)
+            continue
 
-            if out_file.exists():
-                if args.debug:
-                    print(f"[debug] ya existe tema {theme.numero_tema}: {out_file.name}")
-                continue
+        lote_args = (args.lote, args.sleep, args.provider, model, api_key, policy, limiter)
+
+        def finish_theme(theme: ThemeBlock, out_file: Path, preguntas: List[Dict[str, Any]]) -> None:
+            if dedup is not None:
+                preguntas = replace_near_duplicates(
+                    args.materia, theme, total_temas, args.preguntas, preguntas, dedup, args.dedup_rondas, lote_args
+                )
+            write_theme_file(out_file, build_theme_payload(args.materia, theme, total_temas, args.preguntas, preguntas))
+
+        # Dos pools: los hilos de tema solo esperan a sus lotes, las llamadas a
+        # la API corren en el pool de lotes (evita bloqueos por pool anidado).
+        # La deduplicación y los reemplazos corren aquí, en orden de tema: el
+        # índice compartido evoluciona igual que en modo secuencial.
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lote") as lote_pool, \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tema") as tema_pool:
+            theme_futures: List[Tuple[ThemeBlock, Path, Future]] = [
+                (theme, out_file, tema_pool.submit(
+                    generate_theme_lotes, args.materia, theme, total_temas, args.preguntas, lote_args, lote_pool
+                ))
+                for theme, out_file in pending
+            ]
+            errors = 0
+            for theme, out_file, future in theme_futures:
+                try:
+                    finish_theme(theme, out_file, future.result())
+                    if args.debug:
+                        print(f"[debug] tema {theme.numero_tema} listo: {out_file.name}")
+                except Exception as exc:
+                    errors += 1
+                    print(f"Error en tema {theme.numero_tema} ({theme.titulo_tema}): {exc}", file=sys.stderr)
+            if errors:
+                print_retry_summary()
+                print(f"{errors} tema(s) fallaron; vuelve a ejecutar para reintentarlos.", file=sys.stderr)
+                return 1
 
-            payload = generate_questions_for_theme(
-                materia=args.materia,
-                theme=theme,
-                total_temas=total_temas,
-                preguntas_total=args.preguntas,
-                preguntas_por_lote=args.lote,
-                sleep_s=args.sleep,
-                provider=args.provider,
-                model=model,
-                api_key=api_key,
-                retries=args.retries,
-            )
-            out_file.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    materia_norm = normalizar_texto(args.materia)
+    if args.batch_mode:
+        batch_dir = Path(args.batch_dir) if args.batch_dir else out_dir / ".batch" / materia_norm
+        return run_batch_mode(args, batch_pending, batch_dir, out_dir / materia_norm, model, api_key, policy, dedup)
 
+    print_retry_summary()
     num_archivos = len(iter_input_files(input_path))
-    materia_norm = normalizar_texto(args.materia)
     print(f"OK: procesados {num_archivos} archivo(s). Salida en: {out_dir}/{materia_norm}/")
     return 0
 
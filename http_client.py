@@ -0,0 +1,87 @@
+"""
+Cliente HTTP compartido para todas las llamadas a proveedores de IA.
+
+Se crea un único httpx.AsyncClient con pool de conexiones (y HTTP/2 si el
+paquete `h2` está instalado) en el lifespan de FastAPI, de modo que cada
+extracción reutiliza conexiones TCP+TLS abiertas en lugar de abrir una nueva.
+
+Variables de entorno:
+- HTTP_TIMEOUT: timeout total por petición en segundos (default 30)
+- HTTP_MAX_CONNECTIONS: conexiones simultáneas máximas (default 100)
+- HTTP_MAX_KEEPALIVE: conexiones inactivas que se mantienen abiertas (default 20)
+- HTTP_KEEPALIVE_EXPIRY: segundos que una conexión inactiva sigue abierta (default 30)
+- HTTP2: "false" para desactivar HTTP/2 (default true si `h2` está disponible)
+"""
+
+import os
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+
+load_dotenv()
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2", "true").lower() not in ("0", "false", "no")
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_disponible() -> bool:
+    """HTTP/2 requiere el paquete opcional `h2` (pip install httpx[http2])"""
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _crear_cliente() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+        limits=limits,
+        http2=_http2_disponible(),
+    )
+
+
+async def init_http_client() -> httpx.AsyncClient:
+    """Crea el cliente compartido (se llama desde el lifespan de la app)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _crear_cliente()
+        get_logger(__name__).info(
+            f"🌐 Cliente HTTP compartido listo (http2={_http2_disponible()}, "
+            f"max_connections={HTTP_MAX_CONNECTIONS}, keepalive={HTTP_MAX_KEEPALIVE})"
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Cierra el cliente compartido y libera las conexiones del pool"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente compartido. Si la app no pasó por el lifespan
+    (scripts, consola), se crea de forma perezosa en el primer uso.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _crear_cliente()
+    return _client
@@ -0,0 +1,152 @@
+"""
+Preprocesado de imágenes antes de enviarlas a los proveedores de IA.
+
+Las fotos de celular (8-12 MB) viajaban tal cual en base64 y siempre
+etiquetadas como image/jpeg. Aquí cada imagen:
+1. Se detecta su formato real (Pillow o firma de bytes)
+2. Se rota según la orientación EXIF
+3. Se recorta al contenido (elimina márgenes de color uniforme)
+4. Se reduce para que su lado mayor no supere IMAGE_MAX_EDGE
+5. Se recodifica como JPEG o WebP
+
+Si Pillow no está disponible o la imagen no se puede decodificar, se envían
+los bytes originales con el tipo MIME detectado por su firma.
+
+Variables de entorno:
+- IMAGE_PREPROCESSING: "false" para enviar las imágenes sin procesar (default true)
+- IMAGE_MAX_EDGE: lado mayor máximo en píxeles (default 2048)
+- IMAGE_FORMAT: "jpeg" o "webp" (default jpeg)
+- IMAGE_QUALITY: calidad de compresión 1-100 (default 85)
+- IMAGE_CROP_TOLERANCE: diferencia de color tolerada al recortar márgenes (default 24)
+"""
+
+import asyncio
+import base64
+import io
+import os
+from dataclasses import dataclass
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+try:
+    from PIL import Image, ImageChops, ImageOps
+except ImportError:  # pragma: no cover - Pillow es opcional en scripts
+    Image = None
+
+IMAGE_PREPROCESSING = os.getenv("IMAGE_PREPROCESSING", "true").lower() not in ("0", "false", "no")
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_CROP_TOLERANCE = int(os.getenv("IMAGE_CROP_TOLERANCE", "24"))
+
+# Margen (px) que se conserva alrededor del contenido al recortar
+_CROP_MARGIN = 16
+
+_MIME_POR_FORMATO = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+    "GIF": "image/gif",
+    "BMP": "image/bmp",
+}
+
+
+@dataclass
+class ImagenPreparada:
+    """Imagen lista para enviar a un proveedor"""
+    data: bytes
+    mime_type: str
+    bytes_originales: int
+
+    @property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+
+def detectar_mime(data: bytes) -> str:
+    """Tipo MIME según la firma de los primeros bytes"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:2] == b"BM":
+        return "image/bmp"
+    return "image/jpeg"
+
+
+def recortar_contenido(img: "Image.Image") -> "Image.Image":
+    """Recorta márgenes de color uniforme tomando como fondo el color de la esquina"""
+    gris = img.convert("L")
+    fondo = Image.new("L", gris.size, gris.getpixel((0, 0)))
+    diff = ImageChops.difference(gris, fondo).point(lambda p: 255 if p > IMAGE_CROP_TOLERANCE else 0)
+    bbox = diff.getbbox()
+    if not bbox:
+        return img
+    left, top, right, bottom = bbox
+    left = max(0, left - _CROP_MARGIN)
+    top = max(0, top - _CROP_MARGIN)
+    right = min(img.width, right + _CROP_MARGIN)
+    bottom = min(img.height, bottom + _CROP_MARGIN)
+    # No recortar si casi no cambia (evita recodificar por unos pocos píxeles)
+    if (right - left) * (bottom - top) > 0.98 * img.width * img.height:
+        return img
+    return img.crop((left, top, right, bottom))
+
+
+def preparar_imagen(data: bytes, max_edge: Optional[int] = None, formato: Optional[str] = None) -> ImagenPreparada:
+    """Detecta, rota, recorta, reduce y recodifica una imagen (operación síncrona, CPU)"""
+    original = ImagenPreparada(data=data, mime_type=detectar_mime(data), bytes_originales=len(data))
+    if not IMAGE_PREPROCESSING or Image is None:
+        return original
+
+    max_edge = max_edge or IMAGE_MAX_EDGE
+    formato = (formato or IMAGE_FORMAT).upper()
+    if formato not in ("JPEG", "WEBP"):
+        formato = "JPEG"
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.format in _MIME_POR_FORMATO:
+            original.mime_type = _MIME_POR_FORMATO[img.format]
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            # Fondo blanco para PNG/WebP con transparencia
+            fondo = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            fondo.paste(rgba, mask=rgba.split()[-1])
+            img = fondo
+
+        img = recortar_contenido(img)
+        if max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        out = io.BytesIO()
+        if formato == "WEBP":
+            img.save(out, format="WEBP", quality=IMAGE_QUALITY, method=4)
+        else:
+            img.save(out, format="JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        procesada = out.getvalue()
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo preprocesar la imagen, se envía la original: {e}")
+        return original
+
+    # Si recodificar no ayudó (imagen pequeña ya comprimida), enviar la original
+    if len(procesada) >= len(data) and original.mime_type in ("image/jpeg", "image/png", "image/webp"):
+        return original
+    return ImagenPreparada(data=procesada, mime_type=_MIME_POR_FORMATO[formato], bytes_originales=len(data))
+
+
+async def preparar_imagenes(images: List[bytes]) -> List[ImagenPreparada]:
+    """Preprocesa varias imágenes en paralelo fuera del event loop"""
+    return list(await asyncio.gather(*[asyncio.to_thread(preparar_imagen, image) for image in images]))
@@ -0,0 +1,486 @@
+"""
+Cola de trabajos persistente (SQLite) para las tareas de IA largas.
+
+Generar una explicación (hasta 3 imágenes de solución) o una variación
+mantenía la petición HTTP abierta durante toda la llamada al proveedor:
+decenas de segundos ocupando un worker de uvicorn y, a veces, superando el
+timeout del navegador. Ahora esos endpoints solo encolan el trabajo y
+responden 202 con su id; el resultado se consulta en GET /api/jobs/{id} o se
+espera por Server-Sent Events en GET /api/jobs/{id}/eventos.
+
+- Los trabajos (parámetros e imágenes) se guardan en JOBS_DB_PATH, así que
+  sobreviven a un reinicio de la app
+- JOBS_WORKERS workers asyncio dentro de la app toman los trabajos por
+  prioridad (mayor primero) y antigüedad. Con JOBS_WORKERS=0 la app solo
+  encola y los procesan workers aparte, que escalan por separado:
+      python job_queue.py worker --workers 4
+- Un trabajo tomado tiene un plazo (JOBS_LEASE_SECONDS): si el proceso que
+  lo ejecutaba muere, otro worker lo retoma al vencer, hasta
+  JOBS_MAX_ATTEMPTS intentos. Un error del proveedor termina el trabajo con
+  estado "error" (los reintentos ante 429/5xx ya ocurren en retry_policy)
+- Las imágenes se borran al terminar el trabajo y los trabajos terminados se
+  purgan tras JOBS_RETENTION_HOURS
+
+Variables de entorno:
+- JOBS_DB_PATH: archivo SQLite de la cola (default .cache/jobs.sqlite3)
+- JOBS_WORKERS: workers dentro de la app (default 2; 0 = solo encolar)
+- JOBS_LEASE_SECONDS: plazo de un trabajo tomado antes de darlo por abandonado (default 300)
+- JOBS_MAX_ATTEMPTS: veces que se toma un trabajo abandonado antes de marcarlo con error (default 2)
+- JOBS_POLL_INTERVAL: segundos entre consultas a la base cuando no hay avisos del mismo proceso (default 1)
+- JOBS_RETENTION_HOURS: horas que se conservan los trabajos terminados (default 24)
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+from metrics import job_duration, jobs
+from storage_pool import run_storage
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+JOBS_DB_PATH = Path(os.getenv("JOBS_DB_PATH", ".cache/jobs.sqlite3"))
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))
+JOBS_LEASE_SECONDS = float(os.getenv("JOBS_LEASE_SECONDS", "300"))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "2"))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "1"))
+JOBS_RETENTION_HOURS = float(os.getenv("JOBS_RETENTION_HOURS", "24"))
+
+ESTADOS_TERMINALES = ("listo", "error")
+
+RutaArchivo = Union[str, Path]
+
+# Función de un tipo de trabajo: (parámetros, imágenes) -> resultado JSON
+Ejecutor = Callable[[Dict[str, Any], List[bytes]], Awaitable[Dict[str, Any]]]
+
+
+@dataclass
+class TipoTrabajo:
+    ejecutar: Ejecutor
+    prioridad: int
+
+
+TIPOS: Dict[str, TipoTrabajo] = {}
+
+
+def tipo_trabajo(nombre: str, prioridad: int = 0) -> Callable[[Ejecutor], Ejecutor]:
+    """Registra la función que ejecuta los trabajos de un tipo"""
+    def registrar(funcion: Ejecutor) -> Ejecutor:
+        TIPOS[nombre] = TipoTrabajo(funcion, prioridad)
+        return funcion
+    return registrar
+
+
+# ----- tipos de trabajo -----
+
+@tipo_trabajo("explicacion", prioridad=10)
+async def _generar_explicacion(parametros: Dict[str, Any], imagenes: List[bytes]) -> Dict[str, Any]:
+    # Paso del formulario de una pregunta: alguien está esperando para guardarla
+    from ai_services import process_solution_images_with_ai, generate_explanation_from_question
+
+    if parametros["mode"] == "from_question":
+        result = await generate_explanation_from_question(
+            parametros["ai_service"], imagenes[0], parametros["pregunta"], parametros["respuesta_correcta"]
+        )
+    else:
+        result = await process_solution_images_with_ai(
+            parametros["ai_service"], imagenes, parametros["pregunta"], parametros["respuesta_correcta"]
+        )
+    # Los fallos llegan como {"explanation": "Error generando...", "error": ...}
+    if result.get("error"):
+        raise RuntimeError(f"Error generando explicación: {result['error']}")
+    return {"explanation": result["explanation"]}
+
+
+@tipo_trabajo("variacion", prioridad=0)
+async def _generar_variacion(parametros: Dict[str, Any], imagenes: List[bytes]) -> Dict[str, Any]:
+    from ai_variation import generate_question_variation
+
+    return await generate_question_variation(parametros["ai_service"], imagenes[0], parametros["tipo_variacion"])
+
+
+def _fecha(marca: Optional[float]) -> Optional[str]:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(marca)) if marca else None
+
+
+class ColaTrabajos:
+    """
+    Trabajos en SQLite (modo WAL: la app y los workers aparte comparten el
+    archivo). Los avisos entre corrutinas del mismo proceso despiertan al
+    momento a workers y suscriptores; los de otros procesos se ven al
+    consultar la base cada JOBS_POLL_INTERVAL.
+    """
+
+    def __init__(self, path: RutaArchivo = JOBS_DB_PATH):
+        self.path = Path(path)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._cambio: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+        self._ultima_purga = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        # Con self._lock tomado
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id TEXT PRIMARY KEY,
+                    tipo TEXT NOT NULL,
+                    prioridad INTEGER NOT NULL,
+                    estado TEXT NOT NULL,
+                    parametros TEXT NOT NULL,
+                    resultado TEXT,
+                    error TEXT,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    creado REAL NOT NULL,
+                    iniciado REAL,
+                    terminado REAL,
+                    plazo REAL
+                );
+                CREATE INDEX IF NOT EXISTS trabajos_cola ON trabajos (estado, prioridad DESC, creado);
+                CREATE TABLE IF NOT EXISTS imagenes (
+                    trabajo TEXT NOT NULL,
+                    posicion INTEGER NOT NULL,
+                    contenido BLOB NOT NULL,
+                    PRIMARY KEY (trabajo, posicion)
+                );
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    # ----- avisos dentro del proceso -----
+
+    def _notificar(self) -> None:
+        if self._cambio is not None:
+            self._cambio.set()
+        self._cambio = asyncio.Event()
+
+    async def _esperar_cambio(self, timeout: float) -> None:
+        if self._cambio is None:
+            self._cambio = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._cambio.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # ----- operaciones bloqueantes (en el pool de almacenamiento) -----
+
+    def _insertar(self, trabajo_id: str, tipo: str, prioridad: int, parametros: Dict[str, Any], imagenes: List[bytes]) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    "INSERT INTO trabajos (id, tipo, prioridad, estado, parametros, creado) VALUES (?, ?, ?, 'pendiente', ?, ?)",
+                    (trabajo_id, tipo, prioridad, json.dumps(parametros, ensure_ascii=False), time.time()),
+                )
+                db.executemany(
+                    "INSERT INTO imagenes (trabajo, posicion, contenido) VALUES (?, ?, ?)",
+                    [(trabajo_id, i, sqlite3.Binary(contenido)) for i, contenido in enumerate(imagenes)],
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+
+    def _tomar(self, tipos: List[str]) -> Optional[Tuple[str, str, Dict[str, Any], List[bytes], int, float]]:
+        """Reserva el siguiente trabajo (pendiente o abandonado) para este worker"""
+        ahora = time.time()
+        marcas = ",".join("?" * len(tipos))
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                agotados = [fila[0] for fila in db.execute(
+                    "SELECT id FROM trabajos WHERE estado = 'en_curso' AND plazo < ? AND intentos >= ?",
+                    (ahora, JOBS_MAX_ATTEMPTS),
+                )]
+                for trabajo_id in agotados:
+                    db.execute(
+                        "UPDATE trabajos SET estado = 'error', error = ?, terminado = ? WHERE id = ?",
+                        (f"El trabajo se interrumpió {JOBS_MAX_ATTEMPTS} veces sin terminar", ahora, trabajo_id),
+                    )
+                    db.execute("DELETE FROM imagenes WHERE trabajo = ?", (trabajo_id,))
+                fila = db.execute(
+                    f"""SELECT id, tipo, parametros, intentos, creado FROM trabajos
+                        WHERE tipo IN ({marcas}) AND (estado = 'pendiente' OR (estado = 'en_curso' AND plazo < ?))
+                        ORDER BY prioridad DESC, creado LIMIT 1""",
+                    (*tipos, ahora),
+                ).fetchone()
+                if fila is None:
+                    db.execute("COMMIT")
+                    return None
+                trabajo_id, tipo, parametros, intentos, creado = fila
+                db.execute(
+                    "UPDATE trabajos SET estado = 'en_curso', intentos = ?, iniciado = ?, plazo = ? WHERE id = ?",
+                    (intentos + 1, ahora, ahora + JOBS_LEASE_SECONDS, trabajo_id),
+                )
+                imagenes = [bytes(c) for (c,) in db.execute(
+                    "SELECT contenido FROM imagenes WHERE trabajo = ? ORDER BY posicion", (trabajo_id,)
+                )]
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if agotados:
+            logger.warning(f"⚠️ {len(agotados)} trabajo(s) abandonados demasiadas veces", extra={"campos": {"ids": agotados}})
+        return trabajo_id, tipo, json.loads(parametros), imagenes, intentos + 1, ahora - creado
+
+    def _terminar(self, trabajo_id: str, intento: int, estado: str, resultado: Optional[Dict[str, Any]], error: Optional[str]) -> bool:
+        """Guarda el resultado si el trabajo sigue siendo de este intento (no lo retomó otro worker)"""
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = db.execute(
+                    """UPDATE trabajos SET estado = ?, resultado = ?, error = ?, terminado = ?, plazo = NULL
+                       WHERE id = ? AND estado = 'en_curso' AND intentos = ?""",
+                    (estado, json.dumps(resultado, ensure_ascii=False) if resultado is not None else None,
+                     error, time.time(), trabajo_id, intento),
+                )
+                if cursor.rowcount:
+                    db.execute("DELETE FROM imagenes WHERE trabajo = ?", (trabajo_id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return bool(cursor.rowcount)
+
+    def _devolver(self, trabajo_id: str, intento: int) -> None:
+        """Devuelve a la cola un trabajo interrumpido por el apagado (no cuenta como intento)"""
+        with self._lock:
+            self._db().execute(
+                """UPDATE trabajos SET estado = 'pendiente', intentos = intentos - 1, iniciado = NULL, plazo = NULL
+                   WHERE id = ? AND estado = 'en_curso' AND intentos = ?""",
+                (trabajo_id, intento),
+            )
+
+    def _leer(self, trabajo_id: str) -> Dict[str, Any]:
+        with self._lock:
+            db = self._db()
+            fila = db.execute(
+                """SELECT id, tipo, prioridad, estado, resultado, error, intentos, creado, iniciado, terminado
+                   FROM trabajos WHERE id = ?""",
+                (trabajo_id,),
+            ).fetchone()
+            if fila is None:
+                raise KeyError(trabajo_id)
+            trabajo_id, tipo, prioridad, estado, resultado, error, intentos, creado, iniciado, terminado = fila
+            trabajo = {
+                "id": trabajo_id,
+                "tipo": tipo,
+                "estado": estado,
+                "prioridad": prioridad,
+                "intentos": intentos,
+                "creado": _fecha(creado),
+                "iniciado": _fecha(iniciado),
+                "terminado": _fecha(terminado),
+            }
+            if estado == "pendiente":
+                # Trabajos que se tomarán antes que este
+                trabajo["posicion"] = db.execute(
+                    """SELECT COUNT(*) FROM trabajos WHERE estado = 'pendiente'
+                       AND (prioridad > ? OR (prioridad = ? AND creado < ?))""",
+                    (prioridad, prioridad, creado),
+                ).fetchone()[0]
+        if resultado is not None:
+            trabajo["resultado"] = json.loads(resultado)
+        if error is not None:
+            trabajo["error"] = error
+        return trabajo
+
+    def purgar(self) -> int:
+        """Borra los trabajos terminados hace más de JOBS_RETENTION_HOURS"""
+        limite = time.time() - JOBS_RETENTION_HOURS * 3600
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    """DELETE FROM imagenes WHERE trabajo IN
+                       (SELECT id FROM trabajos WHERE estado IN ('listo', 'error') AND terminado < ?)""",
+                    (limite,),
+                )
+                borrados = db.execute(
+                    "DELETE FROM trabajos WHERE estado IN ('listo', 'error') AND terminado < ?", (limite,)
+                ).rowcount
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if borrados:
+            logger.info(f"🧹 {borrados} trabajo(s) terminados purgados de la cola")
+        return borrados
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            filas = self._db().execute(
+                "SELECT tipo, estado, COUNT(*) FROM trabajos GROUP BY tipo, estado"
+            ).fetchall()
+        por_tipo: Dict[str, Dict[str, int]] = {}
+        for tipo, estado, total in filas:
+            por_tipo.setdefault(tipo, {})[estado] = total
+        return {
+            "por_tipo": por_tipo,
+            "workers": len(self._workers),
+            "lease_segundos": JOBS_LEASE_SECONDS,
+            "retencion_horas": JOBS_RETENTION_HOURS,
+        }
+
+    # ----- API -----
+
+    async def encolar(
+        self, tipo: str, parametros: Dict[str, Any], imagenes: List[bytes], prioridad: Optional[int] = None
+    ) -> str:
+        """Guarda un trabajo y devuelve su id (la prioridad por defecto es la del tipo)"""
+        if tipo not in TIPOS:
+            raise ValueError(f"Tipo de trabajo desconocido: {tipo}")
+        trabajo_id = uuid.uuid4().hex
+        await run_storage(
+            self._insertar, trabajo_id, tipo,
+            TIPOS[tipo].prioridad if prioridad is None else prioridad, parametros, imagenes,
+        )
+        logger.info(f"📥 Trabajo {tipo} encolado", extra={"campos": {"job_id": trabajo_id}})
+        self._notificar()
+        return trabajo_id
+
+    async def obtener(self, trabajo_id: str) -> Dict[str, Any]:
+        """Estado del trabajo y su resultado si terminó; KeyError si no existe"""
+        return await run_storage(self._leer, trabajo_id)
+
+    async def seguir(self, trabajo_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """El trabajo cada vez que cambia su estado o su posición, hasta que termina"""
+        anterior = None
+        while True:
+            trabajo = await self.obtener(trabajo_id)
+            clave = (trabajo["estado"], trabajo.get("posicion"))
+            if clave != anterior:
+                anterior = clave
+                yield trabajo
+            if trabajo["estado"] in ESTADOS_TERMINALES:
+                return
+            await self._esperar_cambio(JOBS_POLL_INTERVAL)
+
+    async def _ejecutar(self, trabajo_id: str, tipo: str, parametros: Dict[str, Any], imagenes: List[bytes], intento: int) -> None:
+        inicio = time.perf_counter()
+        try:
+            resultado = await TIPOS[tipo].ejecutar(parametros, imagenes)
+        except asyncio.CancelledError:
+            await run_storage(self._devolver, trabajo_id, intento)
+            raise
+        except Exception as e:
+            logger.error(f"❌ Trabajo {tipo} {trabajo_id} falló: {e}")
+            guardado = await run_storage(self._terminar, trabajo_id, intento, "error", None, str(e))
+            salida = "error"
+        else:
+            guardado = await run_storage(self._terminar, trabajo_id, intento, "listo", resultado, None)
+            salida = "ok"
+        duracion = time.perf_counter() - inicio
+        job_duration.observe(duracion, tipo=tipo, fase="ejecucion")
+        if not guardado:
+            # Venció el plazo y otro worker lo retomó: su resultado es el que vale
+            salida = "descartado"
+        jobs.inc(tipo=tipo, outcome=salida)
+        logger.info(
+            f"📤 Trabajo {tipo} terminado en {duracion:.1f}s",
+            extra={"campos": {"job_id": trabajo_id, "outcome": salida, "intento": intento}},
+        )
+        self._notificar()
+
+    async def _worker(self, numero: int) -> None:
+        tipos = list(TIPOS)
+        while True:
+            if numero == 0 and time.time() - self._ultima_purga > 3600:
+                self._ultima_purga = time.time()
+                await run_storage(self.purgar)
+            try:
+                tomado = await run_storage(self._tomar, tipos)
+            except sqlite3.Error as e:
+                logger.error(f"❌ Error leyendo la cola de trabajos: {e}")
+                tomado = None
+            if tomado is None:
+                await self._esperar_cambio(JOBS_POLL_INTERVAL)
+                continue
+            trabajo_id, tipo, parametros, imagenes, intento, espera = tomado
+            job_duration.observe(espera, tipo=tipo, fase="espera")
+            self._notificar()  # pendiente -> en_curso
+            await self._ejecutar(trabajo_id, tipo, parametros, imagenes, intento)
+
+    def iniciar(self, workers: int = JOBS_WORKERS) -> None:
+        """Arranca el pool de workers en el loop actual"""
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(workers)]
+        if workers:
+            logger.info(f"⚙️ Cola de trabajos: {workers} worker(s)")
+
+    async def detener(self) -> None:
+        """Detiene los workers; los trabajos a medias vuelven a la cola"""
+        for tarea in self._workers:
+            tarea.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+cola_trabajos = ColaTrabajos()
+
+
+async def _worker_independiente(workers: int) -> None:
+    from app_logging import configurar_logging, detener_logging
+    from http_client import close_http_client, init_http_client
+    from storage_pool import shutdown_storage_pool
+
+    configurar_logging()
+    await init_http_client()
+    cola_trabajos.iniciar(workers)
+    try:
+        await asyncio.gather(*cola_trabajos._workers)
+    finally:
+        await cola_trabajos.detener()
+        await close_http_client()
+        shutdown_storage_pool()
+        detener_logging()
+
+
+def main(argv: List[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cola de trabajos de IA")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    worker = sub.add_parser("worker", help="Procesa trabajos de la cola en un proceso aparte de la app")
+    worker.add_argument("--workers", type=int, default=max(1, JOBS_WORKERS))
+    sub.add_parser("estado", help="Trabajos por tipo y estado")
+    sub.add_parser("purgar", help="Borra los trabajos terminados más antiguos que JOBS_RETENTION_HOURS")
+    args = parser.parse_args(argv)
+
+    if args.comando == "worker":
+        try:
+            asyncio.run(_worker_independiente(args.workers))
+        except KeyboardInterrupt:
+            pass
+    elif args.comando == "estado":
+        print(json.dumps(cola_trabajos.get_stats(), ensure_ascii=False, indent=2))
+    else:
+        print(f"{cola_trabajos.purgar()} trabajo(s) purgados")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
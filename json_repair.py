@@ -0,0 +1,528 @@
+"""
+Parser JSON tolerante para respuestas de modelos de IA.
+
+Reemplaza a las tres copias de `extract_json` (ai_services.py, ai_variation.py y
+generador_batch/generar_sinteticas.py). En lugar de encadenar regex y varios
+intentos de json.loads, la respuesta se recorre UNA sola vez con una máquina de
+estados que produce texto JSON válido, y se parsea con json.loads al final.
+El tiempo es lineal en el tamaño de la entrada: ninguna regex retrocede
+(solo se usan clases de caracteres para saltar al siguiente carácter especial)
+y cada mirada hacia adelante recorre únicamente espacios en blanco o letras.
+
+Qué repara:
+- Bloques ```json ... ``` y texto antes/después del JSON
+- Backslashes de LaTeX sin escapar (\\frac, \\sqrt, \\theta, \\(, \\{ ...)
+- Comillas tipográficas usadas como delimitadores (“clave”: “valor”)
+- Comillas dobles sin escapar dentro de un string ("dijo "hola" y se fue")
+- Saltos de línea, tabs y caracteres de control crudos dentro de strings
+- Comas finales ({"a": 1,})
+- Salida truncada: cierra strings, completa claves sin valor y cierra llaves/corchetes
+- Objetos sueltos separados por comas o saltos de línea ({...}, {...}) -> lista
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from app_logging import get_logger, volcar_payload
+from metrics import json_parse
+
+logger = get_logger(__name__)
+
+# Comandos LaTeX que empiezan con una letra que también es escape JSON (\b \f \n \r \t).
+# "\frac" es LaTeX, pero "\nentonces" es un salto de línea seguido de "entonces".
+_LATEX_AMBIGUOS = {
+    "b": {"beta", "bar", "binom", "boxed", "begin", "big", "bigg", "bigl", "bigr", "bmod", "bot", "bullet", "because", "bf", "breve"},
+    "f": {"frac", "forall", "flat", "frown", "fbox"},
+    "n": {"neq", "ne", "nu", "nabla", "not", "neg", "ni", "notin", "newline", "nleq", "ngeq", "nmid", "nexists", "natural"},
+    "r": {"right", "rightarrow", "rho", "rangle", "rceil", "rfloor", "rm", "rbrace", "rvert", "rVert", "rightleftharpoons"},
+    "t": {
+        "theta", "times", "tan", "tanh", "text", "textbf", "textit", "textrm", "to", "tau", "triangle",
+        "top", "tfrac", "therefore", "tilde", "textstyle", "tiny", "triangleq",
+    },
+}
+
+_ESCAPES_SIMPLES = {'"', "\\", "/"}
+_HEX = set("0123456789abcdefABCDEF")
+_COMILLAS_TIPOGRAFICAS = {"“", "”"}  # “ ”
+
+# Siguiente carácter especial dentro / fuera de un string (clases de caracteres: sin retroceso)
+_ESPECIAL_EN_STRING = re.compile('[\x00-\x1f"\\\\“”]')
+_ESPECIAL_FUERA = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f"{}\\[\\],:“”]')
+_INICIO_VALOR = re.compile(r"[{\[]")
+_NO_ESPACIO = re.compile(r"\S")
+_LETRAS = re.compile(r"[A-Za-z]+")
+_FENCE_INICIO = re.compile(r"^```+(?:json)?\s*", re.IGNORECASE)
+_FENCE_FIN = re.compile(r"```+\s*$")
+# Un backslash seguido de \b \f \n \r \t y una letra puede ser LaTeX mal escapado
+_ESCAPE_SOSPECHOSO = re.compile(r"\\[bfnrt][A-Za-z]")
+
+_CONTROL_EN_STRING = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+
+
+def _siguiente_no_espacio(text: str, pos: int) -> int:
+    m = _NO_ESPACIO.search(text, pos)
+    return m.start() if m else len(text)
+
+
+def comilla_cierra(text: str, pos: int, final: bool = True) -> Optional[bool]:
+    """
+    Decide si la comilla en `pos` cierra el string o es una comilla interna sin
+    escapar, mirando el siguiente carácter significativo. Con final=False (texto
+    que aún está llegando por streaming) devuelve None si hace falta más texto.
+    """
+    n = len(text)
+    j = _siguiente_no_espacio(text, pos + 1)
+    if j >= n:
+        return True if final else None
+    c = text[j]
+    if c in "}]:\"“”":
+        return True
+    if c == ",":
+        k = _siguiente_no_espacio(text, j + 1)
+        if k >= n:
+            return True if final else None
+        d = text[k]
+        if not final and d in "tfn" and n - k < 5:
+            return None
+        return d in "\"“”{[}]-" or d.isdigit() or text.startswith(("true", "false", "null"), k)
+    return False
+
+
+def _completar_escalar(resto: str) -> str:
+    """Escalar truncado: "tru" -> "true", "3." -> "3"; "" si no queda nada válido"""
+    valor = resto.strip()
+    for literal in ("true", "false", "null"):
+        if literal.startswith(valor):
+            return literal
+    return valor.rstrip(".eE+-")
+
+
+def _quitar_coma_final(out: List[str]) -> None:
+    """Elimina una coma colgante antes de un cierre (trozos de espacio incluidos)"""
+    i = len(out) - 1
+    while i >= 0 and (not out[i] or out[i].isspace()):
+        i -= 1
+    if i < 0:
+        return
+    chunk = out[i]
+    j = len(chunk) - 1
+    while chunk[j].isspace():
+        j -= 1
+    if chunk[j] == ",":
+        out[i] = chunk[:j]
+        del out[i + 1:]
+
+
+class _Marco:
+    """Contenedor abierto: '{' o '[' y qué se espera a continuación"""
+    __slots__ = ("tipo", "espera")
+
+    def __init__(self, tipo: str):
+        self.tipo = tipo
+        # objeto: clave -> dos_puntos -> valor -> despues ; lista: valor -> despues
+        self.espera = "clave" if tipo == "{" else "valor"
+
+
+def reparar_json(text: str) -> str:
+    """
+    Recorre `text` una vez y devuelve texto JSON válido (si la estructura es
+    recuperable). Si hay varios valores de nivel superior se devuelven como lista.
+    """
+    n = len(text)
+    out: List[str] = []
+    pila: List[_Marco] = []
+    abiertos = {"{": 0, "[": 0}  # evita recorrer la pila para saber si un cierre tiene apertura
+    valores = 0
+    pos = 0
+
+    while pos < n:
+        if not pila:
+            if valores:
+                # Otro valor solo si sigue a continuación ({...}, {...} o {...}\n{...});
+                # un texto explicativo después del JSON (con LaTeX como \frac{1}{2}) se ignora
+                j = _siguiente_no_espacio(text, pos)
+                while j < n and text[j] == ",":
+                    j = _siguiente_no_espacio(text, j + 1)
+                if j >= n or text[j] != "{":
+                    break
+                out.append(",")
+                pos = j
+            else:
+                # Texto antes del JSON: saltar hasta el primer { o [
+                m = _INICIO_VALOR.search(text, pos)
+                if not m:
+                    break
+                pos = m.start()
+            valores += 1
+            c = text[pos]
+            out.append(c)
+            pila.append(_Marco(c))
+            abiertos[c] += 1
+            pos += 1
+            continue
+
+        m = _ESPECIAL_FUERA.search(text, pos)
+        if not m:
+            resto = text[pos:]
+            if pila[-1].espera == "valor" and not resto.isspace():
+                # Número o true/false/null cortado al final de la entrada
+                resto = _completar_escalar(resto)
+                if resto:
+                    pila[-1].espera = "despues"
+            out.append(resto)
+            pos = n
+            break
+        if m.start() > pos:
+            out.append(text[pos:m.start()])
+            if pila[-1].espera == "valor" and not text[pos:m.start()].isspace():
+                pila[-1].espera = "despues"  # número o true/false/null
+        c = m.group()
+        pos = m.end()
+        top = pila[-1]
+
+        if c in "{[":
+            if top.tipo == "[" and top.espera == "despues":
+                out.append(",")  # [{...}{...}]
+            out.append(c)
+            top.espera = "despues"
+            pila.append(_Marco(c))
+            abiertos[c] += 1
+        elif c in "}]":
+            buscado = "{" if c == "}" else "["
+            if not abiertos[buscado]:
+                continue  # cierre sin apertura: se ignora
+            while pila:
+                marco = pila.pop()
+                abiertos[marco.tipo] -= 1
+                if marco.espera == "dos_puntos":
+                    out.append(": null")
+                elif marco.espera == "valor" and marco.tipo == "{":
+                    out.append("null")
+                _quitar_coma_final(out)
+                out.append("}" if marco.tipo == "{" else "]")
+                if marco.tipo == buscado:
+                    break
+        elif c == ",":
+            if top.espera == "clave" or (top.tipo == "[" and top.espera == "valor"):
+                continue  # coma duplicada o al inicio
+            if top.espera == "dos_puntos":
+                out.append(": null")
+            elif top.espera == "valor":
+                out.append("null")
+            out.append(",")
+            top.espera = "clave" if top.tipo == "{" else "valor"
+        elif c == ":":
+            out.append(":")
+            if top.tipo == "{":
+                top.espera = "valor"
+        elif c == '"' or c in _COMILLAS_TIPOGRAFICAS:
+            if top.tipo == "{" and top.espera == "despues":
+                out.append(",")  # falta la coma entre miembros
+                top.espera = "clave"
+            elif top.tipo == "[" and top.espera == "despues":
+                out.append(",")
+            es_clave = top.tipo == "{" and top.espera == "clave"
+            pos, cerrado = _copiar_string(text, pos, out, tipografica=c != '"')
+            if not cerrado:
+                # String truncado: una clave sin valor se completa con null
+                if es_clave:
+                    out.append(": null")
+                top.espera = "despues"
+                break
+            top.espera = "dos_puntos" if es_clave else "despues"
+        # caracteres de control fuera de strings: se descartan
+
+    # Entrada truncada: completar y cerrar lo que quedó abierto
+    while pila:
+        marco = pila.pop()
+        if marco.espera == "dos_puntos":
+            out.append(": null")
+        elif marco.espera == "valor" and marco.tipo == "{":
+            out.append("null")
+        _quitar_coma_final(out)
+        out.append("}" if marco.tipo == "{" else "]")
+
+    reparado = "".join(out)
+    if valores > 1:
+        return "[" + reparado + "]"
+    return reparado
+
+
+def _copiar_string(text: str, pos: int, out: List[str], tipografica: bool) -> Tuple[int, bool]:
+    """
+    Copia el contenido de un string (pos está justo después de la comilla de
+    apertura) escapando lo necesario. Devuelve (posición tras el cierre, cerrado).
+    """
+    n = len(text)
+    out.append('"')
+    while True:
+        m = _ESPECIAL_EN_STRING.search(text, pos)
+        if not m:
+            out.append(text[pos:])
+            out.append('"')
+            return n, False
+        if m.start() > pos:
+            out.append(text[pos:m.start()])
+        c = m.group()
+        i = m.start()
+        pos = i + 1
+
+        if c == "\\":
+            if pos >= n:
+                out.append("\\\\")
+                continue
+            d = text[pos]
+            if d in _ESCAPES_SIMPLES:
+                out.append("\\" + d)
+                pos += 1
+            elif d == "u" and len(text[pos + 1:pos + 5]) == 4 and all(ch in _HEX for ch in text[pos + 1:pos + 5]):
+                out.append(text[i:pos + 5])
+                pos += 5
+            elif d in _LATEX_AMBIGUOS:
+                palabra = _LETRAS.match(text, pos)
+                nombre = palabra.group() if palabra else d
+                if nombre in _LATEX_AMBIGUOS[d]:
+                    out.append("\\\\")  # LaTeX: backslash literal, el comando sigue como texto
+                else:
+                    out.append("\\" + d)
+                    pos += 1
+            else:
+                out.append("\\\\")  # \sqrt, \( , \{ ... : backslash literal
+        elif c == '"' or c in _COMILLAS_TIPOGRAFICAS:
+            cierra = (c == '"' or tipografica) and comilla_cierra(text, i)
+            if cierra:
+                out.append('"')
+                return pos, True
+            out.append('\\"' if c == '"' else c)
+        elif c in _CONTROL_EN_STRING:
+            out.append(_CONTROL_EN_STRING[c])
+        # otros caracteres de control: se descartan
+
+
+def _limpiar_fences(text: str) -> str:
+    cleaned = _FENCE_INICIO.sub("", text.strip())
+    return _FENCE_FIN.sub("", cleaned).strip()
+
+
+def cargar_json_tolerante(text: str) -> Any:
+    """
+    Parsea la respuesta de un modelo. Usa json.loads directamente si el texto ya
+    es JSON válido y sin backslashes ambiguos; si no, lo repara en una pasada.
+    Lanza json.JSONDecodeError (subclase de ValueError) si no es recuperable.
+    """
+    cleaned = _limpiar_fences(text or "")
+    if not cleaned:
+        raise ValueError("Respuesta vacía de la API.")
+
+    if not _ESCAPE_SOSPECHOSO.search(cleaned):
+        try:
+            value = json.loads(cleaned)
+            json_parse.inc(path="direct")
+            return value
+        except (json.JSONDecodeError, RecursionError):
+            pass
+
+    reparado = reparar_json(cleaned)
+    if not reparado:
+        json_parse.inc(path="error")
+        raise json.JSONDecodeError("No se encontró un objeto JSON en la respuesta", cleaned, 0)
+    try:
+        value = json.loads(reparado)
+        json_parse.inc(path="repaired")
+        return value
+    except RecursionError:
+        json_parse.inc(path="error")
+        raise json.JSONDecodeError("Anidamiento demasiado profundo", reparado, 0) from None
+    except json.JSONDecodeError as e:
+        json_parse.inc(path="error")
+        inicio = max(0, e.pos - 100)
+        ruta = volcar_payload("json_no_reparable", text, forzar=True)
+        logger.error(
+            f"❌ Error parseando JSON después de reparar: {e} (original en {ruta})",
+            extra={"campos": {"contexto": reparado[inicio:e.pos + 100]}},
+        )
+        raise
+
+
+def extract_json(text: str, allow_single: bool = True, list_key: str = "preguntas") -> Dict[str, Any]:
+    """
+    Extrae el JSON de la respuesta de la IA.
+
+    - Una lista de nivel superior (o varios objetos sueltos) se devuelve como
+      {list_key: [...]}.
+    - Con allow_single=False, un único objeto con "pregunta" (el modelo olvidó
+      el envoltorio) también se envuelve en {list_key: [objeto]}.
+    """
+    value = cargar_json_tolerante(text)
+    if isinstance(value, list):
+        return {list_key: value}
+    if (
+        not allow_single
+        and isinstance(value, dict)
+        and list_key not in value
+        and "pregunta" in value
+    ):
+        logger.info(f"⚠️ Detectado: respuesta es objeto individual, se envuelve en '{list_key}'")
+        return {list_key: [value]}
+    if not isinstance(value, dict):
+        raise ValueError(f"Se esperaba un objeto JSON, se obtuvo {type(value).__name__}")
+    return value
+
+
+def _decodificar_valor(raw: str) -> Any:
+    """Decodifica un valor suelto (string, número, objeto...) de forma tolerante"""
+    raw = raw.strip()
+    if not _ESCAPE_SOSPECHOSO.search(raw):
+        try:
+            return json.loads(raw)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+    return json.loads(reparar_json("[" + raw + "]"))[0]
+
+
+class _MarcoIncremental:
+    __slots__ = ("tipo", "espera", "clave", "inicio", "ruta")
+
+    def __init__(self, tipo: str, ruta: Optional[List[str]]):
+        self.tipo = tipo
+        self.espera = "clave" if tipo == "{" else "valor"
+        self.clave: Optional[str] = None
+        self.inicio: Optional[int] = None  # inicio del valor en curso (objetos)
+        self.ruta = ruta  # None dentro de listas: sus campos no se emiten
+
+
+class ParserIncremental:
+    """
+    Parser para respuestas que llegan por streaming. `feed` recibe cada trozo
+    de texto y devuelve los campos cuyo valor ya está completo como pares
+    (ruta, valor): "pregunta", "opciones.A", "opciones", ... hasta
+    `profundidad` niveles de objetos anidados.
+
+    Cada carácter se examina una sola vez entre llamadas (salvo una comilla al
+    final de un trozo, que espera al siguiente para decidir si cierra el string).
+    Los valores emitidos son una vista previa: el resultado definitivo se
+    obtiene con extract_json sobre el texto completo.
+    """
+
+    def __init__(self, profundidad: int = 2):
+        self.profundidad = profundidad
+        self.texto = ""
+        self._pos = 0
+        self._pila: List[_MarcoIncremental] = []
+        self._en_string = False
+        self._inicio_string = 0
+        self._terminado = False
+
+    def feed(self, trozo: str) -> List[Tuple[str, Any]]:
+        self.texto += trozo
+        return self._avanzar(final=False)
+
+    def close(self) -> List[Tuple[str, Any]]:
+        return self._avanzar(final=True)
+
+    def _emitir(self, marco: _MarcoIncremental, fin: int, eventos: List[Tuple[str, Any]]) -> None:
+        inicio = marco.inicio
+        marco.inicio = None
+        marco.espera = "despues"
+        if marco.ruta is None or marco.clave is None or len(marco.ruta) >= self.profundidad:
+            return
+        try:
+            valor = _decodificar_valor(self.texto[inicio:fin])
+        except (ValueError, IndexError):
+            return
+        eventos.append((".".join(marco.ruta + [marco.clave]), valor))
+
+    def _cerrar_literal(self, marco: _MarcoIncremental, fin: int, eventos: List[Tuple[str, Any]]) -> None:
+        if marco.tipo == "{" and marco.espera == "valor" and marco.inicio is not None:
+            self._emitir(marco, fin, eventos)
+
+    def _avanzar(self, final: bool) -> List[Tuple[str, Any]]:
+        t = self.texto
+        n = len(t)
+        i = self._pos
+        eventos: List[Tuple[str, Any]] = []
+
+        while i < n and not self._terminado:
+            if self._en_string:
+                m = _ESPECIAL_EN_STRING.search(t, i)
+                if not m:
+                    i = n
+                    break
+                i = m.start()
+                c = t[i]
+                if c == "\\":
+                    if i + 1 >= n and not final:
+                        break
+                    i += 2
+                    continue
+                if c == '"':
+                    cierra = comilla_cierra(t, i, final)
+                    if cierra is None:
+                        break  # esperar más texto para decidir
+                    if cierra:
+                        self._en_string = False
+                        self._fin_string(i + 1, eventos)
+                i += 1
+                continue
+
+            c = t[i]
+            if not self._pila:
+                if c == "{":
+                    self._pila.append(_MarcoIncremental("{", []))
+                i += 1
+                continue
+
+            top = self._pila[-1]
+            if c == '"':
+                self._en_string = True
+                self._inicio_string = i
+                if top.tipo == "{" and top.espera == "valor":
+                    top.inicio = i
+            elif c in "{[":
+                ruta = None
+                if top.tipo == "{" and top.espera == "valor":
+                    top.inicio = i
+                    if top.ruta is not None and top.clave is not None:
+                        ruta = top.ruta + [top.clave]
+                self._pila.append(_MarcoIncremental(c, ruta))
+            elif c in "}]":
+                self._cerrar_literal(top, i, eventos)
+                self._pila.pop()
+                if not self._pila:
+                    self._terminado = True
+                else:
+                    padre = self._pila[-1]
+                    if padre.tipo == "{" and padre.espera == "valor" and padre.inicio is not None:
+                        self._emitir(padre, i + 1, eventos)
+                    elif padre.tipo == "[":
+                        padre.espera = "despues"
+            elif c == ":":
+                if top.tipo == "{":
+                    top.espera = "valor"
+                    top.inicio = None
+            elif c == ",":
+                self._cerrar_literal(top, i, eventos)
+                top.espera = "clave" if top.tipo == "{" else "valor"
+            elif not c.isspace() and top.tipo == "{" and top.espera == "valor" and top.inicio is None:
+                top.inicio = i  # número o true/false/null
+            i += 1
+
+        self._pos = i
+        if final and self._pila and not self._en_string:
+            self._cerrar_literal(self._pila[-1], n, eventos)
+        return eventos
+
+    def _fin_string(self, fin: int, eventos: List[Tuple[str, Any]]) -> None:
+        top = self._pila[-1]
+        if top.tipo != "{":
+            return
+        if top.espera == "clave":
+            raw = self.texto[self._inicio_string:fin]
+            try:
+                top.clave = json.loads(raw)
+            except json.JSONDecodeError:
+                top.clave = raw.strip('"')
+            top.espera = "dos_puntos"
+        elif top.espera == "valor" and top.inicio is not None:
+            self._emitir(top, fin, eventos)
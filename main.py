@@ -1,20 +1,91 @@
 from fastapi import FastAPI, Form, File, UploadFile, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi import Request
 from typing import Optional, List
+from contextlib import asynccontextmanager
+import asyncio
 import json
 import os
-import shutil
-import re
+import time
 from pathlib import Path
 from pydantic import BaseModel
-from utils import normalizar_texto, obtener_siguiente_numero, guardar_pregunta_json
+from utils import normalizar_texto, guardar_pregunta_json, reservar_id_temporal, siguiente_numero_texto
+from atomic_io import bloqueo_archivo_async, escribir_atomico
+from storage_pool import run_storage, shutdown_storage_pool
+from question_store import question_store
 from models import PreguntaRequest, PreguntaResponse
-from ai_services import process_image_with_ai
-
-app = FastAPI(title="Banco de Preguntas Preuniversitarias", version="1.0.0")
+from ai_services import process_images_with_ai
+from ai_streaming import stream_extraction
+from ai_router import SinProveedorError
+from question_index import LIMITE_MAXIMO, indice_preguntas, leer_archivos_banco
+from near_dup import indice_duplicados
+from figure_index import FIGURE_SHORTCUT, indice_figuras
+from bulk_import import (
+    LoteDemasiadoGrandeError, LoteInvalidoError, borrar_lote, cancelar_importaciones, iniciar_importacion, leer_lote,
+    leer_subida, progreso, ruta_imagen,
+)
+from search_index import search_index
+from job_queue import ESTADOS_TERMINALES, cola_trabajos
+from http_client import init_http_client, close_http_client
+from metrics import http_request_duration, http_requests, registry
+from app_logging import configurar_logging, detener_logging, get_logger, nuevo_request_id
+
+logger = get_logger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Logging por cola: los handlers escriben desde su propio hilo
+    configurar_logging()
+    # Cliente HTTP con pool de conexiones compartido por todos los proveedores de IA
+    await init_http_client()
+    # Índice en memoria para GET /api/preguntas y el de casi duplicados (se mantienen al día en cada guardado)
+    archivos_banco = await run_storage(leer_archivos_banco)
+    await run_storage(indice_preguntas.cargar, archivos_banco)
+    await run_storage(indice_duplicados.cargar, archivos_banco)
+    # Huellas de las figuras: solo se calculan las de imágenes nuevas o modificadas
+    await run_storage(indice_figuras.sincronizar, archivos_banco)
+    del archivos_banco  # no retener el banco completo mientras la app corre
+    # Búsqueda de texto completo: solo se reindexan los archivos que cambiaron
+    await run_storage(search_index.sincronizar)
+    # Workers de la cola de trabajos de IA (explicaciones, variaciones); retoman los pendientes
+    cola_trabajos.iniciar()
+    yield
+    await cola_trabajos.detener()
+    await cancelar_importaciones()
+    await close_http_client()
+    # JSON de temas con exportación diferida pendiente
+    await run_storage(question_store.exportar_pendientes)
+    shutdown_storage_pool()
+    detener_logging()
+
+app = FastAPI(title="Banco de Preguntas Preuniversitarias", version="1.0.0", lifespan=lifespan)
+
+@app.middleware("http")
+async def medir_peticiones(request: Request, call_next):
+    """Cuenta peticiones y latencia por endpoint (plantilla de la ruta, no la URL)"""
+    inicio = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", None)
+        if endpoint is None:
+            endpoint = "/static" if request.url.path.startswith("/static/") else "sin_ruta"
+        http_requests.inc(method=request.method, endpoint=endpoint, status=str(status))
+        http_request_duration.observe(time.perf_counter() - inicio, method=request.method, endpoint=endpoint)
+
+@app.middleware("http")
+async def asignar_request_id(request: Request, call_next):
+    """Correlación: todos los logs de la petición llevan su request_id (X-Request-ID si lo envía el cliente)"""
+    request_id = nuevo_request_id(request.headers.get("X-Request-ID"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
 
 # Configurar archivos estáticos y templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -128,26 +199,21 @@ async def crear_pregunta(
             path_parts.append(materia_norm)
             materia_dir = Path(*path_parts)
 
-        # Crear directorios
+        # Crear directorios (toda la E/S de disco va al pool de almacenamiento)
         imagenes_dir = materia_dir / "imagenes"
-        materia_dir.mkdir(parents=True, exist_ok=True)
-        imagenes_dir.mkdir(exist_ok=True)
+        await run_storage(imagenes_dir.mkdir, parents=True, exist_ok=True)
         
         # Procesar imágenes si existen
         imagenes = []
+        figuras_compartidas = []
         for idx, imagen in enumerate([imagen1, imagen2], start=1):
             if imagen and imagen.filename:
-                # Obtener siguiente número para la imagen
-                siguiente_num = obtener_siguiente_numero(imagenes_dir, f"{materia_norm}_{tema_norm}")
+                # Numerar y guardar la imagen de forma atómica (una copia exacta ya guardada no se duplica)
                 extension = imagen.filename.split(".")[-1].lower()
-                nombre_imagen = f"{materia_norm}_{tema_norm}_{siguiente_num:03d}.{extension}"
-
-                # Guardar imagen
-                ruta_imagen = imagenes_dir / nombre_imagen
-                with open(ruta_imagen, "wb") as buffer:
-                    shutil.copyfileobj(imagen.file, buffer)
-
-                imagenes.append(nombre_imagen)
+                contenido = await imagen.read()
+                figura = await run_storage(indice_figuras.guardar, imagenes_dir, f"{materia_norm}_{tema_norm}", extension, contenido)
+                imagenes.append(figura["nombre"])
+                figuras_compartidas.extend(figura["compartida_con"])
         
         # Crear objeto pregunta
         opciones = {
@@ -158,26 +224,9 @@ async def crear_pregunta(
             "E": opcion_e
         }
         
-        # Obtener siguiente número para id_temporal
+        # Reservar id_temporal en el almacén de preguntas (sin releer el JSON del tema)
         archivo_json = materia_dir / f"{tema_norm}.json"
-        siguiente_num_id = 1
-        if archivo_json.exists():
-            with open(archivo_json, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if data.get("preguntas"):
-                    # Encontrar el número más alto
-                    max_num = 0
-                    prefix = f"{materia_norm[:3]}_{tema_norm[:3]}_"
-                    for p in data["preguntas"]:
-                        if p["id_temporal"].startswith(prefix):
-                            try:
-                                num = int(p["id_temporal"].split("_")[-1])
-                                max_num = max(max_num, num)
-                            except ValueError:
-                                continue
-                    siguiente_num_id = max_num + 1
-        
-        id_temporal = f"{materia_norm[:3]}_{tema_norm[:3]}_{siguiente_num_id:03d}"
+        id_temporal = await run_storage(reservar_id_temporal, archivo_json, materia_norm, tema_norm)
 
         nueva_pregunta = {
             "id_temporal": id_temporal,
@@ -199,22 +248,146 @@ async def crear_pregunta(
             nueva_pregunta["examen"] = examen if examen else None
         
         # Guardar en JSON
-        resultado = guardar_pregunta_json(archivo_json, materia_norm, tema_norm, nueva_pregunta)
+        resultado = await run_storage(guardar_pregunta_json, archivo_json, materia_norm, tema_norm, nueva_pregunta)
+        cabecera = {"materia": materia_norm, "tema": tema_norm}
+        indice_preguntas.agregar(archivo_json, cabecera, nueva_pregunta)
+        indice_figuras.vincular(archivo_json, nueva_pregunta)
+        await run_storage(search_index.indexar_pregunta, archivo_json, resultado["total_preguntas"] - 1, cabecera, nueva_pregunta)
         
         return JSONResponse(content={
             "success": True,
             "message": "Pregunta creada exitosamente",
             "pregunta": nueva_pregunta,
-            "archivo": str(archivo_json)
+            "archivo": str(archivo_json),
+            "posibles_duplicados": resultado["posibles_duplicados"],
+            "figuras_compartidas": figuras_compartidas
         })
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
+@app.get("/api/figuras/compartidas")
+async def listar_figuras_compartidas():
+    """Grupos de preguntas que usan la misma figura (copia exacta o casi igual)"""
+    grupos = await asyncio.to_thread(indice_figuras.grupos_compartidos)
+    return {"success": True, "grupos": grupos, "estadisticas": indice_figuras.get_stats()}
+
 @app.get("/api/materias")
 async def obtener_materias():
     return {"materias": MATERIAS}
 
+@app.get("/api/preguntas")
+async def listar_preguntas(
+    materia: Optional[str] = None,
+    tema: Optional[str] = None,
+    dificultad: Optional[int] = None,
+    tipo_clasificacion: Optional[str] = None,
+    area_academica: Optional[str] = None,
+    anio: Optional[str] = None,
+    tipo_proceso: Optional[str] = None,
+    fase: Optional[str] = None,
+    examen: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limite: int = 50,
+    campos: Optional[str] = None
+):
+    """
+    Consulta el banco con filtros exactos (normalizados), paginación por cursor
+    (`siguiente_cursor` de la respuesta anterior) y proyección de campos
+    (`campos=pregunta,opciones,respuesta_correcta`). Responde desde el índice en memoria.
+    """
+    if not 1 <= limite <= LIMITE_MAXIMO:
+        raise HTTPException(status_code=400, detail=f"limite debe estar entre 1 y {LIMITE_MAXIMO}")
+
+    filtros = {
+        "materia": materia, "tema": tema, "dificultad": dificultad,
+        "tipo_clasificacion": tipo_clasificacion, "area_academica": area_academica,
+        "anio": anio, "tipo_proceso": tipo_proceso, "fase": fase, "examen": examen,
+    }
+    lista_campos = [c.strip() for c in campos.split(",") if c.strip()] if campos else None
+
+    try:
+        pagina = indice_preguntas.consultar(filtros, cursor=cursor, limite=limite, campos=lista_campos)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"success": True, **pagina}
+
+@app.get("/api/buscar")
+async def buscar_preguntas(
+    q: str,
+    materia: Optional[str] = None,
+    origen: Optional[str] = None,
+    limite: int = 20
+):
+    """
+    Búsqueda de texto completo (BM25) en enunciados, opciones y explicaciones,
+    con tildes y LaTeX normalizados. `origen`: "banco" o "generador".
+    """
+    if not 1 <= limite <= 100:
+        raise HTTPException(status_code=400, detail="limite debe estar entre 1 y 100")
+    if origen not in (None, "banco", "generador"):
+        raise HTTPException(status_code=400, detail="origen debe ser 'banco' o 'generador'")
+
+    inicio = time.perf_counter()
+    resultados = await run_storage(
+        search_index.buscar, q, limite=limite, materia=normalizar_texto(materia) if materia else None, origen=origen
+    )
+    return {
+        "success": True,
+        "resultados": resultados,
+        "tiempo_ms": round((time.perf_counter() - inicio) * 1000, 2)
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metricas():
+    """Métricas en formato de exposición de Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache/stats")
+async def obtener_estadisticas_cache():
+    """Contadores de aciertos/fallos de la caché de resultados de IA y de peticiones coalescidas"""
+    from ai_cache import ai_cache, single_flight
+    return {"success": True, "cache": ai_cache.get_stats(), "coalescencia": single_flight.get_stats()}
+
+@app.get("/api/retry/stats")
+async def obtener_estadisticas_reintentos():
+    """Reintentos, esperas y estado del circuit breaker por modelo"""
+    from retry_policy import retry_metrics
+    return {"success": True, "reintentos": retry_metrics.snapshot()}
+
+@app.get("/api/router/stats")
+async def obtener_estadisticas_router():
+    """Latencia (p50/p95), tasa de error, hedges y failovers recientes por proveedor"""
+    from ai_router import router_snapshot
+    return {"success": True, "proveedores": router_snapshot()}
+
+def evento_sse(evento: str, data: dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def pregunta_por_figura(images_content: List[tuple]) -> Optional[dict]:
+    """
+    Si las imágenes subidas son figuras ya guardadas en una pregunta del banco
+    (figure_index.py), esa pregunta con el formato de la extracción con IA
+    """
+    if not FIGURE_SHORTCUT:
+        return None
+    coincidencia = await asyncio.to_thread(indice_figuras.pregunta_de_imagenes, [c for c, _ in images_content])
+    if coincidencia is None:
+        return None
+    pregunta = indice_preguntas.obtener(coincidencia["archivo"], coincidencia["id_temporal"])
+    if pregunta is None:
+        return None
+    logger.info(f"🖼️ Figura conocida: se reutiliza {coincidencia['id_temporal']} sin llamar a la IA")
+    materia = next((m for m in MATERIAS if normalizar_texto(m) == pregunta.get("materia")), pregunta.get("materia"))
+    return {
+        "materia": materia,
+        "tema": pregunta.get("titulo_tema") or str(pregunta.get("tema") or "").replace("_", " "),
+        **{k: pregunta.get(k) for k in ("pregunta", "opciones", "respuesta_correcta", "explicacion", "dificultad")},
+        "ai_service": "banco",
+        "figura_conocida": coincidencia,
+    }
+
 @app.post("/api/process-image-ai")
 async def process_image_ai(
     ai_service: str = Form(...),
@@ -241,9 +414,14 @@ async def process_image_ai(
             content2 = await image2.read()
             images_content.append((content2, image2.filename))
 
-        # Procesar con IA (usar la primera imagen para compatibilidad con el código existente)
-        # En el futuro, se puede mejorar para procesar ambas imágenes
-        result = await process_image_with_ai(ai_service, images_content[0][0], images_content[0][1])
+        if not images_content:
+            raise HTTPException(status_code=400, detail="Debe subir al menos una imagen")
+
+        # Una figura ya guardada en el banco no se vuelve a extraer; si no, ambas
+        # imágenes van en una sola petición multimodal
+        result = await pregunta_por_figura(images_content) if mode == "extract_question" else None
+        if result is None:
+            result = await process_images_with_ai(ai_service, images_content)
 
         # Verificar si hubo un error de RECITATION
         if "error" in result and result["error"] == "RECITATION":
@@ -265,11 +443,135 @@ async def process_image_ai(
             "data": result
         })
 
+    except SinProveedorError as e:
+        # Sin respuesta real no se devuelve nada que se pueda guardar en el banco
+        raise HTTPException(status_code=502, detail=str(e))
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=f"Error procesando imagen: {str(e)}")
 
+@app.post("/api/process-image-ai/stream")
+async def process_image_ai_stream(
+    ai_service: str = Form(...),
+    image1: Optional[UploadFile] = File(None),
+    image2: Optional[UploadFile] = File(None)
+):
+    """
+    Igual que /api/process-image-ai (modo extract_question) pero responde con
+    Server-Sent Events: `campo` por cada campo que termina de llegar y un
+    `resultado` final con el mismo formato que la ruta normal (o `error`).
+    """
+    valid_services = ["openai", "gemini", "claude", "azure"]
+    if ai_service not in valid_services:
+        raise HTTPException(status_code=400, detail="Servicio de IA no válido")
+
+    images_content = []
+    if image1 and image1.filename:
+        images_content.append((await image1.read(), image1.filename))
+    if image2 and image2.filename:
+        images_content.append((await image2.read(), image2.filename))
+
+    if not images_content:
+        raise HTTPException(status_code=400, detail="Debe subir al menos una imagen")
+
+    async def eventos():
+        try:
+            conocida = await pregunta_por_figura(images_content)
+            if conocida is not None:
+                yield evento_sse("resultado", {"success": True, "data": conocida})
+                return
+            async for evento in stream_extraction(ai_service, images_content):
+                if evento["tipo"] == "campo":
+                    yield evento_sse("campo", {"ruta": evento["ruta"], "valor": evento["valor"]})
+                    continue
+                result = evento["data"]
+                if result.get("error") == "RECITATION":
+                    yield evento_sse("error", {"detail": result.get("message", "Contenido bloqueado por políticas de IA")})
+                else:
+                    yield evento_sse("resultado", {"success": True, "data": result})
+        except SinProveedorError as e:
+            yield evento_sse("error", {"detail": str(e)})
+        except Exception as e:
+            yield evento_sse("error", {"detail": f"Error procesando imagen: {str(e)}"})
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/importar-lote")
+async def importar_lote(
+    ai_service: str = Form("gemini"),
+    archivo: UploadFile = File(...)
+):
+    """
+    Importa un examen completo: un ZIP de imágenes o un PDF de varias páginas.
+    Cada página se extrae como en /api/process-image-ai, varias a la vez, y
+    los resultados quedan para revisión (GET /api/importar-lote/{id}).
+    Responde con Server-Sent Events: `lote` (id y páginas), `progreso` por
+    página terminada y `fin`. Si el cliente se desconecta el lote continúa.
+    """
+    valid_services = ["openai", "gemini", "claude", "azure"]
+    if ai_service not in valid_services:
+        raise HTTPException(status_code=400, detail="Servicio de IA no válido")
+
+    async def extraer(images_content):
+        conocida = await pregunta_por_figura(images_content)
+        return conocida if conocida is not None else await process_images_with_ai(ai_service, images_content)
+
+    try:
+        manifiesto, importacion = await iniciar_importacion(
+            archivo.filename or "lote", await leer_subida(archivo), ai_service, extraer
+        )
+    except LoteDemasiadoGrandeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except LoteInvalidoError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def eventos():
+        yield evento_sse("lote", {
+            "id": manifiesto["id"],
+            "total": manifiesto["total"],
+            "paginas": [{"indice": i["indice"], "origen": i["origen"]} for i in manifiesto["items"]],
+        })
+        async for evento in progreso(importacion):
+            yield evento_sse(evento.pop("tipo"), evento)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/importar-lote/{lote_id}")
+async def obtener_lote(lote_id: str):
+    """Estado del lote y resultado de cada página (para revisarlas y guardarlas)"""
+    try:
+        return {"success": True, "lote": await run_storage(leer_lote, lote_id)}
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+
+@app.get("/api/importar-lote/{lote_id}/imagenes/{indice}")
+async def obtener_imagen_lote(lote_id: str, indice: int):
+    try:
+        ruta = await run_storage(ruta_imagen, lote_id, indice)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Página no encontrada")
+    return FileResponse(ruta)
+
+@app.delete("/api/importar-lote/{lote_id}")
+async def descartar_lote(lote_id: str):
+    """Borra el área de revisión de un lote terminado"""
+    try:
+        await run_storage(borrar_lote, lote_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True}
+
 @app.post("/api/generate-explanation")
 async def generate_explanation(
     ai_service: str = Form("gemini"),
@@ -282,57 +584,42 @@ async def generate_explanation(
     solution_image2: Optional[UploadFile] = File(None),
     solution_image3: Optional[UploadFile] = File(None)
 ):
-    try:
-        from ai_services import process_solution_images_with_ai, generate_explanation_from_question
-
-        if mode == "from_question":
-            # Modo: generar desde imágenes de pregunta
-            question_images = []
-            if question_image1 and question_image1.filename:
-                content1 = await question_image1.read()
-                question_images.append(content1)
-            if question_image2 and question_image2.filename:
-                content2 = await question_image2.read()
-                question_images.append(content2)
-
-            if not question_images:
-                raise HTTPException(status_code=400, detail="Se requiere al menos una imagen de la pregunta")
-
-            # Usar la primera imagen para compatibilidad
-            result = await generate_explanation_from_question(
-                ai_service,
-                question_images[0],
-                pregunta,
-                respuesta_correcta
-            )
+    """
+    Encola la generación de la explicación y responde 202 con el id del trabajo.
+    El resultado ({"explanation": ...}) se obtiene en GET /api/jobs/{id}.
+    """
+    if mode == "from_question":
+        # Modo: generar desde imágenes de pregunta
+        question_images = []
+        for img in [question_image1, question_image2]:
+            if img and img.filename:
+                question_images.append(await img.read())
 
-        elif mode == "from_solution":
-            # Modo: generar desde imágenes de solución
-            solution_images = []
-            for img in [solution_image1, solution_image2, solution_image3]:
-                if img and img.filename:
-                    content = await img.read()
-                    solution_images.append(content)
-
-            if not solution_images:
-                raise HTTPException(status_code=400, detail="Se requiere al menos una imagen de solución")
-
-            result = await process_solution_images_with_ai(
-                ai_service,
-                solution_images,
-                pregunta,
-                respuesta_correcta
-            )
-        else:
-            raise HTTPException(status_code=400, detail="Modo no válido")
+        if not question_images:
+            raise HTTPException(status_code=400, detail="Se requiere al menos una imagen de la pregunta")
 
-        return JSONResponse(content={
-            "success": True,
-            "explanation": result["explanation"]
-        })
+        # Solo se usa la primera imagen (compatibilidad)
+        imagenes = question_images[:1]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generando explicación: {str(e)}")
+    elif mode == "from_solution":
+        # Modo: generar desde imágenes de solución
+        imagenes = []
+        for img in [solution_image1, solution_image2, solution_image3]:
+            if img and img.filename:
+                imagenes.append(await img.read())
+
+        if not imagenes:
+            raise HTTPException(status_code=400, detail="Se requiere al menos una imagen de solución")
+    else:
+        raise HTTPException(status_code=400, detail="Modo no válido")
+
+    job_id = await cola_trabajos.encolar("explicacion", {
+        "ai_service": ai_service,
+        "mode": mode,
+        "pregunta": pregunta,
+        "respuesta_correcta": respuesta_correcta,
+    }, imagenes)
+    return respuesta_trabajo(job_id)
 
 @app.post("/api/procesar-comprension")
 async def procesar_comprension(
@@ -363,19 +650,47 @@ async def procesar_comprension(
                     raise HTTPException(status_code=400, detail=f"Se requiere la imagen de la pregunta {i}")
                 imagenes_preguntas.append(await img.read())
 
-        # Procesar cada pregunta con IA
+        # Procesar todas las preguntas en paralelo (la concurrencia por proveedor
+        # la acota el semáforo de ai_services); gather conserva el orden
+        resultados = await asyncio.gather(
+            *[
+                process_comprehension_question(ai_service, img_content, texto, idx=i)
+                for i, img_content in enumerate(imagenes_preguntas, start=1)
+            ],
+            return_exceptions=True
+        )
+
         preguntas_procesadas = []
-        for i, img_content in enumerate(imagenes_preguntas, start=1):
-            result = await process_comprehension_question(ai_service, img_content, texto, idx=i)
-            preguntas_procesadas.append(result)
+        errores = []
+        for i, result in enumerate(resultados, start=1):
+            if isinstance(result, Exception):
+                logger.error(f"❌ Error procesando pregunta {i} de comprensión: {result}")
+                errores.append({"pregunta": i, "error": str(result)})
+                # Se deja la pregunta vacía para que el operador la complete a mano
+                preguntas_procesadas.append({
+                    "pregunta": "",
+                    "opciones": {"A": "", "B": "", "C": "", "D": "", "E": ""},
+                    "respuesta_correcta": "A",
+                    "explicacion": "",
+                    "dificultad": 1,
+                    "error": str(result)
+                })
+            else:
+                preguntas_procesadas.append(result)
+
+        if len(errores) == len(resultados):
+            raise HTTPException(status_code=502, detail=f"No se pudo procesar ninguna pregunta: {errores[0]['error']}")
 
         return JSONResponse(content={
             "success": True,
-            "preguntas": preguntas_procesadas
+            "preguntas": preguntas_procesadas,
+            "errores": errores
         })
 
     except Exception as e:
-        print(f"Error procesando comprensión: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        logger.exception(f"❌ Error procesando comprensión: {e}")
         raise HTTPException(status_code=500, detail=f"Error procesando comprensión: {str(e)}")
 
 @app.post("/crear-pregunta-comprension")
@@ -433,7 +748,7 @@ async def crear_pregunta_comprension(request: Request):
             materia_dir = Path(*path_parts)
 
         # Crear directorios
-        materia_dir.mkdir(parents=True, exist_ok=True)
+        await run_storage(materia_dir.mkdir, parents=True, exist_ok=True)
 
         # Generar IDs temporales para las preguntas
         tema_norm = f"texto_{numero_tema:03d}"
@@ -452,9 +767,14 @@ async def crear_pregunta_comprension(request: Request):
             "preguntas": preguntas
         }
 
-        # Guardar JSON
+        # Guardar JSON (bloqueo por archivo + reemplazo atómico)
         archivo_json = materia_dir / f"{tema_norm}.json"
-        archivo_json.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+        contenido = json.dumps(payload, ensure_ascii=False, indent=2)
+        async with bloqueo_archivo_async(archivo_json):
+            await run_storage(escribir_atomico, archivo_json, contenido)
+        indice_preguntas.reemplazar_archivo(archivo_json, payload)
+        await run_storage(indice_duplicados.reemplazar_archivo, archivo_json, payload)
+        await run_storage(search_index.indexar_archivo, archivo_json, payload)
 
         return JSONResponse(content={
             "success": True,
@@ -464,7 +784,7 @@ async def crear_pregunta_comprension(request: Request):
         })
 
     except Exception as e:
-        print(f"Error guardando comprensión: {str(e)}")
+        logger.exception(f"❌ Error guardando comprensión: {e}")
         raise HTTPException(status_code=500, detail=f"Error guardando comprensión: {str(e)}")
 
 @app.post("/siguiente-texto-comprension")
@@ -510,19 +830,12 @@ async def siguiente_texto_comprension(request: Request):
             path_parts.append(materia_norm)
             materia_dir = Path(*path_parts)
 
-        if not materia_dir.exists():
-            return JSONResponse(content={"success": True, "siguiente_numero": 1})
+        siguiente_numero = await run_storage(siguiente_numero_texto, materia_dir)
 
-        max_num = 0
-        for archivo in materia_dir.glob("texto_*.json"):
-            match = re.search(r"texto_(\d{3})\.json$", archivo.name)
-            if match:
-                max_num = max(max_num, int(match.group(1)))
-
-        return JSONResponse(content={"success": True, "siguiente_numero": max_num + 1})
+        return JSONResponse(content={"success": True, "siguiente_numero": siguiente_numero})
 
     except Exception as e:
-        print(f"Error obteniendo siguiente texto: {str(e)}")
+        logger.exception(f"❌ Error obteniendo siguiente texto: {e}")
         raise HTTPException(status_code=500, detail=f"Error obteniendo siguiente texto: {str(e)}")
 
 @app.post("/api/generar-variacion")
@@ -533,40 +846,70 @@ async def generar_variacion(
 ):
     """
     Genera una variación de una pregunta existente manteniendo los números originales
-    pero cambiando el contexto o añadiendo pasos adicionales
+    pero cambiando el contexto o añadiendo pasos adicionales.
+    Se encola: responde 202 con el id del trabajo (resultado en GET /api/jobs/{id}).
     """
+    # Validar servicio de IA
+    valid_services = ["openai", "gemini", "claude", "azure"]
+    if ai_service not in valid_services:
+        raise HTTPException(status_code=400, detail="Servicio de IA no válido")
+
+    # Validar tipo de variación
+    valid_types = ["contexto", "paso_adicional", "mas_compleja"]
+    if tipo_variacion not in valid_types:
+        raise HTTPException(status_code=400, detail="Tipo de variación no válido")
+
+    # Validar que la imagen esté presente
+    if not imagen or not imagen.filename:
+        raise HTTPException(status_code=400, detail="Debe subir una imagen")
+
+    job_id = await cola_trabajos.encolar(
+        "variacion", {"ai_service": ai_service, "tipo_variacion": tipo_variacion}, [await imagen.read()]
+    )
+    return respuesta_trabajo(job_id)
+
+def respuesta_trabajo(job_id: str) -> JSONResponse:
+    return JSONResponse(status_code=202, content={
+        "success": True,
+        "job_id": job_id,
+        "estado": "pendiente",
+        "url": f"/api/jobs/{job_id}",
+        "eventos": f"/api/jobs/{job_id}/eventos",
+    })
+
+@app.get("/api/jobs/stats")
+async def obtener_estadisticas_trabajos():
+    """Trabajos de la cola por tipo y estado"""
+    return {"success": True, "stats": await run_storage(cola_trabajos.get_stats)}
+
+@app.get("/api/jobs/{job_id}")
+async def obtener_trabajo(job_id: str):
+    """Estado de un trabajo (pendiente con su posición, en_curso, listo con `resultado`, error)"""
     try:
-        from ai_variation import generate_question_variation
-
-        # Validar servicio de IA
-        valid_services = ["openai", "gemini", "claude", "azure"]
-        if ai_service not in valid_services:
-            raise HTTPException(status_code=400, detail="Servicio de IA no válido")
-
-        # Validar tipo de variación
-        valid_types = ["contexto", "paso_adicional", "mas_compleja"]
-        if tipo_variacion not in valid_types:
-            raise HTTPException(status_code=400, detail="Tipo de variación no válido")
+        return {"success": True, "job": await cola_trabajos.obtener(job_id)}
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
 
-        # Validar que la imagen esté presente
-        if not imagen or not imagen.filename:
-            raise HTTPException(status_code=400, detail="Debe subir una imagen")
-
-        # Leer imagen
-        image_content = await imagen.read()
-
-        # Generar variación con IA
-        result = await generate_question_variation(ai_service, image_content, tipo_variacion)
-
-        return JSONResponse(content={
-            "success": True,
-            "data": result
-        })
-
-    except Exception as e:
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail=f"Error generando variación: {str(e)}")
+@app.get("/api/jobs/{job_id}/eventos")
+async def eventos_trabajo(job_id: str):
+    """
+    Server-Sent Events del trabajo: `estado` en cada cambio (o de posición en la
+    cola) y `fin` con el resultado o el error.
+    """
+    try:
+        await cola_trabajos.obtener(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    async def eventos():
+        async for trabajo in cola_trabajos.seguir(job_id):
+            yield evento_sse("fin" if trabajo["estado"] in ESTADOS_TERMINALES else "estado", trabajo)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
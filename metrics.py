@@ -0,0 +1,230 @@
+"""
+Métricas en formato de exposición de Prometheus (texto 0.0.4) para GET /metrics.
+
+Implementación mínima sin dependencias (contadores e histogramas con
+etiquetas, seguros entre hilos), suficiente para que Prometheus/Grafana
+vean dónde se van el tiempo y los tokens bajo carga:
+
+- ai_request_duration_seconds: latencia por proveedor/modelo y resultado
+- ai_tokens_total: tokens de entrada/salida reportados por el proveedor
+- ai_mock_responses_total: respuestas simuladas devueltas (sin API key o por error)
+- ai_router_events_total: hedges, failovers y hedges ganados del router de proveedores
+- import_pages_total: páginas de importaciones por lote, por resultado
+- jobs_total / job_duration_seconds: trabajos de la cola por tipo y resultado, espera en cola y ejecución
+- json_parse_total: parseos de respuestas de IA por ruta (directo, reparado, error)
+- storage_operation_seconds: latencia de escrituras (preguntas, imágenes, pool de E/S)
+- http_requests_total / http_request_duration_seconds: peticiones por endpoint
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Buckets por defecto: de 5 ms a 2 min (cubre E/S local y llamadas a modelos)
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def _escapar(valor: str) -> str:
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _etiquetas(nombres: Sequence[str], valores: Sequence[str], extra: str = "") -> str:
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+
+def _numero(valor: float) -> str:
+    if valor == math.inf:
+        return "+Inf"
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+
+    def _clave(self, valores: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(valores.get(n, "")) for n in self.etiquetas)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+
+
+class Counter(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = ()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._valores: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, valor: float = 1, **etiquetas: str) -> None:
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0.0) + valor
+
+    def render(self) -> List[str]:
+        lineas = super().render()
+        with self._lock:
+            items = sorted(self._valores.items())
+        for clave, valor in items:
+            lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}")
+        return lineas
+
+
+class Histogram(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: Sequence[str] = (), buckets: Sequence[float] = BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        # Por combinación de etiquetas: conteos por bucket (el último es +Inf), suma
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, valor: float, **etiquetas: str) -> None:
+        clave = self._clave(etiquetas)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [0.0] * (len(self.buckets) + 2)
+            serie[bisect.bisect_left(self.buckets, valor)] += 1
+            serie[-1] += valor
+
+    @contextmanager
+    def time(self, **etiquetas: str) -> Iterator[None]:
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, **etiquetas)
+
+    def render(self) -> List[str]:
+        lineas = super().render()
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for clave, serie in items:
+            acumulado = 0.0
+            for limite, conteo in zip(self.buckets + (math.inf,), serie[:-1]):
+                acumulado += conteo
+                le = f'le="{_numero(limite)}"'
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {_numero(acumulado)}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(serie[-1])}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {_numero(acumulado)}")
+        return lineas
+
+
+class Registry:
+    def __init__(self):
+        self._metricas: List[_Metrica] = []
+
+    def registrar(self, metrica: _Metrica) -> _Metrica:
+        self._metricas.append(metrica)
+        return metrica
+
+    def render(self) -> str:
+        lineas: List[str] = []
+        for metrica in self._metricas:
+            lineas.extend(metrica.render())
+        return "\n".join(lineas) + "\n"
+
+
+registry = Registry()
+
+ai_request_duration = registry.registrar(Histogram(
+    "ai_request_duration_seconds",
+    "Latencia de cada intento de llamada a un proveedor de IA",
+    ("provider", "model", "outcome"),
+))
+ai_tokens = registry.registrar(Counter(
+    "ai_tokens_total",
+    "Tokens reportados por el proveedor (direction=input|output)",
+    ("provider", "model", "direction"),
+))
+ai_mock_responses = registry.registrar(Counter(
+    "ai_mock_responses_total",
+    "Respuestas simuladas devueltas en lugar de una respuesta real",
+    ("provider",),
+))
+ai_router_events = registry.registrar(Counter(
+    "ai_router_events_total",
+    "Intentos de respaldo lanzados por el router (event=hedge|failover|hedge_ganado)",
+    ("provider", "event"),
+))
+import_pages = registry.registrar(Counter(
+    "import_pages_total",
+    "Páginas extraídas en importaciones por lote (outcome=ok|error|figura_conocida)",
+    ("outcome",),
+))
+jobs = registry.registrar(Counter(
+    "jobs_total",
+    "Trabajos de la cola terminados (outcome=ok|error|descartado)",
+    ("tipo", "outcome"),
+))
+job_duration = registry.registrar(Histogram(
+    "job_duration_seconds",
+    "Tiempo de los trabajos de la cola (fase=espera|ejecucion)",
+    ("tipo", "fase"),
+))
+json_parse = registry.registrar(Counter(
+    "json_parse_total",
+    "Parseos de respuestas de IA por ruta (direct=json.loads, repaired=json_repair, error)",
+    ("path",),
+))
+storage_duration = registry.registrar(Histogram(
+    "storage_operation_seconds",
+    "Latencia de operaciones de almacenamiento",
+    ("operation",),
+))
+http_requests = registry.registrar(Counter(
+    "http_requests_total",
+    "Peticiones HTTP por endpoint",
+    ("method", "endpoint", "status"),
+))
+http_request_duration = registry.registrar(Histogram(
+    "http_request_duration_seconds",
+    "Latencia de las peticiones HTTP por endpoint",
+    ("method", "endpoint"),
+))
+
+
+def separar_clave(key: str) -> Tuple[str, str]:
+    """Clave de retry_policy ("gemini:gemini-2.0-flash") -> (proveedor, modelo)"""
+    proveedor, _, modelo = key.partition(":")
+    return proveedor, modelo
+
+
+def tokens_de_respuesta(body: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    (entrada, salida) del cuerpo de una respuesta de OpenAI/Azure (usage.prompt_tokens),
+    Claude (usage.input_tokens) o Gemini (usageMetadata.promptTokenCount).
+    """
+    if not isinstance(body, dict):
+        return None, None
+    usage = body.get("usageMetadata")
+    if isinstance(usage, dict):
+        return usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+    usage = body.get("usage")
+    if isinstance(usage, dict):
+        if "prompt_tokens" in usage or "completion_tokens" in usage:
+            return usage.get("prompt_tokens"), usage.get("completion_tokens")
+        return usage.get("input_tokens"), usage.get("output_tokens")
+    return None, None
+
+
+def registrar_tokens(key: str, entrada: Optional[int], salida: Optional[int]) -> None:
+    proveedor, modelo = separar_clave(key)
+    if entrada:
+        ai_tokens.inc(entrada, provider=proveedor, model=modelo, direction="input")
+    if salida:
+        ai_tokens.inc(salida, provider=proveedor, model=modelo, direction="output")
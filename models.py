@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Dict, Optional, List
+from pydantic import BaseModel, Field
+from typing import Dict, Literal, Optional, List
 
 class PreguntaRequest(BaseModel):
     tipo_clasificacion: str
@@ -43,4 +43,51 @@ class PreguntaResponse(BaseModel):
 class ApiResponse(BaseModel):
     success: bool
     message: str
-    data: Optional[dict] = None
\ No newline at end of file
+    data: Optional[dict] = None
+
+# ========================================
+# ESQUEMAS DE SALIDA DE LA IA (ver ai_schemas.py)
+# ========================================
+
+class OpcionesPregunta(BaseModel):
+    A: str
+    B: str
+    C: str
+    D: str
+    E: str
+
+class PreguntaExtraida(BaseModel):
+    """Pregunta de examen extraída de una o más imágenes"""
+    materia: str = Field(description="Materia, de la lista indicada en el prompt")
+    tema: str = Field(description="Tema descriptivo")
+    pregunta: str = Field(description="Texto completo de la pregunta, con LaTeX entre $$")
+    opciones: OpcionesPregunta = Field(description="Las 5 opciones en el orden de la imagen")
+    dificultad: int = Field(description="Dificultad de 1 a 5")
+    confianza: int = Field(description="Confianza de la extracción de 0 a 100")
+
+class VariacionPregunta(BaseModel):
+    """Variación de una pregunta manteniendo sus datos numéricos"""
+    pregunta_original: str = Field(description="Pregunta extraída de la imagen")
+    pregunta_variada: str = Field(description="Nueva versión de la pregunta con los mismos números")
+    descripcion_cambios: str = Field(description="Breve descripción de los cambios")
+    numeros_mantenidos: List[str] = Field(description="Números/valores que se mantuvieron iguales")
+
+class PreguntaComprension(BaseModel):
+    """Pregunta de comprensión lectora extraída de una imagen"""
+    pregunta: str
+    opciones: OpcionesPregunta
+    respuesta_correcta: Literal["A", "B", "C", "D", "E"]
+    explicacion: str = Field(description="Explicación breve (máx. 2-3 oraciones)")
+    dificultad: int = Field(description="Dificultad de 1 a 3")
+
+class PreguntaGenerada(BaseModel):
+    """Pregunta sintética nueva (mismos campos que Pregunta, sin metadatos)"""
+    pregunta: str
+    dificultad: int = Field(description="Dificultad de 1 a 3")
+    opciones: OpcionesPregunta
+    respuesta_correcta: Literal["A", "B", "C", "D", "E"]
+    explicacion: str = Field(description="Resolución paso a paso con los nuevos datos")
+
+class LotePreguntas(BaseModel):
+    """Lote de preguntas sintéticas"""
+    preguntas: List[PreguntaGenerada]
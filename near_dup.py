@@ -0,0 +1,278 @@
+"""
+Detección de preguntas casi duplicadas con MinHash + LSH.
+
+Cada pregunta se resume en una firma MinHash de NUM_PERMUTACIONES valores
+calculada sobre sus shingles:
+- trigramas de palabras del enunciado, normalizado con normalizar_busqueda
+  (sin tildes y con el LaTeX reducido a palabras: "$$x^{2}$$" y "x^2" coinciden)
+- el texto normalizado de cada opción como un shingle propio, así que
+  reordenar las alternativas no cambia la firma
+
+La fracción de valores iguales entre dos firmas estima la similitud de
+Jaccard de sus shingles. Para no comparar contra todo el banco, la firma se
+parte en BANDAS bandas de FILAS valores y cada banda es la clave de un
+diccionario: son candidatas las preguntas que coinciden en alguna banda
+completa, y solo a ellas se les estima la similitud con la firma entera.
+Con 20 bandas de 6 filas un par con Jaccard 0.8 es candidato con
+probabilidad > 99 %, uno con 0.4 con < 8 %.
+
+Se usa en dos sitios:
+- al guardar una pregunta (utils.guardar_pregunta_json): las parecidas del
+  banco se devuelven en "posibles_duplicados" (aviso, no bloquea el guardado)
+- en el generador de preguntas sintéticas: las casi duplicadas (entre sí o
+  con las ya generadas de la materia) se descartan y se piden reemplazos
+
+Solo usa la biblioteca estándar: el generador lo importa sin las
+dependencias de la app.
+
+Variables de entorno:
+- NEAR_DUP_THRESHOLD: similitud estimada desde la que dos preguntas se
+  consideran casi duplicadas (default 0.8)
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import random
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from app_logging import get_logger
+from text_normalization import normalizar_busqueda
+
+logger = get_logger(__name__)
+
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+
+BANDAS = 20
+FILAS = 6
+NUM_PERMUTACIONES = BANDAS * FILAS
+
+# Palabras por shingle del enunciado
+TAMANO_SHINGLE = 3
+
+# Permutaciones h(x) = (a*x + b) mod p con semilla fija: las firmas son comparables entre ejecuciones
+_PRIMO = (1 << 61) - 1
+_azar = random.Random(20240417)
+_PERMUTACIONES = [(_azar.randrange(1, _PRIMO), _azar.randrange(0, _PRIMO)) for _ in range(NUM_PERMUTACIONES)]
+
+Firma = Tuple[int, ...]
+
+# Claves de las preguntas que se filtran sin archivo propio (lotes del generador)
+_consecutivo = itertools.count()
+
+
+def _textos_opciones(opciones: Any) -> List[str]:
+    if isinstance(opciones, dict):
+        return [str(v) for v in opciones.values() if v]
+    if isinstance(opciones, list):
+        return [str(v) for v in opciones if v]
+    return []
+
+
+def shingles(pregunta: Dict[str, Any]) -> set:
+    """Trigramas del enunciado y una entrada por opción, normalizados"""
+    tokens = normalizar_busqueda(str(pregunta.get("pregunta") or "")).split()
+    if len(tokens) <= TAMANO_SHINGLE:
+        resultado = {" ".join(tokens)} if tokens else set()
+    else:
+        resultado = {" ".join(tokens[i:i + TAMANO_SHINGLE]) for i in range(len(tokens) - TAMANO_SHINGLE + 1)}
+    for texto in _textos_opciones(pregunta.get("opciones")):
+        normalizado = normalizar_busqueda(texto)
+        if normalizado:
+            resultado.add("opcion:" + normalizado)
+    return resultado
+
+
+def calcular_firma(pregunta: Dict[str, Any]) -> Optional[Firma]:
+    """Firma MinHash de la pregunta, o None si no tiene texto que comparar"""
+    conjunto = shingles(pregunta)
+    if not conjunto:
+        return None
+    valores = [
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+        for s in conjunto
+    ]
+    return tuple(min((a * v + b) % _PRIMO for v in valores) for a, b in _PERMUTACIONES)
+
+
+def similitud(firma_a: Firma, firma_b: Firma) -> float:
+    """Jaccard estimada: fracción de posiciones iguales"""
+    return sum(1 for x, y in zip(firma_a, firma_b) if x == y) / NUM_PERMUTACIONES
+
+
+def _bandas(firma: Firma) -> List[Firma]:
+    return [firma[i * FILAS:(i + 1) * FILAS] for i in range(BANDAS)]
+
+
+def _extracto(texto: Any, largo: int = 120) -> str:
+    texto = " ".join(str(texto or "").split())
+    return texto if len(texto) <= largo else texto[:largo - 1] + "…"
+
+
+class IndiceDuplicados:
+    """
+    Firmas MinHash con sus bandas LSH. Cada entrada tiene una clave única
+    ("<archivo>#<posición>") y los datos que se devuelven al encontrarla.
+    """
+
+    def __init__(self, umbral: Optional[float] = None):
+        self.umbral = NEAR_DUP_THRESHOLD if umbral is None else umbral
+        self._lock = threading.Lock()
+        self._firmas: Dict[str, Firma] = {}
+        self._datos: Dict[str, Dict[str, Any]] = {}
+        self._cubetas: List[Dict[Firma, List[str]]] = [{} for _ in range(BANDAS)]
+        self._por_archivo: Dict[str, List[str]] = {}
+
+    # ----- sin bloqueo (llamar con self._lock tomado) -----
+
+    def _buscar(self, firma: Firma, umbral: float, limite: int) -> List[Dict[str, Any]]:
+        candidatas = set()
+        for i, banda in enumerate(_bandas(firma)):
+            candidatas.update(self._cubetas[i].get(banda, ()))
+        encontradas = []
+        for clave in candidatas:
+            valor = similitud(firma, self._firmas[clave])
+            if valor >= umbral:
+                encontradas.append({**self._datos[clave], "similitud": round(valor, 3)})
+        encontradas.sort(key=lambda d: (-d["similitud"], d.get("archivo") or "", str(d.get("id_temporal") or "")))
+        return encontradas[:limite]
+
+    def _agregar(self, clave: str, firma: Firma, datos: Dict[str, Any]) -> None:
+        if clave in self._firmas:
+            self._quitar(clave)
+        self._firmas[clave] = firma
+        self._datos[clave] = datos
+        for i, banda in enumerate(_bandas(firma)):
+            self._cubetas[i].setdefault(banda, []).append(clave)
+        archivo = datos.get("archivo")
+        if archivo:
+            self._por_archivo.setdefault(archivo, []).append(clave)
+
+    def _quitar(self, clave: str) -> None:
+        firma = self._firmas.pop(clave)
+        self._datos.pop(clave)
+        for i, banda in enumerate(_bandas(firma)):
+            cubeta = self._cubetas[i][banda]
+            cubeta.remove(clave)
+            if not cubeta:
+                del self._cubetas[i][banda]
+
+    # ----- API -----
+
+    def buscar(self, pregunta: Dict[str, Any], umbral: Optional[float] = None, limite: int = 5) -> List[Dict[str, Any]]:
+        """Preguntas del índice casi duplicadas de `pregunta`, de más a menos parecida"""
+        firma = calcular_firma(pregunta)
+        if firma is None:
+            return []
+        with self._lock:
+            return self._buscar(firma, self.umbral if umbral is None else umbral, limite)
+
+    def registrar(
+        self,
+        clave: str,
+        pregunta: Dict[str, Any],
+        archivo: Optional[str] = None,
+        agregar_duplicadas: bool = True,
+        limite: int = 5,
+    ) -> List[Dict[str, Any]]:
+        """
+        Busca las casi duplicadas de `pregunta` y la añade al índice (en una
+        sola operación, así dos hilos no se pierden uno al otro). Con
+        agregar_duplicadas=False solo se añade si no se encontró ninguna.
+        """
+        firma = calcular_firma(pregunta)
+        if firma is None:
+            return []
+        datos = {
+            "archivo": archivo,
+            "id_temporal": pregunta.get("id_temporal"),
+            "pregunta": _extracto(pregunta.get("pregunta")),
+        }
+        with self._lock:
+            encontradas = self._buscar(firma, self.umbral, limite)
+            if agregar_duplicadas or not encontradas:
+                self._agregar(clave, firma, datos)
+        return encontradas
+
+    def reemplazar_archivo(self, ruta: Union[str, Path], data: Dict[str, Any]) -> None:
+        """Sustituye las preguntas de un archivo por las de `data` (archivo reescrito completo)"""
+        archivo = Path(ruta).as_posix()
+        firmas = []
+        for posicion, pregunta in enumerate(data.get("preguntas") or []):
+            if isinstance(pregunta, dict):
+                firma = calcular_firma(pregunta)
+                if firma is not None:
+                    firmas.append((f"{archivo}#{posicion}", firma, {
+                        "archivo": archivo,
+                        "id_temporal": pregunta.get("id_temporal"),
+                        "pregunta": _extracto(pregunta.get("pregunta")),
+                    }))
+        with self._lock:
+            for clave in self._por_archivo.pop(archivo, []):
+                if clave in self._firmas:
+                    self._quitar(clave)
+            for clave, firma, datos in firmas:
+                self._agregar(clave, firma, datos)
+
+    def cargar(self, archivos: Dict[str, Dict[str, Any]]) -> int:
+        """Añade todas las preguntas de {ruta: contenido del JSON} (bloqueante)"""
+        for ruta in sorted(archivos):
+            self.reemplazar_archivo(ruta, archivos[ruta])
+        total = len(self)
+        logger.info(f"🧬 Índice de casi duplicados listo: {total} firmas")
+        return total
+
+    def cargar_directorio(self, directorio: Path, patron: str = "*.json") -> int:
+        """Añade las preguntas de los JSON de un directorio (los ilegibles se omiten)"""
+        archivos: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(directorio.glob(patron)):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                continue
+            if isinstance(data, dict) and isinstance(data.get("preguntas"), list):
+                archivos[path.as_posix()] = data
+        return self.cargar(archivos)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._firmas)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "firmas": len(self._firmas),
+                "archivos": len(self._por_archivo),
+                "umbral": self.umbral,
+                "bandas": BANDAS,
+                "filas": FILAS,
+            }
+
+
+def filtrar_duplicadas(
+    preguntas: Iterable[Dict[str, Any]],
+    indice: IndiceDuplicados,
+    prefijo: str,
+) -> Tuple[List[Dict[str, Any]], List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]]:
+    """
+    Separa `preguntas` en (únicas, descartadas). Las únicas quedan en el índice,
+    así una pregunta también se compara con las anteriores de la misma lista.
+    """
+    unicas: List[Dict[str, Any]] = []
+    descartadas: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]] = []
+    for pregunta in preguntas:
+        if not isinstance(pregunta, dict):
+            continue
+        clave = f"{prefijo}#{next(_consecutivo)}"
+        encontradas = indice.registrar(clave, pregunta, archivo=prefijo, agregar_duplicadas=False, limite=1)
+        if encontradas:
+            descartadas.append((pregunta, encontradas))
+        else:
+            unicas.append(pregunta)
+    return unicas, descartadas
+
+
+indice_duplicados = IndiceDuplicados()
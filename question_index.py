@@ -0,0 +1,261 @@
+"""
+Índice en memoria del banco de preguntas para consultas (GET /api/preguntas).
+
+Se construye al iniciar la app a partir del almacén (question_store.py) y de
+los JSON de banco_preguntas/ y banco_procesos/ que no estén en él (p. ej. los
+textos de comprensión), y se mantiene al día en cada escritura desde main.py.
+Una consulta nunca abre archivos:
+
+- Cada pregunta recibe un número de secuencia creciente (orden de carga y
+  luego de inserción); las listas de secuencias por valor de cada filtro
+  están ordenadas, así que filtrar es recorrer la lista más corta y
+  paginar es un bisect sobre ella.
+- Los valores de los filtros se comparan normalizados con normalizar_texto
+  ("Álgebra" == "algebra", "I FASE" == "i_fase").
+- El cursor es opaco y lleva la generación del índice: un cursor de antes de
+  un reinicio se rechaza en lugar de saltarse o repetir preguntas.
+
+Las preguntas antiguas de banco_procesos/ sin los campos del proceso los
+toman de la ruta ([area]/[año]/[tipo_proceso]/[fase]/[examen]/[materia]/).
+"""
+
+import base64
+import bisect
+import json
+import re
+import threading
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app_logging import get_logger
+from question_store import BASES_BANCO, RutaArchivo, question_store
+from utils import normalizar_texto
+
+logger = get_logger(__name__)
+
+FILTROS = (
+    "materia", "tema", "dificultad", "tipo_clasificacion", "area_academica",
+    "anio", "tipo_proceso", "fase", "examen",
+)
+
+LIMITE_MAXIMO = 1000
+
+
+def _normalizar(valor: Any) -> Optional[str]:
+    if valor is None or valor == "":
+        return None
+    return normalizar_texto(str(valor))
+
+
+def _metadatos_de_ruta(ruta: str) -> Dict[str, Any]:
+    """Clasificación deducida de la ruta del archivo (para preguntas sin esos campos)"""
+    partes = Path(ruta).parts
+    if not partes or partes[0] != "banco_procesos":
+        return {"tipo_clasificacion": "normal"}
+
+    meta: Dict[str, Any] = {"tipo_clasificacion": "proceso"}
+    carpetas = list(partes[1:-2])  # sin la base, la carpeta de la materia ni el archivo
+    for i, parte in enumerate(carpetas):
+        if re.fullmatch(r"\d{4}", parte):
+            if i > 0:
+                meta["area_academica"] = carpetas[i - 1]
+            meta["anio"] = parte
+            resto = carpetas[i + 1:]
+            if resto:
+                meta["tipo_proceso"] = resto[0]
+            for extra in resto[1:]:
+                meta["fase" if "fase" in extra else "examen"] = extra
+            break
+    return meta
+
+
+def leer_archivos_banco(bases: Optional[Iterable[Path]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    {ruta: contenido} de todos los archivos de preguntas: los del almacén y
+    los JSON de disco que no están en él (bloqueante)
+    """
+    archivos: Dict[str, Dict[str, Any]] = {}
+    for ruta in question_store.listar_rutas():
+        data = question_store.obtener_archivo(ruta)
+        if data is not None:
+            archivos[ruta] = data
+    for base in bases or BASES_BANCO:
+        if not base.exists():
+            continue
+        for path in base.rglob("*.json"):
+            clave = path.as_posix()
+            if clave in archivos:
+                continue
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError):
+                logger.warning(f"⚠️ No se pudo leer {clave}, se omite del índice")
+                continue
+            if isinstance(data, dict) and isinstance(data.get("preguntas"), list):
+                archivos[clave] = data
+    return archivos
+
+
+class IndicePreguntas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reiniciar()
+        self.cargado = False
+
+    def _reiniciar(self) -> None:
+        self._generacion = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._entradas: Dict[int, Dict[str, Any]] = {}
+        self._claves: Dict[int, Dict[str, str]] = {}
+        self._orden: List[int] = []
+        self._por_valor: Dict[str, Dict[str, List[int]]] = {campo: {} for campo in FILTROS}
+        self._por_archivo: Dict[str, List[int]] = {}
+
+    # ----- escritura -----
+
+    def _agregar(self, ruta: str, cabecera: Dict[str, Any], pregunta: Dict[str, Any]) -> None:
+        entrada = {
+            **_metadatos_de_ruta(ruta),
+            "materia": Path(ruta).parent.name,
+            "tema": Path(ruta).stem,
+            **{k: v for k, v in cabecera.items() if k != "preguntas"},
+            **pregunta,
+            "archivo": ruta,
+        }
+        self._seq += 1
+        seq = self._seq
+        claves = {}
+        for campo in FILTROS:
+            valor = _normalizar(entrada.get(campo))
+            if valor is not None:
+                claves[campo] = valor
+                self._por_valor[campo].setdefault(valor, []).append(seq)
+        self._entradas[seq] = entrada
+        self._claves[seq] = claves
+        self._orden.append(seq)
+        self._por_archivo.setdefault(ruta, []).append(seq)
+
+    def agregar(self, ruta: RutaArchivo, cabecera: Dict[str, Any], pregunta: Dict[str, Any]) -> None:
+        """Añade una pregunta recién guardada en el archivo `ruta`"""
+        with self._lock:
+            self._agregar(Path(ruta).as_posix(), cabecera, pregunta)
+
+    def reemplazar_archivo(self, ruta: RutaArchivo, data: Dict[str, Any]) -> None:
+        """Sustituye todas las preguntas de un archivo reescrito completo (textos de comprensión)"""
+        clave = Path(ruta).as_posix()
+        with self._lock:
+            viejas = set(self._por_archivo.pop(clave, []))
+            if viejas:
+                for seq in viejas:
+                    del self._entradas[seq]
+                    for campo, valor in self._claves.pop(seq).items():
+                        lista = self._por_valor[campo][valor]
+                        lista[:] = [s for s in lista if s not in viejas]
+                self._orden = [s for s in self._orden if s not in viejas]
+            for pregunta in data.get("preguntas") or []:
+                if isinstance(pregunta, dict):
+                    self._agregar(clave, data, pregunta)
+
+    def cargar(self, archivos: Optional[Dict[str, Dict[str, Any]]] = None) -> int:
+        """
+        Construye el índice a partir de {ruta: contenido} (por defecto, todo el
+        banco). Bloqueante: se ejecuta en el pool de almacenamiento.
+        """
+        if archivos is None:
+            archivos = leer_archivos_banco()
+
+        with self._lock:
+            self._reiniciar()
+            for ruta in sorted(archivos):
+                for pregunta in archivos[ruta]["preguntas"]:
+                    if isinstance(pregunta, dict):
+                        self._agregar(ruta, archivos[ruta], pregunta)
+            self.cargado = True
+            total = len(self._entradas)
+        logger.info(f"📚 Índice de preguntas listo: {total} preguntas en {len(archivos)} archivos")
+        return total
+
+    # ----- lectura -----
+
+    def _codificar_cursor(self, seq: int) -> str:
+        return base64.urlsafe_b64encode(f"{self._generacion}:{seq}".encode()).decode().rstrip("=")
+
+    def _decodificar_cursor(self, cursor: str) -> int:
+        try:
+            texto = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            generacion, seq = texto.split(":")
+            seq_int = int(seq)
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError("Cursor inválido")
+        if generacion != self._generacion:
+            raise ValueError("Cursor expirado (el índice se reconstruyó); reinicia la consulta")
+        return seq_int
+
+    def consultar(
+        self,
+        filtros: Dict[str, Any],
+        cursor: Optional[str] = None,
+        limite: int = 50,
+        campos: Optional[List[str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Página de preguntas que cumplen todos los filtros, en orden de índice.
+        `campos` limita las claves devueltas (id_temporal y archivo siempre se incluyen).
+        """
+        condiciones: List[Tuple[str, str]] = []
+        for campo, valor in filtros.items():
+            if campo not in FILTROS:
+                raise ValueError(f"Filtro no soportado: {campo}")
+            normalizado = _normalizar(valor)
+            if normalizado is not None:
+                condiciones.append((campo, normalizado))
+
+        with self._lock:
+            despues = self._decodificar_cursor(cursor) if cursor else 0
+            if condiciones:
+                base = min((self._por_valor[c].get(v, []) for c, v in condiciones), key=len)
+            else:
+                base = self._orden
+
+            encontradas: List[int] = []
+            for seq in base[bisect.bisect_right(base, despues):]:
+                claves = self._claves[seq]
+                if all(claves.get(c) == v for c, v in condiciones):
+                    encontradas.append(seq)
+                    if len(encontradas) > limite:
+                        break
+
+            hay_mas = len(encontradas) > limite
+            encontradas = encontradas[:limite]
+            preguntas = [self._proyectar(self._entradas[seq], campos) for seq in encontradas]
+            siguiente = self._codificar_cursor(encontradas[-1]) if hay_mas else None
+
+        return {"preguntas": preguntas, "siguiente_cursor": siguiente}
+
+    def obtener(self, ruta: RutaArchivo, id_temporal: str) -> Optional[Dict[str, Any]]:
+        """Pregunta del archivo `ruta` con ese id_temporal, o None"""
+        clave = Path(ruta).as_posix()
+        with self._lock:
+            for seq in self._por_archivo.get(clave, []):
+                if self._entradas[seq].get("id_temporal") == id_temporal:
+                    return dict(self._entradas[seq])
+        return None
+
+    @staticmethod
+    def _proyectar(entrada: Dict[str, Any], campos: Optional[List[str]]) -> Dict[str, Any]:
+        if not campos:
+            return dict(entrada)
+        claves = ["id_temporal", "archivo"] + [c for c in campos if c not in ("id_temporal", "archivo")]
+        return {c: entrada[c] for c in claves if c in entrada}
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "preguntas": len(self._entradas),
+                "archivos": len(self._por_archivo),
+                "cargado": self.cargado,
+            }
+
+
+indice_preguntas = IndicePreguntas()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Almacén indexado de preguntas (SQLite).
+
+Reemplaza el ciclo leer-todo / agregar / reescribir-todo de los JSON por tema:
+- Insertar una pregunta es O(1) (un INSERT, sin parsear el archivo del tema).
+- Los IDs temporales se reservan de forma atómica con un contador por archivo.
+- El exportador regenera los JSON de banco_preguntas/ y banco_procesos/ con el
+  mismo formato de siempre ({"materia", "tema", "preguntas": [...]}).
+
+Cada archivo JSON se identifica por su ruta relativa. La primera vez que se
+usa una ruta que ya existe en disco, su contenido se importa al almacén.
+El almacén guarda la firma (mtime y tamaño) del JSON tras cada importación o
+exportación: si el archivo cambia fuera de la app (git pull, edición a mano),
+se reimporta al tocar ese tema, conservando las preguntas aún no exportadas,
+en vez de pisarlo con la siguiente exportación. Si el JSON cambiado no es
+válido, no se exporta encima hasta que se corrija.
+
+Los índices de la app se construyen al arrancar leyendo el almacén: después de
+un git pull que traiga JSON nuevos o modificados, hay que ejecutar
+`python question_store.py importar` antes de levantar la app.
+
+Variables de entorno:
+- QUESTION_STORE_PATH: archivo SQLite (default banco.sqlite3)
+- QUESTION_STORE_EXPORT_ON_WRITE: "true" para regenerar el JSON del tema en
+  cada inserción, dentro de la misma petición (default false: O(n) por inserción)
+- QUESTION_STORE_EXPORT_DELAY: con la opción anterior desactivada, segundos que
+  espera el exportador en segundo plano; las inserciones en el mismo tema dentro
+  de ese margen se exportan juntas (default 5)
+
+El almacén es la fuente de verdad (la app y los índices leen de él); los JSON
+son una copia para herramientas externas, que se regenera con retraso.
+
+Uso por consola:
+    python question_store.py exportar     # regenera todos los JSON desde el almacén
+    python question_store.py importar     # (re)importa todos los JSON al almacén
+"""
+
+from __future__ import annotations
+
+import argparse
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+from atomic_io import bloqueo_archivo, escribir_atomico
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+QUESTION_STORE_PATH = Path(os.getenv("QUESTION_STORE_PATH", "banco.sqlite3"))
+QUESTION_STORE_EXPORT_ON_WRITE = os.getenv("QUESTION_STORE_EXPORT_ON_WRITE", "false").lower() not in ("0", "false", "no")
+QUESTION_STORE_EXPORT_DELAY = float(os.getenv("QUESTION_STORE_EXPORT_DELAY", "5"))
+
+BASES_BANCO = [Path("banco_preguntas"), Path("banco_procesos")]
+
+RutaArchivo = Union[str, Path]
+
+_SELECT_FIRMA = (
+    "SELECT id, materia, tema, disco_mtime, disco_tamano, exportado_hasta FROM archivos WHERE ruta = ?"
+)
+
+
+def prefijo_id(materia: str, tema: str) -> str:
+    """Prefijo de id_temporal: [materia_3chars]_[tema_3chars]_"""
+    return f"{materia[:3]}_{tema[:3]}_"
+
+
+def _numero_de_id(id_temporal: Any, prefijo: str) -> Optional[int]:
+    if not isinstance(id_temporal, str) or not id_temporal.startswith(prefijo):
+        return None
+    try:
+        return int(id_temporal.split("_")[-1])
+    except ValueError:
+        return None
+
+
+def _clave_ruta(ruta: RutaArchivo) -> str:
+    return Path(ruta).as_posix()
+
+
+def _firma_disco(ruta: RutaArchivo) -> Optional[Tuple[int, int]]:
+    """(mtime_ns, tamaño) del JSON en disco, o None si no existe"""
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _leer_json_tema(path: Path) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """(cabecera, preguntas) del JSON de un tema, o None si no es válido"""
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    preguntas = [p for p in data.get("preguntas") or [] if isinstance(p, dict)]
+    return {k: v for k, v in data.items() if k != "preguntas"}, preguntas
+
+
+def _ultimo_numero(cabecera: Dict[str, Any], preguntas: List[Dict[str, Any]], materia: str, tema: str) -> int:
+    prefijo = prefijo_id(cabecera.get("materia", materia), cabecera.get("tema", tema))
+    return max((n for n in (_numero_de_id(p.get("id_temporal"), prefijo) for p in preguntas) if n is not None), default=0)
+
+
+class QuestionStore:
+    """Repositorio de preguntas respaldado por SQLite (una conexión por hilo)"""
+
+    def __init__(self, path: RutaArchivo = QUESTION_STORE_PATH):
+        self.path = Path(path)
+        self._local = threading.local()
+        # Exportación diferida: ruta -> momento (monotonic) en que toca exportarla
+        self._pendientes: Dict[str, float] = {}
+        self._cond_exportar = threading.Condition()
+        self._hilo_exportar: Optional[threading.Thread] = None
+        self._exportando: Set[str] = set()
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.path.parent != Path("."):
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+            # isolation_level=None: las transacciones se abren explícitamente
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS archivos (
+                    id INTEGER PRIMARY KEY,
+                    ruta TEXT NOT NULL UNIQUE,
+                    materia TEXT NOT NULL,
+                    tema TEXT NOT NULL,
+                    cabecera TEXT NOT NULL,
+                    ultimo_id INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    disco_mtime INTEGER,
+                    disco_tamano INTEGER,
+                    exportado_hasta INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS preguntas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    archivo_id INTEGER NOT NULL REFERENCES archivos(id),
+                    id_temporal TEXT,
+                    datos TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_preguntas_archivo ON preguntas(archivo_id, id);
+                CREATE TABLE IF NOT EXISTS contadores (
+                    nombre TEXT PRIMARY KEY,
+                    valor INTEGER NOT NULL
+                );
+                """
+            )
+            self._migrar(conn)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _migrar(conn: sqlite3.Connection) -> None:
+        """Añade a almacenes de versiones anteriores las columnas de firma del JSON"""
+        columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(archivos)")}
+        for columna, tipo in (
+            ("disco_mtime", "INTEGER"),
+            ("disco_tamano", "INTEGER"),
+            ("exportado_hasta", "INTEGER NOT NULL DEFAULT 0"),
+        ):
+            if columna in columnas:
+                continue
+            try:
+                conn.execute(f"ALTER TABLE archivos ADD COLUMN {columna} {tipo}")
+            except sqlite3.OperationalError as e:
+                # Otro proceso la añadió a la vez
+                if "duplicate column" not in str(e):
+                    raise
+
+    @contextmanager
+    def _transaccion(self) -> Iterator[sqlite3.Connection]:
+        """BEGIN IMMEDIATE: toma el lock de escritura al inicio (seguro entre procesos)"""
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    # ----- archivos -----
+
+    def _asegurar_archivo(self, conn: sqlite3.Connection, ruta: RutaArchivo, materia: str, tema: str) -> int:
+        """
+        Devuelve el id del archivo; si es nuevo, importa su JSON de disco. Si ya
+        estaba en el almacén pero el JSON cambió desde la última sincronización,
+        lo reimporta (ver _revisar_disco).
+        """
+        clave = _clave_ruta(ruta)
+        row = conn.execute(_SELECT_FIRMA, (clave,)).fetchone()
+        if row:
+            self._revisar_disco(conn, row, ruta)
+            return row[0]
+
+        cabecera: Dict[str, Any] = {"materia": materia, "tema": tema}
+        preguntas: List[Dict[str, Any]] = []
+        path = Path(ruta)
+        if path.exists():
+            leido = _leer_json_tema(path)
+            if leido is None:
+                logger.warning(f"⚠️ JSON inválido en {path}, se inicia el tema vacío")
+            else:
+                cabecera, preguntas = leido
+
+        cur = conn.execute(
+            "INSERT INTO archivos (ruta, materia, tema, cabecera, ultimo_id, total) VALUES (?, ?, ?, ?, ?, ?)",
+            (clave, materia, tema, json.dumps(cabecera, ensure_ascii=False),
+             _ultimo_numero(cabecera, preguntas, materia, tema), len(preguntas)),
+        )
+        archivo_id = cur.lastrowid
+        conn.executemany(
+            "INSERT INTO preguntas (archivo_id, id_temporal, datos) VALUES (?, ?, ?)",
+            [(archivo_id, p.get("id_temporal"), json.dumps(p, ensure_ascii=False)) for p in preguntas],
+        )
+        self._marcar_sincronizado(conn, archivo_id, ruta)
+        return archivo_id
+
+    def _marcar_sincronizado(self, conn: sqlite3.Connection, archivo_id: int, ruta: RutaArchivo) -> None:
+        """Guarda la firma del JSON en disco y hasta qué pregunta refleja el almacén"""
+        firma = _firma_disco(ruta) or (None, None)
+        hasta = conn.execute("SELECT COALESCE(MAX(id), 0) FROM preguntas WHERE archivo_id = ?", (archivo_id,)).fetchone()[0]
+        conn.execute(
+            "UPDATE archivos SET disco_mtime = ?, disco_tamano = ?, exportado_hasta = ? WHERE id = ?",
+            (*firma, hasta, archivo_id),
+        )
+
+    def _revisar_disco(self, conn: sqlite3.Connection, row: Tuple[Any, ...], ruta: RutaArchivo) -> bool:
+        """
+        Compara el JSON en disco con la firma de la última sincronización. Si
+        cambió (git pull, edición a mano), lo reimporta: las preguntas del disco
+        reemplazan a las del almacén y se conservan detrás las que se agregaron
+        después de la última exportación y el disco no tiene. Devuelve False si
+        el JSON cambiado no es válido: en ese caso no debe exportarse encima.
+        """
+        archivo_id, materia, tema, mtime, tamano, hasta = row
+        firma = _firma_disco(ruta)
+        if firma is None or firma == (mtime, tamano):
+            return True
+        if mtime is None:
+            # Almacén de una versión anterior, sin firma: se adopta la copia actual
+            conn.execute("UPDATE archivos SET disco_mtime = ?, disco_tamano = ? WHERE id = ?", (*firma, archivo_id))
+            return True
+
+        leido = _leer_json_tema(Path(ruta))
+        if leido is None:
+            logger.warning(f"⚠️ {ruta} cambió en disco y no es un JSON válido: no se reimporta ni se sobrescribe")
+            return False
+        cabecera, preguntas = leido
+        ids_disco = {p.get("id_temporal") for p in preguntas}
+        pendientes = [
+            (id_temporal, datos)
+            for id_temporal, datos in conn.execute(
+                "SELECT id_temporal, datos FROM preguntas WHERE archivo_id = ? AND id > ? ORDER BY id", (archivo_id, hasta)
+            ).fetchall()
+            if id_temporal is None or id_temporal not in ids_disco
+        ]
+
+        conn.execute("DELETE FROM preguntas WHERE archivo_id = ?", (archivo_id,))
+        conn.executemany(
+            "INSERT INTO preguntas (archivo_id, id_temporal, datos) VALUES (?, ?, ?)",
+            [(archivo_id, p.get("id_temporal"), json.dumps(p, ensure_ascii=False)) for p in preguntas],
+        )
+        self._marcar_sincronizado(conn, archivo_id, ruta)
+        conn.executemany(
+            "INSERT INTO preguntas (archivo_id, id_temporal, datos) VALUES (?, ?, ?)",
+            [(archivo_id, id_temporal, datos) for id_temporal, datos in pendientes],
+        )
+        # ultimo_id nunca retrocede: los IDs ya reservados no se reutilizan
+        conn.execute(
+            "UPDATE archivos SET cabecera = ?, total = ?, ultimo_id = MAX(ultimo_id, ?) WHERE id = ?",
+            (json.dumps(cabecera, ensure_ascii=False), len(preguntas) + len(pendientes),
+             _ultimo_numero(cabecera, preguntas, materia, tema), archivo_id),
+        )
+        logger.warning(
+            f"⚠️ {ruta} cambió fuera de la app: se reimporta ({len(preguntas)} preguntas del disco, "
+            f"{len(pendientes)} pendientes de exportar conservadas)"
+        )
+        return True
+
+    def reservar_numero_id(self, ruta: RutaArchivo, materia: str, tema: str) -> int:
+        """Reserva de forma atómica el siguiente número de id_temporal del archivo"""
+        with self._transaccion() as conn:
+            archivo_id = self._asegurar_archivo(conn, ruta, materia, tema)
+            conn.execute("UPDATE archivos SET ultimo_id = ultimo_id + 1 WHERE id = ?", (archivo_id,))
+            return conn.execute("SELECT ultimo_id FROM archivos WHERE id = ?", (archivo_id,)).fetchone()[0]
+
+    def agregar_pregunta(self, ruta: RutaArchivo, materia: str, tema: str, pregunta: Dict[str, Any]) -> int:
+        """Inserta una pregunta (O(1)) y devuelve el total de preguntas del archivo"""
+        with self._transaccion() as conn:
+            archivo_id = self._asegurar_archivo(conn, ruta, materia, tema)
+            conn.execute(
+                "INSERT INTO preguntas (archivo_id, id_temporal, datos) VALUES (?, ?, ?)",
+                (archivo_id, pregunta.get("id_temporal"), json.dumps(pregunta, ensure_ascii=False)),
+            )
+            # Si el ID no vino de reservar_numero_id, mantener el contador por delante
+            numero = _numero_de_id(pregunta.get("id_temporal"), prefijo_id(materia, tema))
+            if numero is not None:
+                conn.execute("UPDATE archivos SET ultimo_id = MAX(ultimo_id, ?) WHERE id = ?", (numero, archivo_id))
+            conn.execute("UPDATE archivos SET total = total + 1 WHERE id = ?", (archivo_id,))
+            return conn.execute("SELECT total FROM archivos WHERE id = ?", (archivo_id,)).fetchone()[0]
+
+    def reservar_contador(self, nombre: str, valor_inicial: Callable[[], int]) -> int:
+        """
+        Incrementa de forma atómica un contador persistente y devuelve el nuevo valor.
+        Si el contador no existe, se inicializa una única vez con `valor_inicial()`
+        (por ejemplo, reconstruyéndolo a partir de los archivos en disco).
+        """
+        with self._transaccion() as conn:
+            row = conn.execute("SELECT valor FROM contadores WHERE nombre = ?", (nombre,)).fetchone()
+            valor = (row[0] if row else valor_inicial()) + 1
+            conn.execute("INSERT OR REPLACE INTO contadores (nombre, valor) VALUES (?, ?)", (nombre, valor))
+            return valor
+
+    def obtener_archivo(self, ruta: RutaArchivo) -> Optional[Dict[str, Any]]:
+        """Contenido del archivo con el formato JSON de siempre, o None si no está en el almacén"""
+        conn = self._db()
+        row = conn.execute("SELECT id, cabecera FROM archivos WHERE ruta = ?", (_clave_ruta(ruta),)).fetchone()
+        if row is None:
+            return None
+        archivo_id, cabecera = row
+        preguntas = [
+            json.loads(datos)
+            for (datos,) in conn.execute("SELECT datos FROM preguntas WHERE archivo_id = ? ORDER BY id", (archivo_id,))
+        ]
+        return {**json.loads(cabecera), "preguntas": preguntas}
+
+    def listar_rutas(self) -> List[str]:
+        return [ruta for (ruta,) in self._db().execute("SELECT ruta FROM archivos ORDER BY ruta")]
+
+    def totales(self) -> Dict[str, int]:
+        """Número de preguntas por archivo (sin leer las preguntas)"""
+        return dict(self._db().execute("SELECT ruta, total FROM archivos"))
+
+    # ----- exportación / importación -----
+
+    def exportar_archivo(self, ruta: RutaArchivo) -> Optional[Dict[str, Any]]:
+        """
+        Regenera el JSON del tema a partir del almacén. La lectura y la escritura
+        ocurren bajo el bloqueo del archivo, así una exportación con datos viejos
+        nunca pisa a una más reciente; el reemplazo es atómico (temporal + rename).
+        Si el JSON cambió en disco desde la última sincronización, primero se
+        reimporta; la transacción se mantiene hasta guardar la nueva firma para
+        que ninguna inserción vea el archivo recién escrito como un cambio ajeno.
+        """
+        with bloqueo_archivo(ruta):
+            with self._transaccion() as conn:
+                row = conn.execute(_SELECT_FIRMA, (_clave_ruta(ruta),)).fetchone()
+                if row is None:
+                    return None
+                if not self._revisar_disco(conn, row, ruta):
+                    return None
+                data = self.obtener_archivo(ruta)
+                escribir_atomico(ruta, json.dumps(data, indent=2, ensure_ascii=False))
+                self._marcar_sincronizado(conn, row[0], ruta)
+            return data
+
+    def programar_exportacion(self, ruta: RutaArchivo, retraso: float = QUESTION_STORE_EXPORT_DELAY) -> None:
+        """
+        Exporta el JSON del tema en segundo plano dentro de `retraso` segundos.
+        Si ya estaba programado se mantiene el plazo original: una ráfaga de
+        inserciones en el tema produce una sola exportación.
+        """
+        with self._cond_exportar:
+            self._pendientes.setdefault(str(ruta), time.monotonic() + retraso)
+            if self._hilo_exportar is None:
+                self._hilo_exportar = threading.Thread(target=self._exportador, name="exportador-json", daemon=True)
+                self._hilo_exportar.start()
+                # El hilo es daemon: lo que quede programado se exporta al salir
+                atexit.register(self.exportar_pendientes)
+            self._cond_exportar.notify()
+
+    def _exportador(self) -> None:
+        while True:
+            with self._cond_exportar:
+                while True:
+                    ahora = time.monotonic()
+                    vencidas = [r for r, t in self._pendientes.items() if t <= ahora]
+                    if vencidas:
+                        break
+                    espera = min(self._pendientes.values()) - ahora if self._pendientes else None
+                    self._cond_exportar.wait(espera)
+                for ruta in vencidas:
+                    del self._pendientes[ruta]
+                self._exportando.update(vencidas)
+            for ruta in vencidas:
+                try:
+                    self.exportar_archivo(ruta)
+                except Exception as e:
+                    logger.error(f"❌ Error exportando {ruta}: {e}")
+                finally:
+                    with self._cond_exportar:
+                        self._exportando.discard(ruta)
+
+    def exportar_pendientes(self) -> int:
+        """
+        Exporta ya lo programado (al apagar la app o al salir del proceso).
+        También repite las exportaciones que el hilo tenga en curso, que se
+        cortarían al terminar el proceso.
+        """
+        with self._cond_exportar:
+            rutas = list(dict.fromkeys([*self._pendientes, *self._exportando]))
+            self._pendientes.clear()
+        for ruta in rutas:
+            self.exportar_archivo(ruta)
+        return len(rutas)
+
+    def exportar_todo(self) -> int:
+        rutas = self.listar_rutas()
+        for ruta in rutas:
+            self.exportar_archivo(ruta)
+        return len(rutas)
+
+    def importar_archivo(self, ruta: RutaArchivo) -> bool:
+        """(Re)importa un JSON de tema desde disco, reemplazando lo que hubiera en el almacén"""
+        path = Path(ruta)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return False
+        if not isinstance(data, dict) or "tema" not in data or not isinstance(data.get("preguntas"), list):
+            return False
+
+        clave = _clave_ruta(ruta)
+        with self._transaccion() as conn:
+            row = conn.execute("SELECT id FROM archivos WHERE ruta = ?", (clave,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM preguntas WHERE archivo_id = ?", (row[0],))
+                conn.execute("DELETE FROM archivos WHERE id = ?", (row[0],))
+            self._asegurar_archivo(conn, path, str(data.get("materia", "")), str(data["tema"]))
+        return True
+
+    def importar_todo(self, bases: Optional[List[Path]] = None) -> int:
+        total = 0
+        for base in bases or BASES_BANCO:
+            if not base.exists():
+                continue
+            for path in sorted(base.rglob("*.json")):
+                if self.importar_archivo(path):
+                    total += 1
+        return total
+
+
+question_store = QuestionStore()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Almacén indexado del banco de preguntas.")
+    parser.add_argument("accion", choices=["exportar", "importar"], help="exportar: almacén -> JSON; importar: JSON -> almacén")
+    parser.add_argument("--db", default=None, help="Ruta del archivo SQLite (override de QUESTION_STORE_PATH)")
+    args = parser.parse_args(argv)
+
+    store = QuestionStore(args.db) if args.db else question_store
+    if args.accion == "exportar":
+        n = store.exportar_todo()
+        print(f"OK: exportados {n} archivo(s) JSON desde {store.path}")
+    else:
+        n = store.importar_todo()
+        print(f"OK: importados {n} archivo(s) JSON a {store.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
@@ -0,0 +1,415 @@
+"""
+Política de reintentos para llamadas a proveedores de IA.
+
+Usada tanto por las rutas asíncronas de ai_services.py / ai_variation.py como
+por el generador batch (generador_batch/generar_sinteticas.py, síncrono).
+
+- Clasificación de errores: límite de cuota (429), error del servidor (5xx),
+  red/timeout, respuesta inválida (JSON no parseable) y error definitivo
+  (400/401/403/404: reintentar no sirve).
+- Espera exponencial con jitter completo, respetando Retry-After (cabecera
+  HTTP o `retryDelay` en el cuerpo de errores de Gemini) cuando el proveedor
+  lo indica.
+- Circuit breaker por modelo: tras varios fallos transitorios seguidos se
+  dejan de enviar peticiones durante un tiempo y se falla de inmediato.
+- Métricas: intentos, reintentos, fallos por clase y segundos esperados; la
+  latencia y los tokens de cada intento HTTP van además a /metrics (metrics.py).
+
+Variables de entorno:
+- AI_RETRY_MAX: reintentos máximos por llamada (default 3)
+- AI_RETRY_BASE_DELAY: espera base en segundos (default 1)
+- AI_RETRY_MAX_DELAY: espera máxima por reintento en segundos (default 60)
+- AI_CIRCUIT_THRESHOLD: fallos transitorios seguidos que abren el circuito (default 5)
+- AI_CIRCUIT_RESET: segundos que el circuito permanece abierto (default 30)
+"""
+
+import asyncio
+import email.utils
+import json
+import os
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from app_logging import get_logger
+from metrics import ai_request_duration, registrar_tokens, separar_clave, tokens_de_respuesta
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+AI_RETRY_MAX = int(os.getenv("AI_RETRY_MAX", "3"))
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", "1"))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "60"))
+AI_CIRCUIT_THRESHOLD = int(os.getenv("AI_CIRCUIT_THRESHOLD", "5"))
+AI_CIRCUIT_RESET = float(os.getenv("AI_CIRCUIT_RESET", "30"))
+
+# Clases de error
+RATE_LIMIT = "rate_limit"
+SERVIDOR = "servidor"
+RED = "red"
+RESPUESTA_INVALIDA = "respuesta_invalida"
+DEFINITIVO = "definitivo"
+
+# Clases que cuentan para abrir el circuito (el proveedor está saturado o caído)
+CLASES_TRANSITORIAS = {RATE_LIMIT, SERVIDOR, RED}
+CLASES_REINTENTABLES = CLASES_TRANSITORIAS | {RESPUESTA_INVALIDA}
+
+STATUS_REINTENTABLES = {408, 425, 429, 500, 502, 503, 504, 529}
+
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s")
+
+
+class CircuitOpenError(Exception):
+    """El circuito del modelo está abierto: no se envía la petición"""
+
+    def __init__(self, key: str, retry_in: float):
+        super().__init__(f"Circuito abierto para {key}; reintentar en {retry_in:.0f}s")
+        self.key = key
+        self.retry_in = retry_in
+
+
+class RetryableStatusError(Exception):
+    """Respuesta HTTP con un código reintentable (429, 5xx)"""
+
+    def __init__(self, response: Any):
+        super().__init__(f"HTTP {response.status_code}: {response.text[:200]}")
+        self.response = response
+        self.status_code = response.status_code
+        self.retry_after = parse_retry_after(response.headers.get("retry-after"))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After en segundos o como fecha HTTP"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        fecha = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, fecha.timestamp() - time.time())
+
+
+def _status_de(exc: BaseException) -> Optional[int]:
+    """Código HTTP de una excepción de httpx, google-genai u otra librería"""
+    response = getattr(exc, "response", None)
+    for obj in (exc, response):
+        for attr in ("status_code", "code", "status"):
+            value = getattr(obj, attr, None)
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+    match = re.search(r"\b(429|5\d\d)\b", str(exc))
+    return int(match.group(1)) if match else None
+
+
+def retry_after_de(exc: BaseException) -> Optional[float]:
+    """Espera sugerida por el proveedor (cabecera Retry-After o retryDelay de Gemini)"""
+    explicit = getattr(exc, "retry_after", None)
+    if explicit is not None:
+        return explicit
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        try:
+            value = parse_retry_after(headers.get("retry-after"))
+        except Exception:
+            value = None
+        if value is not None:
+            return value
+    match = _RETRY_DELAY_RE.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+def classify_error(exc: BaseException) -> str:
+    """Clase de error usada para decidir si se reintenta"""
+    if isinstance(exc, CircuitOpenError):
+        return DEFINITIVO
+    if isinstance(exc, (json.JSONDecodeError, ValueError)) and not isinstance(exc, UnicodeError):
+        return RESPUESTA_INVALIDA
+    if isinstance(exc, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return RED
+    nombre = type(exc).__name__
+    if any(t in nombre for t in ("Timeout", "Connect", "Network", "Transport", "RemoteProtocol", "ReadError")):
+        return RED
+
+    status = _status_de(exc)
+    if status == 429 or "RESOURCE_EXHAUSTED" in str(exc):
+        return RATE_LIMIT
+    if status is not None and status in STATUS_REINTENTABLES:
+        return SERVIDOR
+    if status is not None:
+        return DEFINITIVO
+    # Error desconocido: se reintenta una vez como si fuera de red
+    return RED
+
+
+@dataclass
+class RetryPolicy:
+    """Espera exponencial con jitter completo, acotada y con Retry-After"""
+    max_retries: int = AI_RETRY_MAX
+    base_delay: float = AI_RETRY_BASE_DELAY
+    max_delay: float = AI_RETRY_MAX_DELAY
+    multiplier: float = 2.0
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Segundos a esperar antes del reintento número `attempt` (desde 1)"""
+        techo = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        espera = random.uniform(0, techo)
+        if retry_after is not None:
+            # El proveedor sabe cuándo se libera la cuota; no esperar menos que eso
+            espera = max(espera, min(retry_after, self.max_delay * 5))
+        return espera
+
+    def should_retry(self, clase: str, attempt: int) -> bool:
+        return clase in CLASES_REINTENTABLES and attempt <= self.max_retries
+
+
+class CircuitBreaker:
+    """
+    Circuito por modelo: cerrado -> abierto tras `threshold` fallos transitorios
+    seguidos; tras `reset_timeout` deja pasar una petición de prueba (semiabierto)
+    y vuelve a cerrarse si tiene éxito.
+    """
+
+    def __init__(self, key: str, threshold: int = AI_CIRCUIT_THRESHOLD, reset_timeout: float = AI_CIRCUIT_RESET):
+        self.key = key
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.fallos = 0
+        self.abierto_hasta = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self) -> str:
+        if self.abierto_hasta == 0.0:
+            return "cerrado"
+        return "abierto" if time.monotonic() < self.abierto_hasta else "semiabierto"
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.abierto_hasta == 0.0 or self.threshold <= 0:
+                return
+            restante = self.abierto_hasta - time.monotonic()
+            if restante > 0 or self._prueba_en_curso:
+                raise CircuitOpenError(self.key, max(restante, 0.0))
+            self._prueba_en_curso = True
+
+    def release_probe(self) -> None:
+        """Libera la prueba de semiabierto sin resultado (llamada cancelada)"""
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.fallos = 0
+            self.abierto_hasta = 0.0
+            self._prueba_en_curso = False
+
+    def record_failure(self, clase: str) -> bool:
+        """Registra un fallo; devuelve True si el circuito acaba de abrirse"""
+        with self._lock:
+            self._prueba_en_curso = False
+            if clase not in CLASES_TRANSITORIAS or self.threshold <= 0:
+                return False
+            self.fallos += 1
+            if self.fallos >= self.threshold or self.abierto_hasta:
+                self.abierto_hasta = time.monotonic() + self.reset_timeout
+                return True
+            return False
+
+
+class RetryMetrics:
+    """Contadores por modelo; seguros entre hilos"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._datos: Dict[str, Dict[str, Any]] = {}
+
+    def _entrada(self, key: str) -> Dict[str, Any]:
+        if key not in self._datos:
+            self._datos[key] = {
+                "llamadas": 0,
+                "intentos": 0,
+                "reintentos": 0,
+                "exitos": 0,
+                "fallos": 0,
+                "espera_s": 0.0,
+                "circuito_abierto": 0,
+                "rechazadas_por_circuito": 0,
+                "errores": {},
+            }
+        return self._datos[key]
+
+    def incr(self, key: str, campo: str, valor: float = 1) -> None:
+        with self._lock:
+            self._entrada(key)[campo] += valor
+
+    def error(self, key: str, clase: str) -> None:
+        with self._lock:
+            errores = self._entrada(key)["errores"]
+            errores[clase] = errores.get(clase, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            out = json.loads(json.dumps(self._datos))
+        for key, datos in out.items():
+            datos["espera_s"] = round(datos["espera_s"], 3)
+            datos["circuito"] = get_breaker(key).estado
+        return out
+
+
+retry_metrics = RetryMetrics()
+default_policy = RetryPolicy()
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """Circuit breaker compartido por clave (p. ej. "gemini:gemini-2.0-flash")"""
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(key)
+        return breaker
+
+
+def _registrar_fallo(key: str, breaker: CircuitBreaker, exc: BaseException) -> str:
+    clase = classify_error(exc)
+    retry_metrics.error(key, clase)
+    if breaker.record_failure(clase):
+        retry_metrics.incr(key, "circuito_abierto")
+        logger.warning(f"🔌 Circuito abierto para {key} durante {breaker.reset_timeout:.0f}s")
+    return clase
+
+
+def call_with_retry(
+    fn: Callable[[], T],
+    key: str,
+    policy: Optional[RetryPolicy] = None,
+    wait_on_open: bool = False,
+) -> T:
+    """
+    Ejecuta `fn` (síncrona) con reintentos, circuit breaker y métricas.
+    Con `wait_on_open` un circuito abierto no falla: el hilo espera a que se
+    cierre (útil en el batch, donde todos los hilos pausan juntos).
+    """
+    policy = policy or default_policy
+    breaker = get_breaker(key)
+    retry_metrics.incr(key, "llamadas")
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError as exc:
+            if wait_on_open:
+                espera = max(exc.retry_in, policy.base_delay)
+                retry_metrics.incr(key, "espera_s", espera)
+                time.sleep(espera)
+                continue
+            retry_metrics.incr(key, "rechazadas_por_circuito")
+            retry_metrics.incr(key, "fallos")
+            raise
+        retry_metrics.incr(key, "intentos")
+        try:
+            result = fn()
+        except BaseException as exc:
+            if not isinstance(exc, Exception):
+                breaker.release_probe()
+                raise
+            clase = _registrar_fallo(key, breaker, exc)
+            attempt += 1
+            if not policy.should_retry(clase, attempt):
+                retry_metrics.incr(key, "fallos")
+                raise
+            espera = policy.delay(attempt, retry_after_de(exc))
+            logger.warning(f"🔁 {key}: {clase} ({exc}); reintento {attempt}/{policy.max_retries} en {espera:.1f}s")
+            retry_metrics.incr(key, "reintentos")
+            retry_metrics.incr(key, "espera_s", espera)
+            time.sleep(espera)
+            continue
+        breaker.record_success()
+        retry_metrics.incr(key, "exitos")
+        return result
+
+
+async def async_call_with_retry(fn: Callable[[], Awaitable[T]], key: str, policy: Optional[RetryPolicy] = None) -> T:
+    """Versión asíncrona de call_with_retry (la espera no bloquea el event loop)"""
+    policy = policy or default_policy
+    breaker = get_breaker(key)
+    retry_metrics.incr(key, "llamadas")
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            retry_metrics.incr(key, "rechazadas_por_circuito")
+            retry_metrics.incr(key, "fallos")
+            raise
+        retry_metrics.incr(key, "intentos")
+        try:
+            result = await fn()
+        except BaseException as exc:
+            if not isinstance(exc, Exception):
+                # Cancelada (timeout del router, hedge perdedor): sin esto la prueba
+                # de semiabierto quedaría tomada y el circuito no se cerraría nunca
+                breaker.release_probe()
+                raise
+            clase = _registrar_fallo(key, breaker, exc)
+            attempt += 1
+            if not policy.should_retry(clase, attempt):
+                retry_metrics.incr(key, "fallos")
+                raise
+            espera = policy.delay(attempt, retry_after_de(exc))
+            logger.warning(f"🔁 {key}: {clase} ({exc}); reintento {attempt}/{policy.max_retries} en {espera:.1f}s")
+            retry_metrics.incr(key, "reintentos")
+            retry_metrics.incr(key, "espera_s", espera)
+            await asyncio.sleep(espera)
+            continue
+        breaker.record_success()
+        retry_metrics.incr(key, "exitos")
+        return result
+
+
+async def post_with_retry(client: Any, key: str, url: str, **kwargs: Any) -> Any:
+    """
+    client.post con reintentos ante 429/5xx y errores de red. Devuelve la última
+    respuesta (también si no es 200) para que el llamador conserve su manejo
+    de errores; solo lanza excepción si la red falla o el circuito está abierto.
+    """
+    proveedor, modelo = separar_clave(key)
+
+    async def _post():
+        inicio = time.perf_counter()
+        try:
+            response = await client.post(url, **kwargs)
+        except Exception:
+            ai_request_duration.observe(time.perf_counter() - inicio, provider=proveedor, model=modelo, outcome="error_red")
+            raise
+        ai_request_duration.observe(
+            time.perf_counter() - inicio, provider=proveedor, model=modelo, outcome=str(response.status_code)
+        )
+        if response.status_code in STATUS_REINTENTABLES:
+            raise RetryableStatusError(response)
+        if response.status_code == 200:
+            try:
+                registrar_tokens(key, *tokens_de_respuesta(response.json()))
+            except ValueError:
+                pass
+        return response
+
+    try:
+        return await async_call_with_retry(_post, key)
+    except RetryableStatusError as exc:
+        # Reintentos agotados: el llamador recibe la última respuesta del proveedor
+        return exc.response
+
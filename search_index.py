@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Índice de búsqueda de texto completo sobre las preguntas (GET /api/buscar).
+
+Usa SQLite FTS5 con ranking BM25 sobre `pregunta`, `opciones` y `explicacion`
+de banco_preguntas/, banco_procesos/ y generador_batch/salida/, para encontrar
+preguntas existentes antes de redactar un duplicado.
+
+El texto se normaliza igual al indexar y al buscar:
+- normalizar_busqueda (text_normalization.py): minúsculas y sin tildes (la
+  misma regla que normalizar_texto)
+- LaTeX: los comandos quedan como palabras (\\frac -> frac, \\sqrt -> sqrt), se
+  quitan $$, llaves, ^ y _ (x^{2} y x^2 dan los mismos tokens), \\left/\\right
+  y los espacios de LaTeX; la coma decimal se unifica con el punto
+
+El índice es derivado (se puede borrar y se reconstruye) y se actualiza de
+forma incremental:
+- al iniciar, sincronizar() solo reindexa los archivos cuya huella cambió
+  (mtime/tamaño en disco, o total de preguntas si el archivo está en el
+  almacén de question_store.py) y quita los que ya no existen
+- cada guardado desde main.py indexa la pregunta nueva o el archivo reescrito
+
+Variables de entorno:
+- SEARCH_INDEX_PATH: archivo SQLite del índice (default .cache/search_index.sqlite3)
+
+Uso por consola:
+    python search_index.py sincronizar
+    python search_index.py buscar "ecuacion cuadratica \\sqrt"
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+from app_logging import get_logger
+from question_store import BASES_BANCO, RutaArchivo, question_store
+from text_normalization import normalizar_busqueda
+
+load_dotenv()
+
+logger = get_logger(__name__)
+
+SEARCH_INDEX_PATH = Path(os.getenv("SEARCH_INDEX_PATH", ".cache/search_index.sqlite3"))
+
+BASE_GENERADOR = Path("generador_batch/salida")
+BASES_BUSQUEDA = BASES_BANCO + [BASE_GENERADOR]
+
+# Peso de cada columna en BM25: el enunciado pesa más que opciones y explicación
+PESOS_BM25 = (3.0, 1.0, 1.0)
+
+
+def _origen(ruta: str) -> str:
+    return "generador" if ruta.startswith(BASE_GENERADOR.as_posix() + "/") else "banco"
+
+
+def _texto_opciones(opciones: Any) -> str:
+    if isinstance(opciones, dict):
+        return " ".join(str(v) for v in opciones.values() if v)
+    if isinstance(opciones, list):
+        return " ".join(str(v) for v in opciones if v)
+    return ""
+
+
+class SearchIndex:
+    """Índice FTS5 (una conexión por hilo, como QuestionStore)"""
+
+    def __init__(self, path: RutaArchivo = SEARCH_INDEX_PATH):
+        self.path = Path(path)
+        self._local = threading.local()
+
+    def _db(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS documentos (
+                    id INTEGER PRIMARY KEY,
+                    archivo TEXT NOT NULL,
+                    posicion INTEGER NOT NULL,
+                    id_temporal TEXT,
+                    materia TEXT,
+                    tema TEXT,
+                    origen TEXT NOT NULL,
+                    pregunta TEXT NOT NULL,
+                    UNIQUE (archivo, posicion)
+                );
+                CREATE INDEX IF NOT EXISTS idx_documentos_materia ON documentos(materia);
+                CREATE TABLE IF NOT EXISTS huellas (
+                    archivo TEXT PRIMARY KEY,
+                    huella TEXT NOT NULL
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(
+                    pregunta, opciones, explicacion, tokenize = 'unicode61'
+                );
+                """
+            )
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaccion(self) -> Iterator[sqlite3.Connection]:
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    # ----- escritura -----
+
+    def _insertar(self, conn: sqlite3.Connection, ruta: str, posicion: int, cabecera: Dict[str, Any], pregunta: Dict[str, Any]) -> None:
+        existente = conn.execute(
+            "SELECT id FROM documentos WHERE archivo = ? AND posicion = ?", (ruta, posicion)
+        ).fetchone()
+        if existente:
+            conn.execute("DELETE FROM fts WHERE rowid = ?", existente)
+            conn.execute("DELETE FROM documentos WHERE id = ?", existente)
+        cur = conn.execute(
+            "INSERT INTO documentos (archivo, posicion, id_temporal, materia, tema, origen, pregunta) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                ruta,
+                posicion,
+                pregunta.get("id_temporal"),
+                cabecera.get("materia") or Path(ruta).parent.name,
+                cabecera.get("tema") or Path(ruta).stem,
+                _origen(ruta),
+                str(pregunta.get("pregunta") or ""),
+            ),
+        )
+        conn.execute(
+            "INSERT INTO fts (rowid, pregunta, opciones, explicacion) VALUES (?, ?, ?, ?)",
+            (
+                cur.lastrowid,
+                normalizar_busqueda(str(pregunta.get("pregunta") or "")),
+                normalizar_busqueda(_texto_opciones(pregunta.get("opciones"))),
+                normalizar_busqueda(str(pregunta.get("explicacion") or "")),
+            ),
+        )
+
+    def _borrar_archivo(self, conn: sqlite3.Connection, ruta: str) -> None:
+        conn.execute("DELETE FROM fts WHERE rowid IN (SELECT id FROM documentos WHERE archivo = ?)", (ruta,))
+        conn.execute("DELETE FROM documentos WHERE archivo = ?", (ruta,))
+        conn.execute("DELETE FROM huellas WHERE archivo = ?", (ruta,))
+
+    def indexar_pregunta(self, ruta: RutaArchivo, posicion: int, cabecera: Dict[str, Any], pregunta: Dict[str, Any]) -> None:
+        """Indexa una pregunta recién añadida en la posición `posicion` (0-based) del archivo"""
+        clave = Path(ruta).as_posix()
+        with self._transaccion() as conn:
+            self._insertar(conn, clave, posicion, cabecera, pregunta)
+            # Huella del almacén: evita reindexar el archivo en la próxima sincronización
+            conn.execute(
+                "INSERT OR REPLACE INTO huellas (archivo, huella) VALUES (?, ?)",
+                (clave, self._huella(clave, {clave: posicion + 1})),
+            )
+
+    def indexar_archivo(self, ruta: RutaArchivo, data: Dict[str, Any], huella: Optional[str] = None) -> int:
+        """Reemplaza en el índice todas las preguntas de un archivo"""
+        clave = Path(ruta).as_posix()
+        preguntas = [p for p in data.get("preguntas") or [] if isinstance(p, dict)]
+        with self._transaccion() as conn:
+            self._borrar_archivo(conn, clave)
+            for posicion, pregunta in enumerate(preguntas):
+                self._insertar(conn, clave, posicion, data, pregunta)
+            conn.execute(
+                "INSERT OR REPLACE INTO huellas (archivo, huella) VALUES (?, ?)",
+                (clave, huella or self._huella(clave, {})),
+            )
+        return len(preguntas)
+
+    @staticmethod
+    def _huella(ruta: str, totales_almacen: Dict[str, int]) -> str:
+        if ruta in totales_almacen:
+            return f"almacen:{totales_almacen[ruta]}"
+        try:
+            stat = Path(ruta).stat()
+        except OSError:
+            return ""
+        return f"disco:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def sincronizar(self) -> Dict[str, int]:
+        """Reindexa los archivos nuevos o modificados y quita los eliminados"""
+        inicio = time.perf_counter()
+        totales = question_store.totales()
+        actuales: Dict[str, str] = {ruta: self._huella(ruta, totales) for ruta in totales}
+        for base in BASES_BUSQUEDA:
+            if base.exists():
+                for path in base.rglob("*.json"):
+                    clave = path.as_posix()
+                    if clave not in actuales:
+                        actuales[clave] = self._huella(clave, totales)
+
+        indexadas = dict(self._db().execute("SELECT archivo, huella FROM huellas"))
+        cambiados = [ruta for ruta, huella in actuales.items() if indexadas.get(ruta) != huella]
+        eliminados = [ruta for ruta in indexadas if ruta not in actuales]
+
+        preguntas = 0
+        for ruta in sorted(cambiados):
+            data = question_store.obtener_archivo(ruta) if ruta in totales else None
+            if data is None:
+                try:
+                    data = json.loads(Path(ruta).read_text(encoding="utf-8"))
+                except (OSError, json.JSONDecodeError):
+                    logger.warning(f"⚠️ No se pudo leer {ruta}, se omite de la búsqueda")
+                    continue
+            if isinstance(data, dict) and isinstance(data.get("preguntas"), list):
+                preguntas += self.indexar_archivo(ruta, data, actuales[ruta])
+        if eliminados:
+            with self._transaccion() as conn:
+                for ruta in eliminados:
+                    self._borrar_archivo(conn, ruta)
+
+        resumen = {"archivos_reindexados": len(cambiados), "preguntas": preguntas, "archivos_eliminados": len(eliminados)}
+        logger.info(
+            f"🔎 Índice de búsqueda sincronizado en {time.perf_counter() - inicio:.2f}s",
+            extra={"campos": resumen},
+        )
+        return resumen
+
+    # ----- lectura -----
+
+    def buscar(
+        self,
+        consulta: str,
+        limite: int = 20,
+        materia: Optional[str] = None,
+        origen: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Preguntas que contienen todos los términos de la consulta (el último
+        también como prefijo), ordenadas por BM25.
+        """
+        tokens = normalizar_busqueda(consulta).split()
+        if not tokens:
+            return []
+        expresion = " ".join(f'"{t}"' for t in tokens[:-1]) + f' "{tokens[-1]}"*'
+
+        sql = (
+            "SELECT d.archivo, d.id_temporal, d.materia, d.tema, d.origen, d.pregunta, bm25(fts, ?, ?, ?) AS puntaje "
+            "FROM fts JOIN documentos d ON d.id = fts.rowid WHERE fts MATCH ?"
+        )
+        params: List[Any] = [*PESOS_BM25, expresion]
+        if materia:
+            sql += " AND d.materia = ?"
+            params.append(materia)
+        if origen:
+            sql += " AND d.origen = ?"
+            params.append(origen)
+        sql += " ORDER BY puntaje LIMIT ?"
+        params.append(limite)
+
+        columnas = ("archivo", "id_temporal", "materia", "tema", "origen", "pregunta", "puntaje")
+        resultados = []
+        for fila in self._db().execute(sql, params):
+            resultado = dict(zip(columnas, fila))
+            # bm25() es negativo (más negativo = más relevante)
+            resultado["puntaje"] = round(-resultado["puntaje"], 3)
+            resultados.append(resultado)
+        return resultados
+
+    def get_stats(self) -> Dict[str, int]:
+        conn = self._db()
+        return {
+            "preguntas": conn.execute("SELECT COUNT(*) FROM documentos").fetchone()[0],
+            "archivos": conn.execute("SELECT COUNT(*) FROM huellas").fetchone()[0],
+        }
+
+
+search_index = SearchIndex()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Índice de búsqueda de texto completo sobre las preguntas.")
+    sub = parser.add_subparsers(dest="accion", required=True)
+    sub.add_parser("sincronizar", help="Reindexa los archivos nuevos o modificados")
+    p_buscar = sub.add_parser("buscar", help="Busca preguntas")
+    p_buscar.add_argument("consulta")
+    p_buscar.add_argument("--limite", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.accion == "sincronizar":
+        print(f"OK: {search_index.sincronizar()}")
+    else:
+        for r in search_index.buscar(args.consulta, limite=args.limite):
+            print(f"{r['puntaje']:>8} {r['archivo']} [{r['id_temporal'] or '-'}] {r['pregunta'][:80]!r}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv[1:]))
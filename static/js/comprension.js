@@ -561,12 +561,17 @@ document.addEventListener('DOMContentLoaded', () => {
                     dificultad: typeof p.dificultad === 'number' ? p.dificultad : 1
                 }));
                 mostrarPreguntasExtraidas(preguntasExtraidas);
-                mostrarMensaje('✅ Preguntas procesadas correctamente. Revisa y edita antes de guardar.', 'success');
+                if (result.errores && result.errores.length) {
+                    const fallidas = result.errores.map(e => e.pregunta).join(', ');
+                    mostrarMensaje(`⚠️ No se pudo procesar la(s) pregunta(s) ${fallidas}. Complétalas manualmente antes de guardar.`, 'error');
+                } else {
+                    mostrarMensaje('✅ Preguntas procesadas correctamente. Revisa y edita antes de guardar.', 'success');
+                }
 
                 // Habilitar botón de guardar
                 document.getElementById('submitCompBtn').disabled = false;
             } else {
-                throw new Error(result.message || 'No se pudieron procesar las preguntas');
+                throw new Error(result.detail || result.message || 'No se pudieron procesar las preguntas');
             }
         } catch (error) {
             console.error('Error:', error);
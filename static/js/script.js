@@ -391,7 +391,19 @@ async function submitForm() {
         const result = await response.json();
         
         if (response.ok) {
-            showMessage('✅ Pregunta creada exitosamente', 'success');
+            const duplicados = result.posibles_duplicados || [];
+            const figuras = result.figuras_compartidas || [];
+            if (duplicados.length) {
+                const similares = duplicados
+                    .map(d => `${d.id_temporal || d.archivo} (${Math.round(d.similitud * 100)}%)`)
+                    .join(', ');
+                showMessage(`✅ Pregunta creada. ⚠️ Es muy parecida a: ${similares}`, 'warning');
+            } else if (figuras.length) {
+                const otras = [...new Set(figuras.map(f => f.id_temporal))].join(', ');
+                showMessage(`✅ Pregunta creada. 🖼️ Usa la misma figura que: ${otras}`, 'warning');
+            } else {
+                showMessage('✅ Pregunta creada exitosamente', 'success');
+            }
             showJsonPreview(result.pregunta);
             
             // Preguntar si continuar con el mismo proceso
@@ -588,6 +600,8 @@ function showMessage(text, type, doScroll = true) {
     mensaje.textContent = text;
     if (type === 'success') {
         mensaje.className = 'mt-8 rounded-2xl border border-emerald-200 bg-emerald-50 px-4 py-3 text-center text-sm font-semibold text-emerald-700';
+    } else if (type === 'warning') {
+        mensaje.className = 'mt-8 rounded-2xl border border-amber-200 bg-amber-50 px-4 py-3 text-center text-sm font-semibold text-amber-700';
     } else {
         mensaje.className = 'mt-8 rounded-2xl border border-rose-200 bg-rose-50 px-4 py-3 text-center text-sm font-semibold text-rose-700';
     }
@@ -1214,14 +1228,20 @@ async function processImageWithAI(event) {
         if (currentAIImages[2]) formData.append('image2', currentAIImages[2]);
         formData.append('ai_service', aiService);
 
-        const response = await fetch('/api/process-image-ai', {
+        // Respuesta en streaming: los campos se rellenan a medida que llegan
+        const response = await fetch('/api/process-image-ai/stream', {
             method: 'POST',
             body: formData
         });
 
-        const result = await response.json();
+        if (!response.ok) {
+            const errorData = await response.json().catch(() => ({}));
+            throw new Error(errorData.detail || 'Error procesando imagen');
+        }
 
-        if (response.ok && result.success) {
+        const result = await readAIStream(response, fillFieldFromAIStream);
+
+        if (result && result.success) {
             const aiData = result.data;
 
             // Guardar posición actual del scroll
@@ -1248,10 +1268,15 @@ async function processImageWithAI(event) {
             // Mensaje diferenciado según el tipo de respuesta (sin scroll)
             if (aiData.ai_service === 'mock' || aiData.note) {
                 showMessage('🧪 Procesado en MODO SIMULADO - Configura API key para IA real', 'error', false);
+            } else if (aiData.ai_service === 'banco') {
+                // La figura ya estaba guardada en una pregunta del banco: no se llamó a la IA
+                showMessage(`🖼️ Figura ya registrada en ${aiData.figura_conocida.id_temporal}: se cargaron sus datos`, 'warning', false);
             } else {
                 const serviceName = getServiceDisplayName(aiData.ai_service);
                 const imageCount = (hasImage1 ? 1 : 0) + (hasImage2 ? 1 : 0);
-                showMessage(`🤖 ¡${serviceName} procesó ${imageCount} imagen(es) exitosamente!`, 'success', false);
+                // El router puede responder con otro proveedor si el elegido falla o tarda demasiado
+                const fallback = aiData.ai_service !== aiService ? ` (respaldo de ${getServiceDisplayName(aiService)})` : '';
+                showMessage(`🤖 ¡${serviceName} procesó ${imageCount} imagen(es) exitosamente!${fallback}`, 'success', false);
             }
 
             // Remover listener y asegurar posición del scroll después de un momento
@@ -1260,7 +1285,7 @@ async function processImageWithAI(event) {
                 window.scrollTo(scrollLeft, scrollPosition);
             }, 100);
         } else {
-            throw new Error(result.detail || 'Error procesando imagen');
+            throw new Error((result && result.detail) || 'Error procesando imagen');
         }
 
     } catch (error) {
@@ -1273,6 +1298,106 @@ async function processImageWithAI(event) {
     }
 }
 
+// Lee la respuesta Server-Sent Events de /api/process-image-ai/stream.
+// Llama a onField(ruta, valor) por cada evento `campo` y devuelve el evento final
+// (`resultado` → {success, data}; `error` → {detail}).
+async function readAIStream(response, onField) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let final = null;
+
+    const handleEvent = (raw) => {
+        let eventName = 'message';
+        const dataLines = [];
+        raw.split('\n').forEach(line => {
+            if (line.startsWith('event:')) eventName = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).trimStart());
+        });
+        if (!dataLines.length) return;
+        const data = JSON.parse(dataLines.join('\n'));
+        if (eventName === 'campo') {
+            onField(data.ruta, data.valor);
+        } else if (eventName === 'resultado' || eventName === 'error') {
+            final = data;
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            handleEvent(buffer.slice(0, sep));
+            buffer = buffer.slice(sep + 2);
+        }
+    }
+    if (buffer.trim()) handleEvent(buffer);
+    return final;
+}
+
+// Espera un trabajo de la cola (/api/jobs/{id}/eventos) y devuelve su resultado.
+// onState(job) recibe los cambios intermedios (pendiente con su posición, en_curso).
+// Si la conexión de eventos se corta, sigue consultando GET /api/jobs/{id}.
+function waitForJob(jobId, onState) {
+    return new Promise((resolve, reject) => {
+        const finish = (job) => {
+            if (job.estado === 'listo') resolve(job.resultado);
+            else reject(new Error(job.error || 'El trabajo terminó con error'));
+        };
+
+        const poll = async () => {
+            try {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                const data = await response.json();
+                if (!response.ok) throw new Error(data.detail || 'Trabajo no encontrado');
+                if (data.job.estado === 'listo' || data.job.estado === 'error') return finish(data.job);
+                if (onState) onState(data.job);
+                setTimeout(poll, 1500);
+            } catch (error) {
+                reject(error);
+            }
+        };
+
+        const source = new EventSource(`/api/jobs/${jobId}/eventos`);
+        source.addEventListener('estado', (e) => {
+            if (onState) onState(JSON.parse(e.data));
+        });
+        source.addEventListener('fin', (e) => {
+            source.close();
+            finish(JSON.parse(e.data));
+        });
+        source.onerror = () => {
+            source.close();
+            poll();
+        };
+    });
+}
+
+// Vista previa de un campo recibido en streaming (el resultado final lo reemplaza con fillFormFromAI)
+function fillFieldFromAIStream(ruta, valor) {
+    if (valor === null || valor === undefined || typeof valor === 'object') return;
+
+    let fieldId = null;
+    if (ruta === 'materia' || ruta === 'tema' || ruta === 'pregunta' || ruta === 'dificultad') {
+        fieldId = ruta;
+    } else if (/^opciones\.[A-E]$/.test(ruta)) {
+        fieldId = `opcion_${ruta.slice(-1).toLowerCase()}`;
+    }
+    if (!fieldId) return;
+
+    const field = document.getElementById(fieldId);
+    if (!field) return;
+
+    field.value = valor;
+    if (field.tagName === 'TEXTAREA') {
+        if (fieldId === 'pregunta' || fieldId.startsWith('opcion_')) updateMathPreview(fieldId);
+        autoResize.call(field);
+    }
+    clearFieldError(field);
+}
+
 function setAIProcessingState(processing) {
     const processBtn = document.getElementById('processWithAI');
     const btnText = processBtn.querySelector('.ai-btn-text');
@@ -1686,9 +1811,12 @@ async function generateExplanationWithAI(event) {
         const result = await response.json();
 
         if (response.ok && result.success) {
+            // La explicación se genera en la cola de trabajos
+            const job = await waitForJob(result.job_id);
+
             // Llenar el campo de explicación
             const explicacionField = document.getElementById('explicacion');
-            explicacionField.value = result.explanation;
+            explicacionField.value = job.explanation;
             updateMathPreview('explicacion');
             autoResize.call(explicacionField);
 
@@ -208,8 +208,15 @@ async function generarVariacion() {
             throw new Error('No se pudo generar la variación');
         }
 
+        // La variación se genera en la cola de trabajos: esperar su resultado
+        const variacion = await waitForJob(data.job_id, (job) => {
+            generateBtn.innerHTML = job.estado === 'pendiente' && job.posicion
+                ? `<span class="inline-block animate-spin">⏳</span> En cola (${job.posicion} antes)...`
+                : '<span class="inline-block animate-spin">⏳</span> Generando...';
+        });
+
         // Mostrar resultados
-        mostrarResultadoVariacion(data.data);
+        mostrarResultadoVariacion(variacion);
 
     } catch (error) {
         console.error('Error generando variación:', error);
@@ -0,0 +1,42 @@
+"""
+Pool de hilos dedicado a la E/S de almacenamiento.
+
+Los handlers `async def` de main.py no deben hacer open/json.dump/glob/copias
+de archivos directamente en el event loop: una escritura lenta a disco
+congelaría todas las llamadas de IA en curso de ese worker. Todo ese trabajo
+se ejecuta aquí con `await run_storage(fn, *args)`.
+
+Variables de entorno:
+- STORAGE_WORKERS: hilos del pool (default 4)
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, TypeVar
+
+from dotenv import load_dotenv
+
+from metrics import storage_duration
+
+load_dotenv()
+
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "4"))
+
+T = TypeVar("T")
+
+_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+
+
+async def run_storage(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Ejecuta una función bloqueante de almacenamiento en el pool dedicado"""
+    loop = asyncio.get_running_loop()
+    # Incluye la espera en la cola del pool: crece si STORAGE_WORKERS se queda corto
+    with storage_duration.time(operation=f"pool:{getattr(fn, '__name__', 'desconocida')}"):
+        return await loop.run_in_executor(_executor, partial(fn, *args, **kwargs))
+
+
+def shutdown_storage_pool() -> None:
+    """Espera a que terminen las escrituras pendientes (se llama al apagar la app)"""
+    _executor.shutdown(wait=True)
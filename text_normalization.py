@@ -0,0 +1,45 @@
+"""
+Normalización de texto de preguntas, sin dependencias fuera de la biblioteca
+estándar: la usan la app (utils.py, search_index.py, near_dup.py) y el
+generador de preguntas sintéticas, que no instala las dependencias de la app.
+"""
+
+import re
+
+# Caracteres con tilde y su reemplazo
+REEMPLAZOS_TILDES = {
+    'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
+    'ñ': 'n', 'ü': 'u'
+}
+
+
+def plegar_tildes(texto: str) -> str:
+    """
+    Minúsculas y sin tildes (misma normalización que normalizar_texto, sin tocar la puntuación)
+    """
+    texto = texto.lower()
+    for char, replacement in REEMPLAZOS_TILDES.items():
+        texto = texto.replace(char, replacement)
+    return texto
+
+
+# LaTeX mal escapado en JSON generado: "\frac" se lee como form feed + "rac", "\times" como tab + "imes"
+_ESCAPES_PERDIDOS = re.compile(r"[\f\b]|\t(?=[a-z])")
+_LATEX_ESPACIOS = re.compile(r"\\[,;:! ]")
+_LATEX_DELIMITADORES = re.compile(r"\\(?:left|right|big|Big|bigg|Bigg)\b")
+_LATEX_COMANDO = re.compile(r"\\([a-z]+)")
+_DECIMAL_COMA = re.compile(r"(\d),(\d)")
+_SIMBOLOS_LATEX = re.compile(r"[$^_{}\\]")
+_TOKEN = re.compile(r"\w+")
+
+
+def normalizar_busqueda(texto: str) -> str:
+    """Texto (con LaTeX) -> tokens normalizados separados por espacios"""
+    texto = _ESCAPES_PERDIDOS.sub(lambda m: {"\f": "\\f", "\b": "\\b", "\t": "\\t"}[m.group()], texto or "")
+    texto = _LATEX_ESPACIOS.sub(" ", texto)
+    texto = _LATEX_DELIMITADORES.sub(" ", texto)
+    texto = plegar_tildes(texto)
+    texto = _LATEX_COMANDO.sub(r" \1 ", texto)
+    texto = _DECIMAL_COMA.sub(r"\1.\2", texto)
+    texto = _SIMBOLOS_LATEX.sub(" ", texto)
+    return " ".join(_TOKEN.findall(texto))
@@ -1,24 +1,22 @@
 import re
-import json
 import os
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, BinaryIO
+import shutil
+from question_store import question_store, QUESTION_STORE_EXPORT_ON_WRITE
+from metrics import storage_duration
+from text_normalization import plegar_tildes
+from near_dup import indice_duplicados
+
+# Extensiones de imagen aceptadas (validación y numeración de archivos)
+EXTENSIONES_IMAGEN = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
 
 def normalizar_texto(texto: str) -> str:
     """
     Normaliza texto: minúsculas, sin tildes, espacios -> guiones bajos
     """
-    # Convertir a minúsculas
-    texto = texto.lower()
-    
-    # Reemplazar caracteres con tilde
-    replacements = {
-        'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-        'ñ': 'n', 'ü': 'u'
-    }
-    
-    for char, replacement in replacements.items():
-        texto = texto.replace(char, replacement)
+    # Minúsculas y sin tildes
+    texto = plegar_tildes(texto)
     
     # Reemplazar espacios y caracteres especiales con guiones bajos
     texto = re.sub(r'[^\w]', '_', texto)
@@ -34,75 +32,107 @@ def normalizar_texto(texto: str) -> str:
 def obtener_siguiente_numero(directorio: Path, prefijo: str) -> int:
     """
     Obtiene el siguiente número disponible para archivos con un prefijo dado
+    escaneando el directorio (cubre todas las EXTENSIONES_IMAGEN).
+    Solo se usa para reconstruir el contador persistido; ver reservar_numero_imagen.
     """
     if not directorio.exists():
         return 1
     
-    archivos = list(directorio.glob(f"{prefijo}_*.jpg")) + \
-               list(directorio.glob(f"{prefijo}_*.png")) + \
-               list(directorio.glob(f"{prefijo}_*.jpeg"))
-    
-    if not archivos:
-        return 1
-    
-    numeros = []
-    for archivo in archivos:
-        # Extraer número del nombre del archivo
-        match = re.search(r'_(\d{3})\.(jpg|png|jpeg)$', archivo.name)
-        if match:
-            numeros.append(int(match.group(1)))
-    
-    if not numeros:
-        return 1
+    patron = re.compile(rf'^{re.escape(prefijo)}_(\d{{3,}})\.([A-Za-z0-9]+)$')
+    max_num = 0
+    for archivo in directorio.iterdir():
+        match = patron.match(archivo.name)
+        if match and f".{match.group(2).lower()}" in EXTENSIONES_IMAGEN:
+            max_num = max(max_num, int(match.group(1)))
     
-    return max(numeros) + 1
+    return max_num + 1
+
+def reservar_numero_imagen(directorio: Path, prefijo: str) -> int:
+    """
+    Reserva el siguiente número de imagen para un prefijo usando un contador
+    persistido en el almacén de preguntas. El directorio solo se escanea la
+    primera vez (reconstrucción del contador a partir de los archivos en disco).
+    """
+    nombre = f"imagen:{Path(directorio).as_posix()}/{prefijo}"
+    return question_store.reservar_contador(nombre, lambda: obtener_siguiente_numero(directorio, prefijo) - 1)
+
+def guardar_imagen(imagenes_dir: Path, prefijo: str, extension: str, origen: BinaryIO) -> str:
+    """
+    Reserva el siguiente número de imagen (contador atómico, sin escanear el
+    directorio) y guarda el archivo. Devuelve el nombre del archivo guardado.
+    """
+    with storage_duration.time(operation="guardar_imagen"):
+        while True:
+            siguiente_num = reservar_numero_imagen(imagenes_dir, prefijo)
+            nombre_imagen = f"{prefijo}_{siguiente_num:03d}.{extension}"
+            try:
+                # "xb": nunca sobrescribir una imagen existente (p. ej. copiada a mano)
+                with open(imagenes_dir / nombre_imagen, "xb") as buffer:
+                    shutil.copyfileobj(origen, buffer)
+                return nombre_imagen
+            except FileExistsError:
+                continue
 
 def guardar_pregunta_json(archivo_path: Path, materia: str, tema: str, nueva_pregunta: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Guarda una pregunta en el archivo JSON correspondiente.
-    Si el archivo no existe, lo crea. Si existe, agrega la pregunta al array.
+    Guarda una pregunta en el almacén indexado (inserción O(1)). El JSON del
+    tema se regenera en segundo plano, agrupando las inserciones seguidas
+    (o en la misma llamada con QUESTION_STORE_EXPORT_ON_WRITE).
+
+    Las preguntas del banco casi duplicadas de la nueva (near_dup.py) se
+    devuelven en "posibles_duplicados"; la pregunta se guarda igual.
     """
-    
-    # Estructura base del JSON
-    estructura_base = {
+    with storage_duration.time(operation="guardar_pregunta"):
+        total = question_store.agregar_pregunta(archivo_path, materia, tema, nueva_pregunta)
+
+    if QUESTION_STORE_EXPORT_ON_WRITE:
+        with storage_duration.time(operation="exportar_json_tema"):
+            question_store.exportar_archivo(archivo_path)
+    else:
+        question_store.programar_exportacion(archivo_path)
+
+    ruta = Path(archivo_path).as_posix()
+    posibles_duplicados = indice_duplicados.registrar(f"{ruta}#{total - 1}", nueva_pregunta, archivo=ruta)
+
+    return {
         "materia": materia,
         "tema": tema,
-        "preguntas": []
+        "total_preguntas": total,
+        "posibles_duplicados": posibles_duplicados
     }
-    
-    # Si el archivo existe, cargar datos existentes
-    if archivo_path.exists():
-        try:
-            with open(archivo_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            data = estructura_base
-    else:
-        data = estructura_base
-    
-    # Asegurar que la estructura es correcta
-    if "preguntas" not in data:
-        data["preguntas"] = []
-    
-    # Agregar nueva pregunta
-    data["preguntas"].append(nueva_pregunta)
-    
-    # Guardar archivo
-    with open(archivo_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-    
-    return data
+
+def reservar_id_temporal(archivo_path: Path, materia: str, tema: str) -> str:
+    """
+    Reserva de forma atómica el siguiente id_temporal del tema
+    con formato: [materia_3chars]_[tema_3chars]_[num]
+    """
+    numero = question_store.reservar_numero_id(archivo_path, materia, tema)
+    return f"{materia[:3]}_{tema[:3]}_{numero:03d}"
+
+def siguiente_numero_texto(materia_dir: Path) -> int:
+    """
+    Obtiene el siguiente número disponible para textos de comprensión (texto_XXX.json)
+    """
+    if not materia_dir.exists():
+        return 1
+
+    max_num = 0
+    for archivo in materia_dir.glob("texto_*.json"):
+        match = re.search(r"texto_(\d{3})\.json$", archivo.name)
+        if match:
+            max_num = max(max_num, int(match.group(1)))
+
+    return max_num + 1
 
 def validar_extension_imagen(filename: str) -> bool:
     """
     Valida que la extensión del archivo sea una imagen permitida
     """
-    extensiones_permitidas = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
     if not filename:
         return False
     
     extension = Path(filename).suffix.lower()
-    return extension in extensiones_permitidas
+    return extension in EXTENSIONES_IMAGEN
 
 def limpiar_texto(texto: str) -> str:
     """